@@ -39,6 +39,19 @@
 #define UPPER_VOLTAGE_LIMIT 4.5     //Manufacturer states that 4.1 is the charge cut-off voltage
 #define CURRENT_LIMIT 5.0           //Maximum continous discharge in datasheet is 3C = 4.5A so 5A as a worst case limit should be reasonable
 
+#define SAMPLE_INTERVAL 100U        // Default loop time in milliseconds (ascii protocol)
+#define CONTROL_INTERVAL 100U       // The regulators are tuned for an update every 100 ms, also if samples are taken faster
+#define ADC_SETTLE_TIME 15          // Wait time for an ADC conversion in ms (ascii protocol)
+#define ADC_FAST_SETTLE_TIME 2      // Wait time for an ADC conversion in ms in binary mode, the ADS1115 needs 1.2 ms at 860 SPS
+#define MIN_SAMPLE_INTERVAL 10U     // Shortest sample interval in ms that can be requested for the binary protocol
+
+//Binary framed protocol (see binary_protocol.py): A5 5A, count, sequence (uint16), count * 13 byte samples, CRC-16/CCITT-FALSE
+#define FRAME_SYNC_0 0xA5
+#define FRAME_SYNC_1 0x5A
+#define FRAME_MAX_SAMPLES 8
+#define FRAME_SAMPLE_SIZE 13
+#define FRAME_HEADER_SIZE 5
+
 
 typedef enum 
 {
@@ -65,6 +78,15 @@ float cutoff_current = 0.05;
 float CURRENT_SENSE_ZERO_VOLTAGE = 2.52;  //This is no constant because the zero current value is recalibrated at startup
 
 uint32_t last_millis;
+uint32_t last_control_millis;
+testState_t last_control_state;
+
+uint8_t binary_mode = 0;                          //Samples are sent as binary frames instead of ascii lines
+uint8_t samples_per_frame = 1;
+uint32_t sample_interval = SAMPLE_INTERVAL;
+uint16_t frame_sequence = 0;
+uint8_t frame_samples = 0;
+uint8_t framebuffer[FRAME_HEADER_SIZE + FRAME_MAX_SAMPLES * FRAME_SAMPLE_SIZE + 2];
 
 testState_t teststate;
 
@@ -84,33 +106,43 @@ void setup() {
   calibrate_current_sensor();                     //Calibrate the current Sensor 
 
   last_millis = millis();                         //Initialize loop time counter
+  last_control_millis = last_millis;
+  last_control_state = teststate;
 }
 
 void loop() {
   
-   //The loop is only executed every 100 milliseconds
-   if((millis() - last_millis) > 100U)
+   //The loop is only executed every 100 milliseconds (or the sample interval of the binary protocol)
+   if((millis() - last_millis) > sample_interval)
    {
 
      //Update Timing
      last_millis = millis();
 
      //Read Current and Voltage Values
+     uint8_t settle_time = binary_mode ? ADC_FAST_SETTLE_TIME : ADC_SETTLE_TIME;
      writeADC(ADC_CONFIG_REG,ADC_CURRENT_CONFIG);
-     delay(15);
+     delay(settle_time);
      current = convertCurrent(readADC(ADC_CONVERSION_REG));
      writeADC(ADC_CONFIG_REG,ADC_VOLTAGE_CONFIG);
-     delay(15);
+     delay(settle_time);
      voltage = convertVoltage(readADC(ADC_CONVERSION_REG));
 
      //Print to screen
-     Serial.print(teststate);
-     Serial.print(',');
-     Serial.print(last_millis);
-     Serial.print(',');
-     Serial.print(voltage,4);
-     Serial.print(',');
-     Serial.println(current,4);
+     if(binary_mode)
+     {
+       addFrameSample();
+     }
+     else
+     {
+       Serial.print(teststate);
+       Serial.print(',');
+       Serial.print(last_millis);
+       Serial.print(',');
+       Serial.print(voltage,4);
+       Serial.print(',');
+       Serial.println(current,4);
+     }
 
      //Check Limits and revert to IDLE if limits are Broken
      if(voltage < LOWER_VOLTAGE_LIMIT)
@@ -127,6 +159,13 @@ void loop() {
 
      //Execute function for current 
      SerialRead(); 
+
+     //With faster samples the regulators are still updated every CONTROL_INTERVAL, a new state is applied immediately
+     if(binary_mode && (teststate == last_control_state) && ((last_millis - last_control_millis) < CONTROL_INTERVAL))
+       return;
+     last_control_millis = last_millis;
+     last_control_state = teststate;
+
      switch(teststate)
      {
        case IDLE:
@@ -165,6 +204,59 @@ void loop() {
    
 }
 
+/**
+ * @brief Update a CRC-16/CCITT-FALSE (polynomial 0x1021, start value 0xFFFF)
+ * 
+ * @param crc CRC of the previous bytes
+ * @param data next byte
+ * @return uint16_t updated CRC
+ */
+uint16_t crc16_update(uint16_t crc, uint8_t data)
+{
+  crc ^= ((uint16_t) data) << 8;
+  for(uint8_t i = 0; i < 8; i++)
+  {
+    if(crc & 0x8000)
+      crc = (crc << 1) ^ 0x1021;
+    else
+      crc = crc << 1;
+  }
+  return crc;
+}
+
+/**
+ * @brief Add the current sample to the binary frame and send the frame when it is full
+ * 
+ * All values are copied in the little endian byte order of the AVR
+ */
+void addFrameSample()
+{
+  uint8_t *sample = &framebuffer[FRAME_HEADER_SIZE + frame_samples * FRAME_SAMPLE_SIZE];
+  sample[0] = (uint8_t) teststate;
+  memcpy(&sample[1], &last_millis, 4);
+  memcpy(&sample[5], &voltage, 4);
+  memcpy(&sample[9], &current, 4);
+  frame_samples++;
+
+  if(frame_samples >= samples_per_frame)
+  {
+    frame_sequence++;
+    framebuffer[0] = FRAME_SYNC_0;
+    framebuffer[1] = FRAME_SYNC_1;
+    framebuffer[2] = frame_samples;
+    framebuffer[3] = (uint8_t) (frame_sequence & 0xFF);
+    framebuffer[4] = (uint8_t) (frame_sequence >> 8);
+    uint16_t length = FRAME_HEADER_SIZE + frame_samples * FRAME_SAMPLE_SIZE;
+    uint16_t crc = 0xFFFF;
+    for(uint16_t i = 2; i < length; i++)
+      crc = crc16_update(crc, framebuffer[i]);
+    framebuffer[length] = (uint8_t) (crc & 0xFF);
+    framebuffer[length + 1] = (uint8_t) (crc >> 8);
+    Serial.write(framebuffer, length + 2);
+    frame_samples = 0;
+  }
+}
+
 /**
  * @brief Compensate for the offset Voltage of the current sensor
  * 
@@ -393,6 +485,34 @@ void SerialRead()
       }
     }
 
+    if(terminated && (stringbuffer[0] == 'B'))
+    {
+      //Switch to binary frames: "B <samples per frame> <sample interval in ms>"
+      int frame_size = 1;
+      int interval = SAMPLE_INTERVAL;
+      sscanf(stringbuffer,"B %d %d",&frame_size, &interval);
+      if(frame_size < 1) frame_size = 1;
+      if(frame_size > FRAME_MAX_SAMPLES) frame_size = FRAME_MAX_SAMPLES;
+      if(interval < (int) MIN_SAMPLE_INTERVAL) interval = MIN_SAMPLE_INTERVAL;
+      samples_per_frame = (uint8_t) frame_size;
+      sample_interval = (uint32_t) interval;
+      frame_samples = 0;
+      binary_mode = 1;
+      for(uint8_t i = 0; i < 64; i++) stringbuffer[i] = 0;
+      terminated = 0;
+      stringpointer = 0;
+    }
+    else if(terminated && (stringbuffer[0] == 'A'))
+    {
+      //Switch back to ascii lines
+      binary_mode = 0;
+      sample_interval = SAMPLE_INTERVAL;
+      frame_samples = 0;
+      for(uint8_t i = 0; i < 64; i++) stringbuffer[i] = 0;
+      terminated = 0;
+      stringpointer = 0;
+    }
+
     if(terminated)
     {
       char vset[10];
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import pickle
+import types
+import hashlib
+import numpy as np
+import binary_log
+
+
+"""
+The Purpose of this Module is to store the results of analyses (capacity, OCV, HPPC parameters, ...) of the logs in
+Measurement_Data, so repeated analyses and plots of the whole corpus only recompute new or modified logs.
+
+A result is stored under a key calculated from the sha1 of the content of the log, the name of the analysis function,
+the sha1 of the sources of its module and its parameters. The log is the file binary_log.load_log() really reads, i.e.
+the binary version if it is up to date. The sources are the module of the function and every module of this folder it
+imports directly or indirectly (binary_log, hppc_tester, ocv_analysis, ...). A modified log, a regenerated binary log
+or a modified analysis or dependency therefore gets a new key, the old result is removed by the eviction later. Modules
+are named by their file, so running an analysis module as a script (__main__) and importing it uses the same results.
+To avoid hashing unchanged files again, the hash is remembered together with the size and modification time of the file.
+
+The results are pickled into one file per key inside the cache folder. Every hit updates the modification time of the
+file, if the folder gets larger than max_bytes the least recently used files are deleted. Files are written to a
+temporary file first and then renamed, so multiple processes can use the same cache.
+
+Example:
+
+cache = analysis_cache.analysiscache()
+parameters = cache.call(hppc_analysis.analyse_file, "hppc_test.csv", capacity=1.5)
+
+Usage as a script prints the size of the cache or clears it:
+
+python analysis_cache.py [clear]
+"""
+
+
+CACHE_VERSION = 1
+DEFAULT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".analysis_cache")
+HASH_FILE = "file_hashes.json"
+RESULT_EXTENSION = ".pkl"
+
+
+def _describe(value):
+    """Returns a json compatible description of a parameter, numpy arrays are described by a hash of their data"""
+    if(isinstance(value, np.ndarray)):
+        return {"ndarray": hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest(), "dtype": str(value.dtype),
+                "shape": list(value.shape)}
+    if(isinstance(value, (list, tuple))):
+        return [_describe(v) for v in value]
+    if(isinstance(value, dict)):
+        return {str(k): _describe(v) for k, v in value.items()}
+    if(isinstance(value, np.generic)):
+        return value.item()
+    if(value is None or isinstance(value, (bool, int, float, str))):
+        return value
+    return repr(value)
+
+
+def file_hash(path, block_size=1 << 20):
+    """Returns the sha1 of the content of a file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class analysiscache:
+    """
+    Content addressed cache of analysis results with size based LRU eviction
+    """
+
+    def __init__(self, folder=DEFAULT_FOLDER, max_bytes=512 * 1024 * 1024):
+        """
+        Keyword arguments:
+        folder -- Folder of the cache, created if it doesn't exist
+        max_bytes -- Maximum size of all stored results in bytes
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+        self._hashes = self._load_hashes()
+        self._sources = {}
+
+    def _load_hashes(self):
+        try:
+            with open(os.path.join(self.folder, HASH_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_hashes(self):
+        path = os.path.join(self.folder, HASH_FILE)
+        temp_path = path + ".%d.tmp" % os.getpid()
+        with open(temp_path, 'w') as f:
+            json.dump(self._hashes, f)
+        os.replace(temp_path, path)
+
+    def file_hash(self, path):
+        """Returns the sha1 of a file, unchanged files (same size and modification time) are not hashed again"""
+        stat = os.stat(path)
+        name = os.path.abspath(path)
+        known = self._hashes.get(name)
+        if(known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns):
+            return known[2]
+        digest = file_hash(path)
+        self._hashes[name] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._save_hashes()
+        return digest
+
+    def _source_files(self, module):
+        """Returns the source files of a module and of all modules of this folder it imports directly or indirectly"""
+        folder = os.path.dirname(os.path.abspath(__file__))
+        files = set()
+        pending = [module]
+        while pending:
+            current = pending.pop()
+            path = getattr(current, "__file__", None)
+            if(path is None):
+                continue
+            path = os.path.abspath(path)
+            if(path in files or (current is not module and os.path.dirname(path) != folder)):
+                continue
+            files.add(path)
+            for value in vars(current).values():
+                if(isinstance(value, types.ModuleType)):
+                    pending.append(value)
+                else:
+                    #Functions and classes imported with from ... import
+                    name = getattr(value, "__module__", None)
+                    if(isinstance(name, str) and name in sys.modules):
+                        pending.append(sys.modules[name])
+        return sorted(files)
+
+    def _module(self, function):
+        """Returns the import name of the module of a function and the sha1 of the sources it depends on"""
+        module_name = getattr(function, "__module__", None) or ""
+        module = sys.modules.get(module_name)
+        module_file = getattr(module, "__file__", None)
+        if(module_file is None):
+            return module_name, None
+        if(module_name not in self._sources):
+            self._sources[module_name] = self._source_files(module)
+        hashes = [[os.path.basename(path), self.file_hash(path)] for path in self._sources[module_name]]
+        source_hash = hashlib.sha1(json.dumps(hashes).encode("utf-8")).hexdigest()
+        #Scripts run as __main__ are named like the imported module
+        return os.path.splitext(os.path.basename(module_file))[0], source_hash
+
+    def key(self, function, path, params):
+        """Returns the key of the result of function(path, **params)"""
+        module_name, module_hash = self._module(function)
+        name = module_name + "." + getattr(function, "__qualname__", repr(function))
+        log_hash = self.file_hash(binary_log.log_file(path))
+        description = json.dumps([CACHE_VERSION, name, module_hash, log_hash, _describe(params)], sort_keys=True)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + RESULT_EXTENSION)
+
+    def get(self, key):
+        """Returns (True, result) if the key is stored, otherwise (False, None)"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, result
+
+    def put(self, key, result):
+        path = self._path(key)
+        temp_path = path + ".%d.tmp" % os.getpid()
+        with open(temp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def call(self, function, path, **params):
+        """Returns function(path, **params), calculated only if the log or the parameters changed since the last call"""
+        key = self.key(function, path, params)
+        found, result = self.get(key)
+        if(found):
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = function(path, **params)
+        self.put(key, result)
+        return result
+
+    def entries(self):
+        """Returns (modification time, size, path) of every stored result, least recently used first"""
+        entries = []
+        for name in os.listdir(self.folder):
+            if(name.endswith(RESULT_EXTENSION)):
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        """Delete the least recently used results until the cache is smaller than max_bytes"""
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if(total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            os.remove(path)
+        self._hashes = {}
+        self._save_hashes()
+
+
+if __name__ == "__main__":
+    cache = analysiscache()
+    if(len(sys.argv) > 1 and sys.argv[1] == "clear"):
+        cache.clear()
+    print("%d results, %d bytes in %s" % (len(cache.entries()), cache.size(), os.path.abspath(cache.folder)))
@@ -0,0 +1,342 @@
+import math
+from collections import deque
+import hppc_tester
+
+
+"""
+The Purpose of this Module is to detect faults of a running test that check_operation_complete() doesn't see, e.g. a
+loose contact, a drifting current sensor or an oscillating current regulator, and to end the step or the whole test
+early instead of wasting hours of test time.
+
+The anomalydetector is added as observer to the acquisition loop of a channel (see schedule_engine.run_schedule and
+channel_manager) and checks every sample against statistics of the last samples (ring buffers with running sums, so the
+cost per sample is a constant number of scalar operations and every channel only works on its own samples):
+
+dvdt -- Outliers of dV/dt: dV/dt differs from the mean of the window by more than dvdt_threshold standard deviations
+        (and at least dvdt_min). Reported if dvdt_outliers outliers are inside one window (e.g. a loose contact)
+current -- Mean deviation of the current from the setpoint of the operation (tester.target_current) is larger than the
+           tolerance of the target_operating_mode. In CCCV mode only currents above the current limit count, because
+           the current decreases during the CV phase
+oscillation -- Standard deviation of the current over the window is larger than the limit of the target_operating_mode
+stall -- time_millis didn't increase for stall_samples samples while the tester keeps sending data
+reset -- time_millis jumped back (reset of the Arduino)
+mode -- The reported operatingmode differs from target_operating_mode for mode_samples samples (command not accepted)
+ir -- The resistance dV/dI measured at the first sample after a change of the current setpoint differs by more than
+      ir_jump (relative) from the mean of the previous transitions. Only operations that ran for their whole duration
+      are used as reference, after the voltage limits (empty or full cell) or the cutoff the resistance is not comparable
+
+The windows of the current and dV/dt are restarted at every change of the operation and the first settle_samples samples
+after it are not checked. A kind is reported at most once per window.
+
+Every anomaly is printed and stored in anomalies, so the channel is flagged. The kinds in end_step additionally end the
+running operation (interrupt condition of the schedulerunner), the kinds in abort stop the test (abort condition).
+The default thresholds are tuned on fake_serial.simulatedport. On real hardware (offset of the idle current, noise in the
+CV phase) only flag the anomalies first and use the conditions after checking the thresholds on recorded logs.
+
+Example:
+
+detector = anomaly_detector.anomalydetector(bat_tester, "COM6")
+runner = schedulerunner(steps, abort=detector.fault(), interrupt=detector.step_fault())
+run_schedule(bat_tester, runner, log, [detector])
+"""
+
+
+KINDS = ("dvdt", "current", "oscillation", "stall", "reset", "mode", "ir")
+
+#Tolerance of the mean current deviation per target_operating_mode: (absolute in A, relative to the setpoint)
+#The current sensor reads up to ~0.1A without current in IDLE mode and the current of CCP pulses is not regulated
+CURRENT_TOLERANCE = {
+    int(hppc_tester.operatingmodes["IDLE"]): (0.15, 0.0),
+    int(hppc_tester.operatingmodes["CCCV"]): (0.05, 0.05),
+    int(hppc_tester.operatingmodes["CCP"]): (0.1, 0.2),
+    int(hppc_tester.operatingmodes["CCR"]): (0.05, 0.05)
+}
+
+#Maximum standard deviation of the current over the window per target_operating_mode in A
+#The regulation of the CV phase is noisier than the regulated constant currents
+OSCILLATION_LIMIT = {
+    int(hppc_tester.operatingmodes["IDLE"]): 0.05,
+    int(hppc_tester.operatingmodes["CCCV"]): 0.15,
+    int(hppc_tester.operatingmodes["CCP"]): 0.1,
+    int(hppc_tester.operatingmodes["CCR"]): 0.05
+}
+
+
+class _window:
+    """
+    Mean and standard deviation of the last values, updated with running sums
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = deque(maxlen=size)
+        self.total = 0.0
+        self.squares = 0.0
+        self._updates = 0
+
+    def clear(self):
+        self.values.clear()
+        self.total = 0.0
+        self.squares = 0.0
+        self._updates = 0
+
+    def push(self, value):
+        if(len(self.values) == self.size):
+            old = self.values[0]
+            self.total -= old
+            self.squares -= old * old
+        self.values.append(value)
+        self.total += value
+        self.squares += value * value
+        self._updates += 1
+        if(self._updates >= self.size):
+            #Recalculate the sums once per window, so rounding errors don't accumulate
+            self._updates = 0
+            self.total = math.fsum(self.values)
+            self.squares = math.fsum(v * v for v in self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def full(self):
+        return len(self.values) == self.size
+
+    def mean(self):
+        return self.total / len(self.values)
+
+    def std(self):
+        n = len(self.values)
+        mean = self.total / n
+        return math.sqrt(max(self.squares / n - mean * mean, 0.0))
+
+
+class anomalydetector:
+    """
+    Online anomaly detector of one channel, used as observer of the acquisition loop
+    """
+
+    def __init__(self, tester=None, name=None, window=50, settle_samples=10, dvdt_threshold=8.0, dvdt_min=0.1,
+                 dvdt_outliers=3, current_tolerance=None, oscillation_limit=None, stall_samples=20, mode_samples=50,
+                 ir_min_current=0.2, ir_samples=5, ir_jump=0.5, ir_floor=0.01, ir_smoothing=0.3,
+                 end_step=("dvdt", "current", "oscillation", "ir"), abort=("stall", "reset", "mode"), history=100):
+        """
+        Keyword arguments:
+        tester -- hppc_tester.tester of the channel, the setpoints are read from it. channel_manager sets it if None
+        name -- Name of the channel used in the printed messages
+        window -- Number of samples of the rolling windows
+        settle_samples -- Samples after a change of the operation that are not checked
+        dvdt_threshold -- Deviation of dV/dt from the mean of the window in standard deviations that is an outlier
+        dvdt_min -- Minimum deviation of dV/dt in V/s that is an outlier (noise of the 4 decimal voltage)
+        dvdt_outliers -- Number of outliers inside one window that are reported
+        current_tolerance -- Dict of (absolute A, relative) tolerances per operating mode. Defaults to CURRENT_TOLERANCE
+        oscillation_limit -- Dict of the maximum standard deviation of the current per operating mode. Defaults to OSCILLATION_LIMIT
+        stall_samples -- Number of samples with the same time_millis that are reported
+        mode_samples -- Number of samples with a wrong operating mode that are reported
+        ir_min_current -- Minimum current change of a transition in A for the resistance measurement
+        ir_samples -- Number of samples after a transition in which the current change has to appear
+        ir_jump -- Relative change of the resistance that is reported
+        ir_floor -- Minimum change of the resistance in Ohm that is reported
+        ir_smoothing -- Weight of a new resistance in the mean of the transitions
+        end_step -- Kinds that end the running operation (condition step_fault())
+        abort -- Kinds that stop the test (condition fault())
+        history -- Number of anomalies kept in anomalies
+        """
+        self.tester = tester
+        self.name = name
+        self.settle_samples = settle_samples
+        self.dvdt_threshold = dvdt_threshold
+        self.dvdt_min = dvdt_min
+        self.dvdt_outliers = dvdt_outliers
+        self.current_tolerance = dict(CURRENT_TOLERANCE if current_tolerance is None else current_tolerance)
+        self.oscillation_limit = dict(OSCILLATION_LIMIT if oscillation_limit is None else oscillation_limit)
+        self.stall_samples = stall_samples
+        self.mode_samples = mode_samples
+        self.ir_min_current = ir_min_current
+        self.ir_samples = ir_samples
+        self.ir_jump = ir_jump
+        self.ir_floor = ir_floor
+        self.ir_smoothing = ir_smoothing
+        self.end_step = set(end_step)
+        self.abort = set(abort)
+        for kind in self.end_step | self.abort:
+            if(kind not in KINDS):
+                raise ValueError("Unknown anomaly " + str(kind))
+
+        self.anomalies = deque(maxlen=history)
+        self.counts = dict.fromkeys(KINDS, 0)
+        self.resistance = None
+        self.last_resistance = None
+        self.step = None
+        self.step_faulted = False
+        self.aborted = False
+
+        self._dvdt = _window(window)
+        self._outliers = deque(maxlen=window)
+        self._outlier_count = 0
+        self._deviation = _window(window)
+        self._reported = dict.fromkeys(KINDS, -window)
+        self._samples = 0
+        self._operation = None
+        self._settled = 0
+        self._stalled = 0
+        self._wrong_mode = 0
+        self._ir_pending = 0
+        self._ir_start = None
+        self._stop_time = None
+        self._last = None
+
+    def observe(self, step, sample):
+        mode, millis, voltage, current = sample
+        tester = self.tester
+        self._samples += 1
+        if(step != self.step):
+            self.step = step
+            self.step_faulted = False
+
+        target_mode = tester.target_operating_mode
+        setpoint = tester.target_current
+        operation = (target_mode, setpoint)
+        if(operation != self._operation):
+            self._start_operation(operation)
+
+        last = self._last
+        self._last = (millis, voltage, current)
+        if(last is None):
+            return
+        if(millis <= last[0]):
+            if(millis < last[0]):
+                self._report("reset", millis - last[0], step)
+                return
+            self._stalled += 1
+            if(self._stalled >= self.stall_samples):
+                self._report("stall", self._stalled, step)
+            return
+        self._stalled = 0
+
+        if(mode != target_mode):
+            self._wrong_mode += 1
+            if(self._wrong_mode >= self.mode_samples):
+                self._report("mode", mode, step)
+            return
+        self._wrong_mode = 0
+
+        if(self._ir_pending):
+            self._check_resistance(voltage, current, step)
+
+        self._settled += 1
+        if(self._settled <= self.settle_samples):
+            return
+
+        #dV/dt outliers, outliers are clipped before they are added to the window
+        dvdt = (voltage - last[1]) * 1000 / (millis - last[0])
+        window = self._dvdt
+        outlier = False
+        if(len(window) >= 10):
+            mean = window.mean()
+            limit = max(self.dvdt_threshold * window.std(), self.dvdt_min)
+            if(abs(dvdt - mean) > limit):
+                outlier = True
+                dvdt = mean + math.copysign(limit, dvdt - mean)
+        window.push(dvdt)
+        if(len(self._outliers) == self._outliers.maxlen):
+            self._outlier_count -= self._outliers[0]
+        self._outliers.append(outlier)
+        self._outlier_count += outlier
+        if(self._outlier_count >= self.dvdt_outliers):
+            self._report("dvdt", self._outlier_count, step)
+
+        #Deviation of the current from the setpoint
+        window = self._deviation
+        window.push(current - setpoint)
+        if(window.full()):
+            mean = window.mean()
+            if(target_mode == int(hppc_tester.operatingmodes["CCCV"])):
+                #Only currents above the current limit, the current decreases in the CV phase
+                mean = max(mean, 0.0)
+            tolerance = self.current_tolerance.get(target_mode, (0.05, 0.05))
+            if(abs(mean) > tolerance[0] + tolerance[1] * abs(setpoint)):
+                self._report("current", mean, step)
+            std = window.std()
+            if(std > self.oscillation_limit.get(target_mode, 0.05)):
+                self._report("oscillation", std, step)
+
+    def _start_operation(self, operation):
+        last = self._last
+        tester = self.tester
+        completed = self._stop_time is not None and tester.clock(tester) >= self._stop_time - 1.0
+        if(completed and last is not None and operation[1] != self._operation[1]):
+            #Resistance measurement with the last sample of the previous operation as reference
+            self._ir_start = (last[1], last[2])
+            self._ir_pending = self.ir_samples
+        else:
+            self._ir_pending = 0
+        self._stop_time = tester.instruction_stop_time
+        self._operation = operation
+        self._settled = 0
+        self._wrong_mode = 0
+        self._dvdt.clear()
+        self._deviation.clear()
+        self._outliers.clear()
+        self._outlier_count = 0
+
+    def _check_resistance(self, voltage, current, step):
+        self._ir_pending -= 1
+        start_voltage, start_current = self._ir_start
+        delta_current = current - start_current
+        if(abs(delta_current) < self.ir_min_current):
+            return
+        self._ir_pending = 0
+        resistance = (voltage - start_voltage) / delta_current
+        self.last_resistance = resistance
+        if(self.resistance is None):
+            self.resistance = resistance
+            return
+        if(abs(resistance - self.resistance) > self.ir_jump * abs(self.resistance) + self.ir_floor):
+            #A jump doesn't change the reference, so a loose contact is reported at every transition
+            self._report("ir", resistance, step)
+            return
+        self.resistance += self.ir_smoothing * (resistance - self.resistance)
+
+    def _report(self, kind, value, step):
+        if(self._samples - self._reported[kind] < self._dvdt.size):
+            return
+        self._reported[kind] = self._samples
+        self.counts[kind] += 1
+        self.anomalies.append((self._last[0] if self._last is not None else None, step, kind, value))
+        print("anomaly", "" if self.name is None else self.name, kind, value)
+        if(kind in self.end_step):
+            self.step_faulted = True
+        if(kind in self.abort):
+            self.aborted = True
+
+    def step_fault(self):
+        """Returns a condition that is met after an anomaly of the end_step kinds in the running step"""
+        return lambda tester: self.step_faulted
+
+    def fault(self):
+        """Returns a condition that is met after an anomaly of the abort kinds"""
+        return lambda tester: self.aborted
+
+    @property
+    def flagged(self):
+        return len(self.anomalies) > 0
+
+    def state(self):
+        """Returns the state of the detector as dict (see checkpoint.py)"""
+        return {"resistance": self.resistance, "counts": dict(self.counts)}
+
+    def restore(self, state):
+        """Continue with a state returned by state()"""
+        self.resistance = state["resistance"]
+        self.counts.update(state["counts"])
+        #The time base of the device may differ after a restart
+        self._last = None
+
+    def status(self):
+        return {
+            "name": self.name,
+            "flagged": self.flagged,
+            "counts": {kind: count for kind, count in self.counts.items() if count},
+            "last": None if not self.anomalies else self.anomalies[-1],
+            "resistance": self.resistance
+        }
@@ -0,0 +1,100 @@
+import os
+import sys
+import glob
+import time as tim
+import hppc_tester
+
+
+"""
+Micro benchmark for the line parsing of hppc_tester.tester. The recorded csv logs in Measurement_Data are converted back
+into the lines the Arduino sends ("mode,millis,voltage,current\r\n") and fed through an in-memory port. The previous
+implementation (Serial.readline(), decode, split and a second decode for the logfile) is compared with
+tester.read_sample(). Usage:
+
+python benchmark_parse.py [csv files]
+"""
+
+
+DEFAULT_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data", "static_capacity_tests", "*.csv")
+
+
+class bufferport:
+    """
+    In-memory replacement for a Serial object with the same readline(), read() and in_waiting behaviour
+    """
+
+    def __init__(self, data, block_size=64):
+        self._data = data
+        self._pos = 0
+        self._block_size = block_size
+
+    @property
+    def in_waiting(self):
+        return min(self._block_size, len(self._data) - self._pos)
+
+    def read(self, size=1):
+        chunk = self._data[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+    def readline(self):
+        #Serial.readline() reads byte by byte until the line ending
+        line = bytearray()
+        while True:
+            c = self.read(1)
+            if(not c):
+                break
+            line += c
+            if(c == b'\n'):
+                break
+        return bytes(line)
+
+    def write(self, data):
+        return len(data)
+
+
+def device_lines(csv_paths):
+    """Returns the recorded logs as the byte stream sent by the Arduino"""
+    lines = []
+    for path in csv_paths:
+        with open(path, 'rb') as f:
+            f.readline()
+            for line in f:
+                lines.append(line.split(b',', 1)[1].rstrip(b'\n') + b'\r\n')
+    return b"".join(lines), len(lines)
+
+
+def legacy_loop(port, count):
+    """Parsing as done before: Serial.readline(), decode and split in get_data, decode again for the logfile"""
+    for i in range(count):
+        data = port.readline()
+        values = str(data,'utf-8').split(',')
+        operatingmode = int(values[0])
+        time_millis = int(values[1])
+        voltage = float(values[2])
+        current = float(values[3])
+        logline = str(i) + "," + str(data,'utf-8').replace('\r', "")
+
+
+def fast_loop(port, count):
+    bat_tester = hppc_tester.tester(port)
+    for i in range(count):
+        sample, data = bat_tester.read_sample()
+        logline = b"%d," % i + data.replace(b'\r', b"")
+
+
+def measure(function, data, count):
+    start = tim.perf_counter()
+    function(bufferport(data), count)
+    return count / (tim.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] if len(sys.argv) > 1 else sorted(glob.glob(DEFAULT_FILES))
+    data, count = device_lines(paths)
+    print("lines: " + str(count))
+    legacy = measure(legacy_loop, data, count)
+    fast = measure(fast_loop, data, count)
+    print("readline + str parsing: %.0f lines/s" % legacy)
+    print("read_sample:            %.0f lines/s" % fast)
+    print("speedup:                %.2f" % (fast / legacy))
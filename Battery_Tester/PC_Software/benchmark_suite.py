@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import hashlib
+import platform
+import tempfile
+import subprocess
+import contextlib
+import io
+import time as tim
+import numpy as np
+import hppc_tester
+import log_writer
+import binary_log
+import binary_protocol
+import ocv_analysis
+import capacity_counter
+import fake_serial
+import benchmark_parse
+from schedule_engine import cccv, ccr, idle, repeat, schedulerunner, run_schedule
+
+
+"""
+The Purpose of this Module is to measure the speed of the PC software with the recorded logs of Measurement_Data, so
+changes of the parser, the log sinks or the analysis can be compared. Every benchmark is run several times, the fastest
+run is used for the throughput. The results are written as json file together with the versions of python and numpy,
+the git commit and the size and hash of every fixture, so the results of different runs can be compared:
+
+parse_get_data -- tester.get_data() on the recorded lines, fed through an in-memory port (benchmark_parse.bufferport)
+control_loop -- read_sample() and a schedule (check_operation_complete) on every replayed log with the device clock
+log_write_csv, log_write_bin, log_write_deadband -- log sinks of log_writer.open_log() writing every recorded sample
+load_csv, load_binary -- Loading the logs as csv and as binary log (binary_log.py), all columns are read
+binary_decode -- Decoding the samples as frames of the binary protocol (binary_protocol.framedecoder)
+capacity_counter -- Online capacity counting of every sample (capacity_counter.capacitycounter)
+capacity_analysis -- Charge and discharge capacity of every log with ocv_analysis.coulomb_count
+ocv_analysis -- ocv_analysis.extract_ocv on a simulated incremental OCV test, as the recorded OCV test was aborted
+               before its discharge part
+
+Every benchmark also stores check values (e.g. the number of completed steps or the capacities), a change of these
+values means that the results of the benchmark are not comparable. Usage:
+
+python benchmark_suite.py [results.json] [benchmark names]
+python benchmark_suite.py compare old.json new.json
+"""
+
+
+RESULT_VERSION = 1
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data")
+DEFAULT_FIXTURES = [os.path.join(DATA_FOLDER, "static_capacity_tests", "static_test_*.csv"),
+                    os.path.join(DATA_FOLDER, "OCV_Test", "*.csv")]
+REPEAT = 3
+
+
+class fixtureset:
+    """
+    Recorded logs used by the benchmarks. Converted data (device lines, records, binary logs) is created once and cached
+    """
+
+    def __init__(self, paths, workdir):
+        self.paths = paths
+        self.workdir = workdir
+        self._cache = {}
+
+    def _cached(self, key, function):
+        if(key not in self._cache):
+            self._cache[key] = function()
+        return self._cache[key]
+
+    def records(self, path):
+        return self._cached(("records", path), lambda: binary_log.load_csv(path))
+
+    def device_lines(self, path):
+        """Returns the lines of a log as sent by the Arduino and their number"""
+        return self._cached(("lines", path), lambda: benchmark_parse.device_lines([path]))
+
+    def binary(self, path):
+        """Returns the path of the log converted into a binary log"""
+        target = os.path.join(self.workdir, os.path.splitext(os.path.basename(path))[0] + ".bin")
+        return self._cached(("binary", path), lambda: binary_log.convert_csv(path, target))
+
+    def rows(self, path):
+        """Returns the log as list of (step, line, sample) as passed to the log sinks. Not cached because of its size"""
+        data = self.records(path)
+        lines = benchmark_parse.device_lines([path])[0].split(b'\n')
+        return [(step, line + b'\n', (mode, millis, voltage, current)) for step, line, mode, millis, voltage, current in
+                zip(data["step"].tolist(), lines, data["mode"].tolist(), data["time"].tolist(), data["voltage"].tolist(),
+                    data["current"].tolist())]
+
+    def simulated_ocv_log(self):
+        return self._cached("ocv", lambda: simulate_ocv_test(os.path.join(self.workdir, "simulated_ocv.csv")))
+
+    def describe(self):
+        """Returns size and sha1 of every fixture"""
+        result = {}
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            result[os.path.basename(path)] = {"bytes": os.path.getsize(path), "rows": len(self.records(path)),
+                                              "sha1": digest}
+        return result
+
+
+def simulate_ocv_test(path):
+    """Write the log of an incremental OCV test with shortened rests, simulated by fake_serial.simulatedport"""
+    if(os.path.exists(path)):
+        os.remove(path)
+    port = fake_serial.simulatedport(soc=0.3, voltage_noise=0.001, current_noise=0.002, seed=1)
+    bat_tester = hppc_tester.tester(port, hppc_tester.deviceclock())
+    steps = [
+        cccv(4.1, 0.75, 0.1, 10000, limits=(4.2, 1.4)),
+        repeat([idle(300, limits=(4.2, 1.5)), ccr(-0.5, 540)], until="uv"),
+        idle(10, limits=(4.1, 0.0)),
+        repeat([idle(300), ccr(0.5, 540)], until="ov")
+    ]
+    with log_writer.open_log(path) as log, contextlib.redirect_stdout(io.StringIO()):
+        run_schedule(bat_tester, schedulerunner(steps), log)
+    return path
+
+
+def _static_test_steps():
+    """Schedule of static_capacity_test.py, ends at the end of the replayed log"""
+    return [
+        cccv(4.1, 1.5, 0.075, 100000, limits=(4.2, 1.4)),
+        ccr(-1.5, 100000, limits=(4.2, 1.5)),
+        cccv(4.1, 1.5, 0.075, 100000, limits=(4.2, 1.4))
+    ]
+
+
+def bench_parse_get_data(fixtures):
+    elapsed = 0.0
+    count = 0
+    for path in fixtures.paths:
+        data, lines = fixtures.device_lines(path)
+        bat_tester = hppc_tester.tester(benchmark_parse.bufferport(data))
+        start = tim.perf_counter()
+        for i in range(lines):
+            bat_tester.get_data()
+        elapsed += tim.perf_counter() - start
+        count += lines
+    return elapsed, count, {"lines": count}
+
+
+def bench_control_loop(fixtures):
+    elapsed = 0.0
+    count = 0
+    steps = []
+    for path in fixtures.paths:
+        data, lines = fixtures.device_lines(path)
+        bat_tester = hppc_tester.tester(benchmark_parse.bufferport(data), hppc_tester.deviceclock())
+        runner = schedulerunner(_static_test_steps())
+        read = 0
+        start = tim.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            while read < lines:
+                sample, logdata = bat_tester.read_sample()
+                read += 1
+                if(sample is not None and not runner.update(bat_tester)):
+                    break
+        elapsed += tim.perf_counter() - start
+        count += read
+        steps.append(runner.step)
+    return elapsed, count, {"samples": count, "steps": steps}
+
+
+def _log_write(fixtures, formats, deadband=None):
+    elapsed = 0.0
+    count = 0
+    size = 0
+    for path in fixtures.paths:
+        rows = fixtures.rows(path)
+        target = os.path.join(fixtures.workdir, "log_write.csv")
+        for extension in (".csv", ".bin"):
+            if(os.path.exists(target[:-4] + extension)):
+                os.remove(target[:-4] + extension)
+        start = tim.perf_counter()
+        with log_writer.open_log(target, formats, deadband, fsync_interval=None) as log:
+            for step, line, sample in rows:
+                log.write(step, line, sample)
+        elapsed += tim.perf_counter() - start
+        count += len(rows)
+        size += sum(os.path.getsize(target[:-4] + "." + f) for f in formats)
+    return elapsed, count, {"bytes": size}
+
+
+def bench_log_write_csv(fixtures):
+    return _log_write(fixtures, ("csv",))
+
+
+def bench_log_write_bin(fixtures):
+    return _log_write(fixtures, ("bin",))
+
+
+def bench_log_write_deadband(fixtures):
+    return _log_write(fixtures, ("csv",), (0.002, 0.02, 10.0))
+
+
+def _voltage_sum(data):
+    #Reads every column, so a memory mapped log is really read
+    return float(np.sum(data["voltage"], dtype=np.float64) + np.sum(data["current"], dtype=np.float64)
+                 + np.sum(data["time"], dtype=np.float64) + np.sum(data["step"]) + np.sum(data["mode"]))
+
+
+def bench_load_csv(fixtures):
+    start = tim.perf_counter()
+    rows = 0
+    total = 0.0
+    for path in fixtures.paths:
+        data = binary_log.load_csv(path)
+        rows += len(data)
+        total += _voltage_sum(data)
+    return tim.perf_counter() - start, rows, {"rows": rows, "checksum": round(total, 3)}
+
+
+def bench_load_binary(fixtures):
+    paths = [fixtures.binary(path) for path in fixtures.paths]
+    start = tim.perf_counter()
+    rows = 0
+    total = 0.0
+    for path in paths:
+        data = binary_log.load_binary(path)
+        rows += len(data)
+        total += _voltage_sum(data)
+    return tim.perf_counter() - start, rows, {"rows": rows, "checksum": round(total, 3)}
+
+
+def bench_binary_decode(fixtures):
+    elapsed = 0.0
+    count = 0
+    frames = 0
+    for path in fixtures.paths:
+        data = fixtures.records(path)
+        samples = list(zip(data["mode"].tolist(), data["time"].tolist(), data["voltage"].tolist(), data["current"].tolist()))
+        stream = b"".join(binary_protocol.encode_frame(i, samples[start:start + 8])
+                          for i, start in enumerate(range(0, len(samples), 8)))
+        decoder = binary_protocol.framedecoder()
+        start = tim.perf_counter()
+        #Blocks of the size a COM port read returns
+        for position in range(0, len(stream), 4096):
+            decoder.feed(stream[position:position + 4096])
+            count += len(decoder.decode())
+        elapsed += tim.perf_counter() - start
+        frames += decoder.frames
+    return elapsed, count, {"samples": count, "frames": frames}
+
+
+def bench_capacity_counter(fixtures):
+    elapsed = 0.0
+    count = 0
+    discharged = 0.0
+    for path in fixtures.paths:
+        data = fixtures.records(path)
+        rows = list(zip(data["step"].tolist(), data["time"].tolist(), data["voltage"].tolist(), data["current"].tolist()))
+        counter = capacity_counter.capacitycounter()
+        start = tim.perf_counter()
+        for step, millis, voltage, current in rows:
+            counter.update(step, millis, voltage, current)
+        elapsed += tim.perf_counter() - start
+        count += len(rows)
+        discharged += counter.summary()["discharge_ah"]
+    return elapsed, count, {"discharge_ah": round(discharged, 4)}
+
+
+def bench_capacity_analysis(fixtures):
+    elapsed = 0.0
+    count = 0
+    capacities = {}
+    for path in fixtures.paths:
+        data = fixtures.records(path)
+        start = tim.perf_counter()
+        current = np.asarray(data["current"], dtype=np.float64)
+        charge = ocv_analysis.coulomb_count(np.asarray(data["time"]), current)
+        increments = np.diff(charge)
+        result = (float(np.sum(increments[increments > 0])), float(-np.sum(increments[increments < 0])))
+        elapsed += tim.perf_counter() - start
+        count += len(data)
+        capacities[os.path.basename(path)] = [round(value, 4) for value in result]
+    return elapsed, count, {"capacities": capacities}
+
+
+def bench_ocv_analysis(fixtures, iterations=20):
+    data = binary_log.load_csv(fixtures.simulated_ocv_log())
+    start = tim.perf_counter()
+    for i in range(iterations):
+        result = ocv_analysis.extract_ocv(data)
+    return tim.perf_counter() - start, len(data) * iterations, {"rows": len(data),
+                                                                "capacity": round(float(result["capacity"]), 4)}
+
+
+BENCHMARKS = {
+    "parse_get_data": bench_parse_get_data,
+    "control_loop": bench_control_loop,
+    "log_write_csv": bench_log_write_csv,
+    "log_write_bin": bench_log_write_bin,
+    "log_write_deadband": bench_log_write_deadband,
+    "load_csv": bench_load_csv,
+    "load_binary": bench_load_binary,
+    "binary_decode": bench_binary_decode,
+    "capacity_counter": bench_capacity_counter,
+    "capacity_analysis": bench_capacity_analysis,
+    "ocv_analysis": bench_ocv_analysis
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(names=None, paths=None, repeat=REPEAT):
+    """Run the benchmarks and return the results as dict
+
+    Keyword arguments:
+    names -- Names of the benchmarks (keys of BENCHMARKS). Defaults to all
+    paths -- Fixture logs. Defaults to the logs of DEFAULT_FIXTURES
+    repeat -- Number of runs of every benchmark
+    """
+    if(paths is None):
+        paths = sorted(path for pattern in DEFAULT_FIXTURES for path in glob.glob(pattern))
+    names = list(BENCHMARKS) if names is None else list(names)
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        fixtures = fixtureset(paths, workdir)
+        results = {
+            "version": RESULT_VERSION,
+            "time": tim.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "fixtures": fixtures.describe(),
+            "benchmarks": {}
+        }
+        for name in names:
+            times = []
+            for i in range(repeat):
+                elapsed, items, checks = BENCHMARKS[name](fixtures)
+                times.append(elapsed)
+            best = min(times)
+            results["benchmarks"][name] = {
+                "items": items,
+                "times": times,
+                "best": best,
+                "median": float(np.median(times)),
+                "items_per_second": items / best if best > 0 else None,
+                "checks": checks
+            }
+            print("%-20s %12.0f items/s  best %.3f s" % (name, results["benchmarks"][name]["items_per_second"], best))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(old, new):
+    """Print the throughput of two result files and warn about changed check values"""
+    print("%-20s %14s %14s %8s" % ("benchmark", "old items/s", "new items/s", "ratio"))
+    for name, result in new["benchmarks"].items():
+        if(name not in old["benchmarks"]):
+            continue
+        before = old["benchmarks"][name]
+        ratio = result["items_per_second"] / before["items_per_second"]
+        note = "" if before["checks"] == result["checks"] else "  (check values differ)"
+        print("%-20s %14.0f %14.0f %8.2f%s" % (name, before["items_per_second"], result["items_per_second"], ratio, note))
+
+
+if __name__ == "__main__":
+    if(len(sys.argv) == 4 and sys.argv[1] == "compare"):
+        with open(sys.argv[2]) as f_old, open(sys.argv[3]) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+    else:
+        output = sys.argv[1] if len(sys.argv) > 1 else "benchmark_" + tim.strftime("%Y%m%d-%H%M%S") + ".json"
+        results = run(sys.argv[2:] or None)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(output)
@@ -0,0 +1,155 @@
+import os
+import sys
+import glob
+import numpy as np
+import log_writer
+
+
+"""
+The Purpose of this Module is to load measurement logs into numpy arrays. Logs in the binary format written by
+log_writer.binarysink are memory mapped, so loading a file only reads the header and the columns are views into the
+mapped file without any copy. Csv logs are parsed into an array with the same record layout.
+
+The csv logs in Measurement_Data can be converted to the binary format by running this module as a script:
+
+python binary_log.py [csv files or folders]
+
+Without arguments the static_capacity_tests and OCV_Test folders of the repository are converted. The binary file is
+written next to the csv file with the extension .bin
+
+load_log() only uses the binary file if it is up to date with the csv file (not older and the same number of rows), a
+csv log that was modified or appended to afterwards (e.g. by a resumed test that only writes csv) is parsed instead.
+"""
+
+
+RECORD_DTYPE = np.dtype([
+    ("step", "<i4"),
+    ("mode", "<i4"),
+    ("time", "<u4"),
+    ("voltage", "<f4"),
+    ("current", "<f4")
+])
+
+DEFAULT_FOLDERS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data", "static_capacity_tests"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data", "OCV_Test")
+]
+
+
+def load_binary(path):
+    """Memory map a binary log and return it as a numpy record array (read only)
+
+    Keyword arguments:
+    path -- Path of the .bin file
+    """
+    with open(path, 'rb') as f:
+        header = f.read(log_writer.BINARY_HEADER.size)
+    if(len(header) != log_writer.BINARY_HEADER.size):
+        raise ValueError(path + " is not a binary log")
+    magic, version, header_size, record_size = log_writer.BINARY_HEADER.unpack(header)
+    if(magic != log_writer.BINARY_MAGIC or version != log_writer.BINARY_VERSION):
+        raise ValueError(path + " is not a binary log")
+    if(record_size != RECORD_DTYPE.itemsize):
+        raise ValueError(path + " has an unsupported record size")
+
+    #An incomplete record at the end of the file (e.g. after a crash) is ignored
+    records = (os.path.getsize(path) - header_size) // record_size
+    if(records == 0):
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=header_size, shape=(records,))
+
+
+def load_csv(path):
+    """Parse a csv log into a numpy record array
+
+    Keyword arguments:
+    path -- Path of the .csv file
+    """
+    return np.loadtxt(path, delimiter=',', skiprows=1, dtype=RECORD_DTYPE, ndmin=1)
+
+
+def csv_rows(path, block_size=1 << 20):
+    """Returns the number of rows of a csv log without parsing them"""
+    lines = 0
+    last = b"\n"
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if(last != b"\n"):
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def log_file(path):
+    """Returns the path of the file load_log() reads: the binary version of a csv log if it exists and is up to date
+    (modified after the csv file and with the same number of rows), otherwise the csv file
+
+    Keyword arguments:
+    path -- Path of the .csv or .bin file
+    """
+    root, extension = os.path.splitext(path)
+    binary_path = root + ".bin"
+    if(extension == ".bin" or not os.path.exists(path)):
+        return binary_path if os.path.exists(binary_path) else path
+    if(not os.path.exists(binary_path) or os.path.getmtime(binary_path) < os.path.getmtime(path)):
+        return path
+    try:
+        records = len(load_binary(binary_path))
+    except ValueError:
+        return path
+    return binary_path if records == csv_rows(path) else path
+
+
+def load_log(path):
+    """Load a log, preferring the binary version next to the csv file if it is up to date (see log_file)
+
+    Keyword arguments:
+    path -- Path of the .csv or .bin file
+    """
+    path = log_file(path)
+    if(os.path.splitext(path)[1] == ".bin"):
+        return load_binary(path)
+    return load_csv(path)
+
+
+def write_binary(path, data):
+    """Write a record array in the binary log format
+
+    Keyword arguments:
+    path -- Path of the .bin file, an existing file is overwritten
+    data -- Array with the fields of RECORD_DTYPE
+    """
+    header = log_writer.BINARY_HEADER.pack(log_writer.BINARY_MAGIC, log_writer.BINARY_VERSION,
+                                           log_writer.BINARY_HEADER.size, RECORD_DTYPE.itemsize)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(data, dtype=RECORD_DTYPE).tobytes())
+
+
+def convert_csv(csv_path, binary_path=None):
+    """Convert a csv log into the binary format and return the path of the binary file
+
+    Keyword arguments:
+    csv_path -- Path of the csv log
+    binary_path -- Path of the binary log. Defaults to the csv path with the extension .bin
+    """
+    if(binary_path is None):
+        binary_path = os.path.splitext(csv_path)[0] + ".bin"
+    write_binary(binary_path, load_csv(csv_path))
+    return binary_path
+
+
+def convert_folder(folder):
+    """Convert all csv logs inside a folder and return the paths of the binary files"""
+    return [convert_csv(path) for path in sorted(glob.glob(os.path.join(folder, "*.csv")))]
+
+
+if __name__ == "__main__":
+    targets = sys.argv[1:] if len(sys.argv) > 1 else DEFAULT_FOLDERS
+    for target in targets:
+        if(os.path.isdir(target)):
+            for path in convert_folder(target):
+                print(path)
+        else:
+            print(convert_csv(target))
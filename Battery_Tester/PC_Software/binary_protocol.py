@@ -0,0 +1,130 @@
+import struct
+import binascii
+import numpy as np
+
+
+"""
+The Purpose of this Module is to decode the binary framed protocol of the firmware. By default the Arduino prints every
+sample as ascii line ("mode,millis,voltage,current"). After the command
+
+B <samples per frame> <sample interval in ms>\\n
+
+it sends the samples in binary frames instead, which allows shorter sample intervals (e.g. for the edges of HPPC pulses)
+and costs less parsing time on the PC. The command A\\n switches back to ascii lines. All values are little endian:
+
+sync (2 bytes, A5 5A)
+count (uint8) -- Number of samples in the frame
+sequence (uint16) -- Frame counter of the Arduino, used to detect lost frames
+count samples of 13 bytes: mode (uint8), millis (uint32), voltage (float32, V), current (float32, A)
+crc (uint16) -- CRC-16/CCITT-FALSE of count, sequence and the samples
+
+The framedecoder collects the received bytes and decodes all complete frames at once: the frame boundaries are checked
+in a short loop over the frames, the samples of all valid frames are converted with a single numpy call. Bytes that
+don't belong to a valid frame (e.g. ascii lines sent before the switch or transmission errors) are skipped until the
+next sync.
+"""
+
+
+FRAME_SYNC = b"\xa5\x5a"
+FRAME_HEADER = struct.Struct("<2sBH")
+FRAME_CRC = struct.Struct("<H")
+MAX_SAMPLES_PER_FRAME = 8
+
+SAMPLE_DTYPE = np.dtype([
+    ("mode", "u1"),
+    ("time", "<u4"),
+    ("voltage", "<f4"),
+    ("current", "<f4")
+])
+
+
+def enable_command(samples_per_frame, sample_interval):
+    """Returns the command that switches the firmware to binary frames"""
+    if(not 1 <= samples_per_frame <= MAX_SAMPLES_PER_FRAME):
+        raise ValueError("samples_per_frame must be between 1 and " + str(MAX_SAMPLES_PER_FRAME))
+    return b"B %d %d\n" % (samples_per_frame, sample_interval)
+
+
+DISABLE_COMMAND = b"A\n"
+
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE as calculated by the firmware"""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode_frame(sequence, samples):
+    """Build a frame from a list of (mode, millis, voltage, current) tuples, e.g. for a simulated port"""
+    body = FRAME_HEADER.pack(FRAME_SYNC, len(samples), sequence & 0xFFFF)[2:]
+    body += b"".join(struct.pack("<BIff", s[0], s[1], s[2], s[3]) for s in samples)
+    return FRAME_SYNC + body + FRAME_CRC.pack(crc16(body))
+
+
+class framedecoder:
+    """
+    Decodes the binary frames of one tester. feed() adds received bytes, decode() returns the samples of all complete frames
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.lost_frames = 0
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+        self._buffer = bytearray()
+        self._sequence = None
+
+    def feed(self, data):
+        self._buffer += data
+
+    def decode(self):
+        """Returns a numpy array with SAMPLE_DTYPE containing the samples of all complete frames in the buffer"""
+        buf = self._buffer
+        payloads = []
+        position = 0
+        while True:
+            start = buf.find(FRAME_SYNC, position)
+            if(start < 0):
+                #Keep a last byte that could be the start of the next sync
+                keep = len(buf) - 1 if buf[-1:] == FRAME_SYNC[:1] else len(buf)
+                self.skipped_bytes += keep - position
+                position = keep
+                break
+            self.skipped_bytes += start - position
+            if(len(buf) - start < FRAME_HEADER.size):
+                position = start
+                break
+            _, count, sequence = FRAME_HEADER.unpack_from(buf, start)
+            end = start + FRAME_HEADER.size + count * SAMPLE_DTYPE.itemsize
+            if(count == 0 or count > MAX_SAMPLES_PER_FRAME):
+                self.skipped_bytes += 1
+                position = start + 1
+                continue
+            if(len(buf) < end + FRAME_CRC.size):
+                position = start
+                break
+            if(FRAME_CRC.unpack_from(buf, end)[0] != crc16(bytes(buf[start + 2:end]))):
+                #A sync pattern inside the data of a broken frame is found by the next search
+                self.crc_errors += 1
+                self.skipped_bytes += 1
+                position = start + 1
+                continue
+
+            if(self._sequence is not None):
+                gap = (sequence - self._sequence - 1) & 0xFFFF
+                if(gap < 0x8000):
+                    self.lost_frames += gap
+            self._sequence = sequence
+            self.frames += 1
+            payloads.append(bytes(buf[start + FRAME_HEADER.size:end]))
+            position = end + FRAME_CRC.size
+
+        del buf[:position]
+        if(not payloads):
+            return np.zeros(0, dtype=SAMPLE_DTYPE)
+        return np.frombuffer(b"".join(payloads), dtype=SAMPLE_DTYPE)
+
+
+def format_lines(samples):
+    """Returns the samples as ascii lines like the firmware prints them, e.g. for the csv log"""
+    return [b"%d,%d,%.4f,%.4f\r\n" % s for s in zip(samples["mode"].tolist(), samples["time"].tolist(),
+                                                      samples["voltage"].tolist(), samples["current"].tolist())]
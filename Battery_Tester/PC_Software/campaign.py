@@ -0,0 +1,313 @@
+import time as tim
+import channel_manager
+import capacity_counter
+from schedule_engine import schedulerunner
+
+
+"""
+The Purpose of this Module is to run a whole test matrix, e.g. capacity tests of several cells at several C-rates with
+repetitions like the static_test_* files of Measurement_Data, on all available tester channels. Every entry of the matrix
+is a job (cell, C-rate, repetition) with its own schedule and logfile.
+
+Whenever a channel is free, the campaign starts the first job of the list that can run on it:
+
+- the cell of the job is connected to the channel (every channel accepts every cell if no cells are given)
+- the cell isn't tested on another channel
+- the rest time of the cell after its last job is over
+
+The rest between two jobs of a cell is a timed state of the cell instead of a sleep, so other channels keep working and a
+channel can test another cell while the first one is resting. Jobs start in the order they were added. With
+order="longest" they are sorted by their estimated duration (longest first) instead, which keeps the makespan short if
+there are more jobs than channels.
+
+At the end report() returns the makespan of the campaign, the busy time and utilisation of every channel and the start and
+end time of every job.
+
+Example:
+
+jobs = campaign.capacity_jobs([2, 3], [0.5, 1, 1.5], 2, 1.5, capacity_test, "./static_test_")
+c = campaign.campaign(rest=1200)
+c.add_channel("COM6", channel_manager.open_port("COM6"))
+c.add_channel("COM7", channel_manager.open_port("COM7"))
+for j in jobs:
+    c.add_job(j)
+c.run()
+campaign.print_report(c.report())
+"""
+
+
+def c_rate_name(c_rate):
+    """Returns the C-rate as used in the logfile names of Measurement_Data, e.g. 0.5 -> 0c5, 1 -> 1c, 1.25 -> 1c25"""
+    integer, _, fraction = ("%g" % c_rate).partition(".")
+    return integer + "c" + fraction
+
+
+class job:
+    """
+    One test of the campaign
+    """
+
+    def __init__(self, cell, c_rate, repetition, steps, logfile, estimate=0.0):
+        """
+        Keyword arguments:
+        cell -- Name or number of the cell
+        c_rate -- C-rate of the test
+        repetition -- Number of the repetition
+        steps -- List of schedule_engine steps
+        logfile -- Path of the csv logfile
+        estimate -- Estimated duration in seconds, used to start long jobs first (see campaign order)
+        """
+        self.cell = cell
+        self.c_rate = c_rate
+        self.repetition = repetition
+        self.steps = steps
+        self.logfile = logfile
+        self.estimate = estimate
+
+        self.channel = None
+        self.start_time = None
+        self.end_time = None
+        self.finished = False
+        self.error = None
+        self.summary = None
+
+    def name(self):
+        return c_rate_name(self.c_rate) + "-" + str(self.cell) + "-" + str(self.repetition)
+
+
+def capacity_jobs(cells, c_rates, repetitions, capacity, make_steps, prefix="./static_test_"):
+    """Returns the jobs of a test matrix. The logfiles are named like the files in Measurement_Data (prefix + 1c5-2-1.csv)
+
+    Keyword arguments:
+    cells -- List of cell names or numbers
+    c_rates -- List of discharge C-rates
+    repetitions -- Number of repetitions of every C-rate and cell
+    capacity -- Nominal cell capacity in Ah
+    make_steps -- Function that takes the discharge current (negative) and returns the steps of one test
+    prefix -- Path and start of the logfile names
+    """
+    jobs = []
+    for repetition in range(1, repetitions + 1):
+        for cell in cells:
+            for c_rate in c_rates:
+                steps = make_steps(-c_rate * capacity)
+                logfile = prefix + c_rate_name(c_rate) + "-" + str(cell) + "-" + str(repetition) + ".csv"
+                jobs.append(job(cell, c_rate, repetition, steps, logfile, estimate=3600 / c_rate))
+    return jobs
+
+
+class _slot:
+    """A tester channel of the campaign"""
+
+    def __init__(self, name, comport, cells):
+        self.name = name
+        self.comport = comport
+        self.cells = None if cells is None else set(cells)
+        self.job = None
+        self.channel = None
+        self.counter = None
+        self.busy_time = 0.0
+        self.disabled = False
+
+    def accepts(self, cell):
+        return not self.disabled and (self.cells is None or cell in self.cells)
+
+
+class campaign:
+    """
+    Assigns the jobs of a test matrix to free channels and runs them
+    """
+
+    def __init__(self, rest=1200, formats=("csv",), echo_interval=None, clock=None, summary=True, poll_interval=0.5,
+                 order="submitted"):
+        """
+        Keyword arguments:
+        rest -- Rest time of a cell between two of its jobs in seconds
+        formats -- Log formats passed to log_writer.open_log()
+        echo_interval -- Print a sample of every channel at most every echo_interval seconds. None disables the printing
+        clock -- Function without arguments returning a new clock for the tester of every job (e.g. hppc_tester.deviceclock).
+                 Defaults to the PC time
+        summary -- Write a capacity_counter summary file next to every logfile
+        poll_interval -- Time in seconds between two checks of the channels
+        order -- "submitted" starts the jobs in the order of add_job(), "longest" starts the jobs with the longest
+                 estimate first
+        """
+        if(order not in ("submitted", "longest")):
+            raise ValueError("Unknown job order " + str(order))
+        self.rest = rest
+        self.formats = formats
+        self.echo_interval = echo_interval
+        self.clock = clock
+        self.summary = summary
+        self.poll_interval = poll_interval
+        self.order = order
+
+        self.slots = []
+        self.jobs = []
+        self.start_time = None
+        self.end_time = None
+        self._ready_time = {}
+        self._busy_cells = set()
+
+    def add_channel(self, name, comport, cells=None):
+        """Add a tester channel. cells is a list of the cells connected to it, None accepts every cell"""
+        self.slots.append(_slot(name, comport, cells))
+
+    def add_job(self, new_job):
+        self.jobs.append(new_job)
+
+    def _pending(self):
+        return [j for j in self.jobs if j.start_time is None]
+
+    def _start(self, slot, next_job, now):
+        observers = []
+        slot.counter = None
+        if(self.summary):
+            slot.counter = capacity_counter.capacitycounter(next_job.logfile.replace(".csv", "_summary.csv"))
+            observers.append(slot.counter)
+        slot.channel = channel_manager.channel(next_job.name(), slot.comport, schedulerunner(next_job.steps),
+                                               next_job.logfile, self.formats, self.echo_interval,
+                                               clock=None if self.clock is None else self.clock(), observers=observers)
+        slot.job = next_job
+        next_job.channel = slot.name
+        next_job.start_time = now
+        self._busy_cells.add(next_job.cell)
+        print("start " + next_job.name() + " on " + str(slot.name))
+        slot.channel.start()
+
+    def _collect(self, slot, now):
+        """Finish the job of a slot whose acquisition thread has ended"""
+        slot.channel.join()
+        finished_job = slot.job
+        finished_job.end_time = now
+        finished_job.finished = slot.channel.finished
+        finished_job.error = slot.channel.error
+        if(slot.counter is not None):
+            slot.counter.close()
+            finished_job.summary = slot.counter.summary()
+        slot.busy_time += now - finished_job.start_time
+        if(finished_job.error is not None):
+            #A channel with a broken COM port doesn't get new jobs
+            slot.disabled = True
+            print("error on " + str(slot.name) + ": " + repr(finished_job.error))
+        print("end " + finished_job.name() + " on " + str(slot.name))
+
+        self._busy_cells.discard(finished_job.cell)
+        self._ready_time[finished_job.cell] = now + self.rest
+        slot.job = None
+        slot.channel = None
+        slot.counter = None
+
+    def _next_job(self, slot, now):
+        """Returns the next job that can be started on the slot or None"""
+        for candidate in self._pending():
+            if(not slot.accepts(candidate.cell) or candidate.cell in self._busy_cells):
+                continue
+            if(now < self._ready_time.get(candidate.cell, 0.0)):
+                continue
+            return candidate
+        return None
+
+    def step(self):
+        """Collect finished jobs and start new ones. Returns False if all jobs are done"""
+        now = tim.time()
+        for slot in self.slots:
+            if(slot.channel is not None and not slot.channel._thread.is_alive()):
+                self._collect(slot, now)
+        for slot in self.slots:
+            if(slot.channel is None and not slot.disabled):
+                next_job = self._next_job(slot, now)
+                if(next_job is not None):
+                    self._start(slot, next_job, now)
+
+        running = any(slot.channel is not None for slot in self.slots)
+        if(not running):
+            #Jobs whose cell can't be tested on any working channel are never started
+            startable = [j for j in self._pending() if any(slot.accepts(j.cell) for slot in self.slots)]
+            return len(startable) > 0
+        return True
+
+    def run(self, status_interval=60.0):
+        """Run all jobs and block until they are done. Ctrl+C stops all channels
+
+        Keyword arguments:
+        status_interval -- Time in seconds between status prints. None disables the status prints
+        """
+        for j in self.jobs:
+            if(not any(slot.cells is None or j.cell in slot.cells for slot in self.slots)):
+                raise ValueError("No channel for cell " + str(j.cell))
+        if(self.order == "longest"):
+            self.jobs.sort(key=lambda j: j.estimate, reverse=True)
+
+        self.start_time = tim.time()
+        last_status = self.start_time
+        try:
+            while self.step():
+                tim.sleep(self.poll_interval)
+                if(status_interval is not None and (tim.time() - last_status) >= status_interval):
+                    last_status = tim.time()
+                    for s in self.status():
+                        print(s)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for slot in self.slots:
+                if(slot.channel is not None):
+                    slot.channel.stop()
+            now = tim.time()
+            for slot in self.slots:
+                if(slot.channel is not None):
+                    self._collect(slot, now)
+            self.end_time = now
+
+    def status(self):
+        """Returns a list with the status of every channel"""
+        result = []
+        for slot in self.slots:
+            if(slot.channel is not None):
+                result.append(slot.channel.status())
+            else:
+                result.append({"name": slot.name, "running": False, "disabled": slot.disabled})
+        return result
+
+    def report(self):
+        """Returns a dict with the makespan, the utilisation of every channel and the times of every job"""
+        end_time = tim.time() if self.end_time is None else self.end_time
+        makespan = 0.0 if self.start_time is None else end_time - self.start_time
+        channels = []
+        for slot in self.slots:
+            channels.append({
+                "name": slot.name,
+                "jobs": sum(1 for j in self.jobs if j.channel == slot.name),
+                "busy_time": slot.busy_time,
+                "utilisation": slot.busy_time / makespan if makespan > 0 else 0.0
+            })
+        jobs = []
+        for j in self.jobs:
+            jobs.append({
+                "name": j.name(),
+                "channel": j.channel,
+                "start": None if j.start_time is None else j.start_time - self.start_time,
+                "end": None if j.end_time is None else j.end_time - self.start_time,
+                "finished": j.finished,
+                "error": None if j.error is None else repr(j.error)
+            })
+        busy = sum(c["busy_time"] for c in channels)
+        return {
+            "makespan": makespan,
+            "utilisation": busy / (makespan * len(channels)) if makespan > 0 and channels else 0.0,
+            "channels": channels,
+            "jobs": jobs
+        }
+
+
+def print_report(report):
+    print("makespan: %.0f s, utilisation: %.1f %%" % (report["makespan"], report["utilisation"] * 100))
+    for c in report["channels"]:
+        print("%s: %d jobs, busy %.0f s, utilisation %.1f %%" % (c["name"], c["jobs"], c["busy_time"], c["utilisation"] * 100))
+    for j in report["jobs"]:
+        if(j["start"] is None):
+            print("%s: not started" % j["name"])
+        else:
+            print("%s: %s %.0f s - %.0f s%s" % (j["name"], j["channel"], j["start"], j["end"],
+                                                  "" if j["finished"] else " (not finished)"))
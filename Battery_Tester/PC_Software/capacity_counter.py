@@ -0,0 +1,173 @@
+import os
+
+
+"""
+The Purpose of this Module is to calculate capacity, energy and efficiencies while a test is running instead of
+integrating the whole logfile afterwards. The capacitycounter is updated with every sample of the tester and integrates
+current and power with the trapezoidal rule over the time_millis difference of two samples. Only the totals of the
+test and the subtotals of the current step are kept, so the memory doesn't grow with the duration of the test.
+
+When the step (instruction pointer) changes, the subtotals of the finished step are written as a row into the summary
+file (if given) and stored in last_step. Current and power are counted as charge if the current is positive and as
+discharge if it is negative.
+"""
+
+
+SUMMARY_HEADER = "step,start_time,duration,charge_ah,discharge_ah,charge_wh,discharge_wh,start_voltage,end_voltage\n"
+
+
+class _totals:
+    def __init__(self, step=0, start_time=0, start_voltage=0.0):
+        self.step = step
+        self.start_time = start_time
+        self.end_time = start_time
+        self.start_voltage = start_voltage
+        self.end_voltage = start_voltage
+        self.charge_ah = 0.0
+        self.discharge_ah = 0.0
+        self.charge_wh = 0.0
+        self.discharge_wh = 0.0
+
+    def as_dict(self):
+        return {
+            "step": self.step,
+            "start_time": self.start_time,
+            "duration": (self.end_time - self.start_time) / 1000,
+            "charge_ah": self.charge_ah,
+            "discharge_ah": self.discharge_ah,
+            "charge_wh": self.charge_wh,
+            "discharge_wh": self.discharge_wh,
+            "start_voltage": self.start_voltage,
+            "end_voltage": self.end_voltage
+        }
+
+
+class capacitycounter:
+    """
+    Online capacity and energy accumulator for one tester
+    """
+
+    def __init__(self, summary_path=None, max_gap=10.0):
+        """
+        Keyword arguments:
+        summary_path -- Path of the csv file the step summaries are appended to. None disables the file
+        max_gap -- Samples more than max_gap seconds apart (e.g. after a reset of the Arduino) are not integrated
+        """
+        self.summary_path = summary_path
+        self.max_gap = max_gap * 1000
+        self.total = None
+        self.current_step = None
+        self.last_step = None
+        self._last_time = None
+        self._last_current = 0.0
+        self._last_power = 0.0
+        self._summary_file = None
+        if(summary_path is not None):
+            new_file = not os.path.exists(summary_path) or os.path.getsize(summary_path) == 0
+            self._summary_file = open(summary_path, 'a')
+            if(new_file):
+                self._summary_file.write(SUMMARY_HEADER)
+                self._summary_file.flush()
+
+    def update(self, step, time_millis, voltage, current):
+        """Add a sample of the tester
+
+        Keyword arguments:
+        step -- Instruction pointer the sample is logged with
+        time_millis -- Time of the sample in milliseconds (tester.time_millis)
+        voltage -- Cell voltage in V
+        current -- Cell current in A
+        """
+        power = voltage * current
+        if(self.total is None):
+            self.total = _totals(step, time_millis, voltage)
+            self.current_step = _totals(step, time_millis, voltage)
+        elif(step != self.current_step.step):
+            self._end_step()
+            self.current_step = _totals(step, time_millis, voltage)
+
+        if(self._last_time is not None):
+            dt = time_millis - self._last_time
+            if(0 < dt <= self.max_gap):
+                ah = (current + self._last_current) * dt / 7200000
+                wh = (power + self._last_power) * dt / 7200000
+                for t in (self.total, self.current_step):
+                    if(ah >= 0):
+                        t.charge_ah += ah
+                        t.charge_wh += wh
+                    else:
+                        t.discharge_ah -= ah
+                        t.discharge_wh -= wh
+
+        for t in (self.total, self.current_step):
+            t.end_time = time_millis
+            t.end_voltage = voltage
+        self._last_time = time_millis
+        self._last_current = current
+        self._last_power = power
+
+    def observe(self, step, sample):
+        """Add a sample as returned by tester.read_sample()"""
+        self.update(step, sample[1], sample[2], sample[3])
+
+    def state(self):
+        """Returns the totals and the subtotals of the running step as dict (see checkpoint.py)"""
+        return {
+            "total": None if self.total is None else dict(self.total.__dict__),
+            "current_step": None if self.current_step is None else dict(self.current_step.__dict__),
+            "last_time": self._last_time,
+            "last_current": self._last_current,
+            "last_power": self._last_power
+        }
+
+    def restore(self, state):
+        """Continue counting from a state returned by state()"""
+        self.total = None
+        self.current_step = None
+        if(state["total"] is not None):
+            self.total = _totals()
+            self.total.__dict__.update(state["total"])
+        if(state["current_step"] is not None):
+            self.current_step = _totals()
+            self.current_step.__dict__.update(state["current_step"])
+        self._last_time = state["last_time"]
+        self._last_current = state["last_current"]
+        self._last_power = state["last_power"]
+
+    def _end_step(self):
+        self.last_step = self.current_step.as_dict()
+        if(self._summary_file is not None):
+            s = self.last_step
+            self._summary_file.write("%d,%d,%.1f,%.6f,%.6f,%.6f,%.6f,%.4f,%.4f\n" % (
+                s["step"], s["start_time"], s["duration"], s["charge_ah"], s["discharge_ah"],
+                s["charge_wh"], s["discharge_wh"], s["start_voltage"], s["end_voltage"]))
+            self._summary_file.flush()
+
+    def step_summary(self):
+        """Returns the subtotals of the running step as dict"""
+        return None if self.current_step is None else self.current_step.as_dict()
+
+    def summary(self):
+        """Returns the totals of the test as dict including coulombic and energy efficiency (discharge / charge)"""
+        if(self.total is None):
+            return None
+        s = self.total.as_dict()
+        s["coulombic_efficiency"] = s["discharge_ah"] / s["charge_ah"] if s["charge_ah"] > 0 else float("nan")
+        s["energy_efficiency"] = s["discharge_wh"] / s["charge_wh"] if s["charge_wh"] > 0 else float("nan")
+        return s
+
+    def close(self):
+        """Write the summary of the running step and close the summary file"""
+        if(self.current_step is not None and self.current_step.end_time > self.current_step.start_time):
+            self._end_step()
+            self.current_step = _totals(self.current_step.step, self.current_step.end_time, self.current_step.end_voltage)
+        if(self._summary_file is not None):
+            self._summary_file.close()
+            self._summary_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,324 @@
+import os
+import sys
+import glob
+import numpy as np
+import binary_log
+import hppc_tester
+import fake_serial
+import analysis_cache
+
+
+"""
+The Purpose of this Module is to simulate the terminal voltage of a cell with a Thevenin equivalent circuit
+
+V = OCV(SoC) + I * R0(SoC) + sum of the voltages of n RC elements (R_i(SoC), tau_i)
+
+for many current profiles or parameter sets at once. All arrays have a batch axis in front of the time axis, so one call
+of simulate() calculates e.g. thousands of parameter sets for the parameter fit. The SoC is calculated by coulomb counting
+(cumsum) and the RC voltages with the exact solution for piecewise constant current:
+
+v[k] = a[k] * v[k-1] + (1 - a[k]) * R * I[k] with a[k] = exp(-dt[k] / tau)
+
+This recursion is solved in blocks of samples with a cumulative sum (see rc_response), so the python loop runs over blocks
+instead of samples and the sample time may vary like the time column of the logs.
+
+The parameters can be constants or tables over the SoC, e.g. from the pulses of an HPPC test (from_hppc) and the OCV
+curve of ocv_analysis (ocv_table). fit() adjusts parameters to a measured log with a Levenberg-Marquardt algorithm, the
+Jacobian and the candidate steps are calculated as batches. validate() compares the model with the discharge of logs
+like the static_test_* files. Usage as a script:
+
+python cell_model.py [reference log] [logs...]
+
+fits R0, R1, tau and the capacity to the discharge of the reference log (default static_test_0c5-2-1) and prints the
+RMSE for the discharge of every static_test_* file.
+"""
+
+
+DEFAULT_OCV_SOC = np.linspace(0, 1, len(fake_serial.DEFAULT_OCV_TABLE))
+DEFAULT_OCV = np.array(fake_serial.DEFAULT_OCV_TABLE)
+DEFAULT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data",
+                              "static_capacity_tests")
+DEFAULT_REFERENCE = "static_test_0c5-2-1.csv"
+
+
+class cellparameters:
+    """
+    Parameters of the equivalent circuit. Every parameter may have a leading batch axis
+
+    Without soc_grid: capacity (B), r0 (B), r_rc (B, n), tau (B, n)
+    With soc_grid (K values): r0 (B, K) and r_rc (B, n, K) are tables over the SoC, capacity and tau are constant
+    """
+
+    def __init__(self, capacity=1.5, r0=0.06, r_rc=(0.04,), tau=(40.0,), ocv_soc=DEFAULT_OCV_SOC, ocv=DEFAULT_OCV,
+                 soc_grid=None):
+        """
+        Keyword arguments:
+        capacity -- Capacity in Ah
+        r0 -- Series resistance in Ohm
+        r_rc -- Resistances of the RC elements in Ohm
+        tau -- Time constants of the RC elements in s
+        ocv_soc -- SoC values of the OCV table (ascending)
+        ocv -- OCV in V for ocv_soc
+        soc_grid -- Optional SoC values (ascending) of the r0 and r_rc tables
+        """
+        self.capacity = np.asarray(capacity, dtype=np.float64)
+        self.r0 = np.asarray(r0, dtype=np.float64)
+        self.r_rc = np.asarray(r_rc, dtype=np.float64)
+        self.tau = np.asarray(tau, dtype=np.float64)
+        self.ocv_soc = np.asarray(ocv_soc, dtype=np.float64)
+        self.ocv = np.asarray(ocv, dtype=np.float64)
+        self.soc_grid = None if soc_grid is None else np.asarray(soc_grid, dtype=np.float64)
+
+    def copy(self, **changes):
+        """Returns a copy with some parameters replaced, e.g. p.copy(r0=np.linspace(0.05, 0.08, 1000))"""
+        values = {"capacity": self.capacity, "r0": self.r0, "r_rc": self.r_rc, "tau": self.tau, "ocv_soc": self.ocv_soc,
+                  "ocv": self.ocv, "soc_grid": self.soc_grid}
+        values.update(changes)
+        return cellparameters(**values)
+
+    def batch_shape(self):
+        table = 0 if self.soc_grid is None else 1
+        return np.broadcast_shapes(self.capacity.shape, self.r0.shape[:self.r0.ndim - table],
+                                   self.r_rc.shape[:self.r_rc.ndim - 1 - table], self.tau.shape[:-1])
+
+    def arrays(self, batch):
+        """Returns capacity (B), r0 (B, K), r_rc (B, n, K) and tau (B, n) for a batch size B, K is 1 without soc_grid"""
+        n = self.tau.shape[-1]
+        if(self.soc_grid is None):
+            k = 1
+            r0 = self.r0[..., None]
+            r_rc = self.r_rc[..., None]
+        else:
+            k = len(self.soc_grid)
+            r0 = self.r0
+            r_rc = self.r_rc
+        return (np.broadcast_to(self.capacity, (batch,)), np.broadcast_to(r0, (batch, k)),
+                np.broadcast_to(r_rc, (batch, n, k)), np.broadcast_to(self.tau, (batch, n)))
+
+
+def ocv_table(result):
+    """Returns the (soc, ocv) table of an ocv_analysis result. The OCV is the mean of the charge and discharge curve"""
+    soc = result["soc"]
+    ocv = np.nanmean(np.vstack((result["ocv_discharge"], result["ocv_charge"])), axis=0)
+    valid = np.isfinite(ocv)
+    return soc[valid], ocv[valid]
+
+
+def from_hppc(pulses, ocv_soc, ocv, capacity, discharge=True):
+    """Build SoC dependent parameters with one RC element from the pulse parameters of hppc_analysis.analyse()
+
+    Keyword arguments:
+    pulses -- Array with hppc_analysis.PARAMETER_DTYPE
+    ocv_soc, ocv -- OCV table, e.g. from ocv_table()
+    capacity -- Capacity in Ah
+    discharge -- Use the discharge pulses (True) or the charge pulses (False)
+    """
+    selected = pulses[(pulses["current"] < 0) == discharge]
+    selected = selected[np.isfinite(selected["r0"]) & np.isfinite(selected["r1"])]
+    selected = np.sort(selected, order="soc")
+    if(len(selected) == 0):
+        raise ValueError("No pulses for the parameter tables")
+    return cellparameters(capacity, selected["r0"], selected["r1"][None, :], [float(np.median(selected["tau"]))],
+                          ocv_soc, ocv, soc_grid=selected["soc"])
+
+
+def _at_soc(table, soc_grid, soc):
+    """Interpolate tables (B, ..., K) at the SoC (B, T). Returns (B, ..., T) or (B, ..., 1) for constant tables"""
+    k = table.shape[-1]
+    if(k == 1):
+        return table
+    position = np.interp(soc, soc_grid, np.arange(k, dtype=np.float64))
+    index = np.minimum(position.astype(np.intp), k - 2)
+    fraction = position - index
+    extra = table.ndim - 2
+    index = index.reshape(index.shape[:1] + (1,) * extra + index.shape[1:])
+    fraction = fraction.reshape(index.shape)
+    low = np.take_along_axis(table, index, axis=-1)
+    high = np.take_along_axis(table, index + 1, axis=-1)
+    return low + fraction * (high - low)
+
+
+def rc_response(time, inputs, tau, block_time=20.0):
+    """Solve v[k] = exp(-dt[k] / tau) * v[k-1] + inputs[k] for all batches, starting with v = 0
+
+    Keyword arguments:
+    time -- Sample times in s (T)
+    inputs -- Input of every sample (B, T)
+    tau -- Time constant of every batch in s (B)
+    block_time -- Length of a block in units of the smallest tau. exp(block_time) must fit into a float64 with enough precision
+    """
+    batch, samples = inputs.shape
+    output = np.empty((batch, samples))
+    if(samples == 0):
+        return output
+    max_dt = max(float(np.max(np.diff(time))) if samples > 1 else 1.0, 1e-9)
+    block = max(int(block_time * float(np.min(tau)) / max_dt), 1)
+    state = np.zeros(batch)
+    previous_time = time[0]
+    for start in range(0, samples, block):
+        end = min(start + block, samples)
+        block_time_axis = time[start:end]
+        growth = np.exp((block_time_axis - block_time_axis[0])[None, :] / tau[:, None])
+        total = np.cumsum(inputs[:, start:end] * growth, axis=1)
+        decay = np.exp(-(block_time_axis - previous_time)[None, :] / tau[:, None])
+        output[:, start:end] = decay * state[:, None] + total / growth
+        state = output[:, end - 1]
+        previous_time = block_time_axis[-1]
+    return output
+
+
+def simulate(params, time, current, soc0=1.0):
+    """Simulate the terminal voltage for a batch of current profiles and/or parameter sets
+
+    Keyword arguments:
+    params -- cellparameters, parameters with a batch axis simulate one parameter set per batch
+    time -- Sample times in s (T), shared by all batches
+    current -- Current in A (charge positive), either (T) or (B, T)
+    soc0 -- SoC at the first sample, scalar or (B)
+
+    Returns the voltage (B, T) and the SoC (B, T)
+    """
+    time = np.asarray(time, dtype=np.float64)
+    current = np.atleast_2d(np.asarray(current, dtype=np.float64))
+    batch = int(np.prod(np.broadcast_shapes(params.batch_shape(), current.shape[:1], np.shape(soc0))))
+    current = np.broadcast_to(current, (batch, len(time)))
+    capacity, r0, r_rc, tau = params.arrays(batch)
+
+    dt = np.diff(time)
+    charge = np.zeros((batch, len(time)))
+    np.cumsum((current[:, 1:] + current[:, :-1]) * dt / 7200, axis=1, out=charge[:, 1:])
+    soc = np.reshape(soc0, (-1, 1)) + charge / capacity[:, None]
+
+    voltage = np.interp(soc, params.ocv_soc, params.ocv) + _at_soc(r0, params.soc_grid, soc) * current
+    if(tau.shape[1] > 0):
+        resistance = _at_soc(r_rc, params.soc_grid, soc)
+        dt_samples = np.concatenate(([0.0], dt))
+        for i in range(tau.shape[1]):
+            gain = 1 - np.exp(-dt_samples[None, :] / tau[:, i, None])
+            voltage += rc_response(time, gain * resistance[:, i] * current, tau[:, i])
+    return voltage, soc
+
+
+def load_discharge(path):
+    """Returns time (s, starting at 0), current and voltage of the first regulated discharge (CCR, negative current) of a log"""
+    data = binary_log.load_log(path)
+    discharge = (np.asarray(data["mode"]) == int(hppc_tester.operatingmodes["CCR"])) & (np.asarray(data["current"]) < 0)
+    indices = np.flatnonzero(discharge)
+    if(len(indices) == 0):
+        raise ValueError(path + " doesn't contain a discharge")
+    gaps = np.flatnonzero(np.diff(indices) != 1)
+    end = indices[gaps[0]] + 1 if len(gaps) else indices[-1] + 1
+    selected = slice(indices[0], end)
+    time = np.asarray(data["time"][selected], dtype=np.float64) / 1000
+    return (time - time[0], np.asarray(data["current"][selected], dtype=np.float64),
+            np.asarray(data["voltage"][selected], dtype=np.float64))
+
+
+FIT_NAMES = ("r0", "r_rc", "tau", "capacity")
+
+
+def _set_batch(params, names, theta):
+    """Returns parameters with a batch axis for every row of theta (log values of the fitted parameters)"""
+    changes = {}
+    position = 0
+    for name in names:
+        base = getattr(params, name)
+        size = base.size
+        values = np.exp(theta[:, position:position + size]).reshape((len(theta),) + base.shape)
+        changes[name] = values
+        position += size
+    return params.copy(**changes)
+
+
+def fit(params, time, current, voltage, soc0=1.0, names=FIT_NAMES, iterations=50, tolerance=1e-8):
+    """Fit parameters to a measured voltage with the Levenberg-Marquardt algorithm (parameters are fitted as logarithm)
+
+    Keyword arguments:
+    params -- Start values (cellparameters without batch axis)
+    time, current, voltage -- Measured profile (T)
+    soc0 -- SoC at the first sample
+    names -- Names of the fitted attributes of cellparameters
+    iterations -- Maximum number of iterations
+    tolerance -- The fit ends if the relative improvement of the squared error is smaller
+
+    Returns the fitted cellparameters and the RMSE
+    """
+    theta = np.concatenate([np.log(getattr(params, name)).ravel() for name in names])
+    count = len(theta)
+    step = 1e-4
+    damping = 1e-3
+    candidates = np.array([0.1, 1.0, 10.0, 100.0])
+
+    simulated, _ = simulate(_set_batch(params, names, theta[None, :]), time, current, soc0)
+    cost = float(np.sum((simulated[0] - voltage) ** 2))
+    for iteration in range(iterations):
+        #Jacobian by forward differences, all parameter sets in one batch
+        batch = theta[None, :] + np.vstack((np.zeros(count), np.eye(count) * step))
+        simulated, _ = simulate(_set_batch(params, names, batch), time, current, soc0)
+        residual = simulated[0] - voltage
+        jacobian = (simulated[1:] - simulated[0]) / step
+        normal = jacobian @ jacobian.T
+        gradient = jacobian @ residual
+        diagonal = np.diag(np.diag(normal) + 1e-12)
+
+        #Try several damping factors at once
+        steps = np.array([-np.linalg.solve(normal + damping * c * diagonal, gradient) for c in candidates])
+        trial, _ = simulate(_set_batch(params, names, theta[None, :] + steps), time, current, soc0)
+        costs = np.sum((trial - voltage[None, :]) ** 2, axis=1)
+        best = int(np.argmin(costs))
+        if(costs[best] >= cost):
+            damping *= 1000
+            if(damping > 1e10):
+                break
+            continue
+        improvement = (cost - costs[best]) / cost
+        theta = theta + steps[best]
+        cost = float(costs[best])
+        damping = max(damping * candidates[best] / 10, 1e-9)
+        if(improvement < tolerance):
+            break
+
+    fitted = _set_batch(params, names, theta[None, :])
+    changes = {name: getattr(fitted, name)[0] for name in names}
+    return params.copy(**changes), np.sqrt(cost / len(voltage))
+
+
+def validate(params, paths, cutoff_voltage=1.5, cache=None):
+    """Simulate the discharge of every log with its measured current. The discharges are loaded through the optional
+    analysis_cache.analysiscache
+
+    Returns a list of dicts with the file, the mean discharge current, the RMSE of the voltage, the measured capacity
+    and the simulated capacity until the cutoff voltage or the end of the OCV table (the last current is continued after the end of the log)
+    """
+    results = []
+    for path in paths:
+        time, current, voltage = load_discharge(path) if cache is None else cache.call(load_discharge, path)
+        #Continue the last current after the end of the measurement, so the simulation can reach the cutoff later
+        samples = len(time)
+        interval = (time[-1] - time[0]) / max(samples - 1, 1)
+        extended_time = np.concatenate((time, time[-1] + interval * np.arange(1, samples // 2 + 1)))
+        extended_current = np.concatenate((current, np.full(samples // 2, current[-1])))
+        simulated, soc = simulate(params, extended_time, extended_current)
+        below = np.flatnonzero((simulated[0] < cutoff_voltage) | (soc[0] <= params.ocv_soc[0]))
+        end = below[0] if len(below) else len(extended_time) - 1
+        results.append({
+            "file": os.path.basename(path),
+            "current": float(np.mean(current)),
+            "rmse": float(np.sqrt(np.mean((simulated[0, :samples] - voltage) ** 2))),
+            "capacity": float((soc[0, 0] - soc[0, samples - 1]) * params.capacity),
+            "simulated_capacity": float((soc[0, 0] - soc[0, end]) * params.capacity)
+        })
+    return results
+
+
+if __name__ == "__main__":
+    reference = sys.argv[1] if len(sys.argv) > 1 else os.path.join(DEFAULT_FOLDER, DEFAULT_REFERENCE)
+    paths = sys.argv[2:] if len(sys.argv) > 2 else sorted(glob.glob(os.path.join(DEFAULT_FOLDER, "static_test_*.csv")))
+
+    cache = analysis_cache.analysiscache()
+    params, rmse = fit(cellparameters(), *cache.call(load_discharge, reference))
+    print("fit %s: rmse %.4f V, capacity %.4f Ah, r0 %.4f Ohm, r1 %s Ohm, tau %s s" % (
+        os.path.basename(reference), rmse, params.capacity, params.r0, params.r_rc, params.tau))
+    print("file,current,rmse,capacity,simulated_capacity")
+    for r in validate(params, paths, cache=cache):
+        print("%s,%.3f,%.4f,%.4f,%.4f" % (r["file"], r["current"], r["rmse"], r["capacity"], r["simulated_capacity"]))
@@ -0,0 +1,237 @@
+import threading
+import time as tim
+import serial as Serial
+import hppc_tester
+import log_writer
+
+
+"""
+The Purpose of this Module is to run multiple battery testers from a single python process. Every tester is connected
+to its own COM port and is handled by a channel. Each channel has its own test schedule and logfile and runs its
+acquisition loop in a separate thread, so a slow or stalled COM port only blocks its own channel while all other
+channels keep sampling. A thread per channel is used instead of a selector based event loop because pyserial can't
+wait on COM ports with select() on Windows.
+
+The schedule of a channel is an object with the following interface:
+
+update(tester) -- Called after every sample. Starts the next operation of the tester if necessary and returns False
+                  when the test is finished
+step -- Current instruction pointer, which is written into the step column of the log
+
+schedule_engine.schedulerunner implements this interface.
+
+Example:
+
+manager = channel_manager.manager()
+manager.add_channel("cell1", channel_manager.open_port("COM6"), schedule1, "./cell1.csv")
+manager.add_channel("cell2", channel_manager.open_port("COM7"), schedule2, "./cell2.csv")
+manager.run()
+"""
+
+
+def open_port(port, baudrate=115200, timeout=1.0):
+    """Open the COM port of a tester. The timeout keeps a channel responsive to stop() if its tester stops sending data"""
+    return Serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+
+
+class channel:
+    """
+    A single tester with its schedule and logfile. The acquisition loop of the channel is run by the manager
+    """
+
+    def __init__(self, name, comport, schedule, logfile, formats=("csv",), echo_interval=None, stall_timeout=5.0, clock=None,
+                 observers=(), metrics=None, deadband=None):
+        """
+        Keyword arguments:
+        name -- Name of the channel used in status reports
+        comport -- Serial object of the tester
+        schedule -- Test schedule of the channel (see module description)
+        logfile -- Path of the csv logfile
+        formats -- Log formats passed to log_writer.open_log()
+        echo_interval -- Print a sample of this channel at most every echo_interval seconds. None disables the printing
+        stall_timeout -- Time without valid data in seconds after which the channel is reported as stalled
+        clock -- Clock of the tester (see hppc_tester). Defaults to the PC time, every channel needs its own deviceclock()
+        observers -- Objects with a method observe(step, sample) that is called with every valid sample (see schedule_engine.run_schedule)
+        metrics -- Optional tester_metrics.metrics object of the channel
+        deadband -- Optional deadband of the log (voltage in V, current in A, max interval in s), see log_writer.open_log()
+        """
+        self.name = name
+        self.comport = comport
+        self.schedule = schedule
+        self.logfile = logfile
+        self.formats = formats
+        self.deadband = deadband
+        self.echo_interval = echo_interval
+        self.stall_timeout = stall_timeout
+        self.observers = list(observers)
+        self.estimator = None
+        self.detector = None
+
+        self.tester = hppc_tester.tester(comport, hppc_tester.wall_clock if clock is None else clock, metrics)
+        self.running = False
+        self.finished = False
+        self.error = None
+        self.samples = 0
+        self.last_sample_time = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        self.running = True
+        self.last_sample_time = tim.time()
+        try:
+            with log_writer.open_log(self.logfile, self.formats, echo_interval=self.echo_interval,
+                                     deadband=self.deadband) as log:
+                if(self.tester.metrics is not None):
+                    log = self.tester.metrics.wrap_sink(log)
+                while not self._stop.is_set():
+                    try:
+                        sample, logdata = self.tester.read_sample()
+                    except EOFError:
+                        #End of a replayed logfile (fake_serial.replayport)
+                        break
+                    if(sample is None):
+                        #Timeouts of the COM port and incomplete lines
+                        continue
+
+                    self.samples += 1
+                    self.last_sample_time = tim.time()
+                    log.write(self.schedule.step, logdata, sample)
+                    for observer in self.observers:
+                        observer.observe(self.schedule.step, sample)
+
+                    if(not self.schedule.update(self.tester)):
+                        self.finished = True
+                        break
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.tester.set_idle()
+            except Exception:
+                pass
+            if(self.tester.metrics is not None and self.tester.metrics.path is not None):
+                self.tester.metrics.export()
+            self.running = False
+
+    def start(self):
+        """Start the acquisition loop of the channel in a new thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="channel-" + str(self.name))
+        self._thread.start()
+
+    def stop(self):
+        """Request the acquisition loop to stop after the current sample"""
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if(self._thread is not None):
+            self._thread.join(timeout)
+
+    def is_stalled(self):
+        """Returns True if the channel is running but didn't receive valid data for stall_timeout seconds"""
+        return self.running and (tim.time() - self.last_sample_time) > self.stall_timeout
+
+    def status(self):
+        """Returns a dict describing the state of the channel"""
+        return {
+            "name": self.name,
+            "running": self.running,
+            "finished": self.finished,
+            "stalled": self.is_stalled(),
+            "error": None if self.error is None else repr(self.error),
+            "step": self.schedule.step,
+            "samples": self.samples,
+            "rejected_lines": self.tester.rejected_lines,
+            "timeouts": self.tester.timeouts,
+            "missed_samples": None if self.tester.metrics is None else self.tester.metrics.missed_samples,
+            "voltage": self.tester.voltage,
+            "current": self.tester.current,
+            "soc": None if self.estimator is None else self.estimator.soc,
+            "anomalies": None if self.detector is None else self.detector.status()
+        }
+
+
+class manager:
+    """
+    Runs the acquisition loops of multiple channels concurrently
+    """
+
+    def __init__(self, telemetry=None, estimator=None):
+        """
+        Keyword arguments:
+        telemetry -- Optional telemetry.telemetryserver. Every channel gets a ring buffer with its live data on this server
+        estimator -- Optional soc_estimator.estimatorbank. Every channel is observed by the SoC estimator with its name
+                     (create it with estimator.channel(name) before the schedule to use its SoC conditions)
+        """
+        self.channels = {}
+        self.telemetry = telemetry
+        self.estimator = estimator
+
+    def add_channel(self, name, comport, schedule, logfile, detector=None, **kwargs):
+        """Add a channel and return it. Additional keyword arguments are passed to the channel constructor
+
+        Keyword arguments:
+        detector -- Optional anomaly_detector.anomalydetector of the channel. It observes the channel, uses the tester of
+                    the channel and is reported in the status (use its conditions in the schedule to end steps early)
+        """
+        if(name in self.channels):
+            raise ValueError("Channel " + str(name) + " already exists")
+        new_channel = channel(name, comport, schedule, logfile, **kwargs)
+        if(detector is not None):
+            if(detector.tester is None):
+                detector.tester = new_channel.tester
+            if(detector.name is None):
+                detector.name = name
+            new_channel.detector = detector
+            new_channel.observers.append(detector)
+        if(self.estimator is not None):
+            new_channel.estimator = self.estimator.channel(name)
+            new_channel.observers.append(new_channel.estimator)
+        if(self.telemetry is not None):
+            new_channel.observers.append(self.telemetry.add_channel(name, status=new_channel.status))
+        self.channels[name] = new_channel
+        return new_channel
+
+    def start(self):
+        """Start all channels that are not running yet"""
+        for ch in self.channels.values():
+            if(not ch.running and not ch.finished):
+                ch.start()
+
+    def stop(self):
+        """Stop all channels and wait for their threads to end"""
+        for ch in self.channels.values():
+            ch.stop()
+        for ch in self.channels.values():
+            ch.join()
+
+    def is_running(self):
+        return any(ch._thread is not None and ch._thread.is_alive() for ch in self.channels.values())
+
+    def status(self):
+        """Returns a list with the status of every channel"""
+        return [ch.status() for ch in self.channels.values()]
+
+    def run(self, status_interval=60.0):
+        """Start all channels and block until every channel is finished. Ctrl+C stops all channels
+
+        Keyword arguments:
+        status_interval -- Time in seconds between status prints. None disables the status prints
+        """
+        self.start()
+        last_status = tim.time()
+        try:
+            while self.is_running():
+                tim.sleep(0.5)
+                if(status_interval is not None and (tim.time() - last_status) >= status_interval):
+                    last_status = tim.time()
+                    for s in self.status():
+                        print(s)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            for ch in self.channels.values():
+                ch.comport.close()
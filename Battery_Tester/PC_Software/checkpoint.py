@@ -0,0 +1,109 @@
+import os
+import json
+import time as tim
+
+
+"""
+The Purpose of this Module is to continue a test after the PC software crashed or the COM port was lost. The
+checkpointer is added as observer to the acquisition loop (see schedule_engine.run_schedule) and periodically saves
+
+- the position in the schedule (schedule_engine.schedulerunner.state)
+- the remaining time of the running operation, the voltage limits and the uv/ov/cutoff flags
+- the state of capacity counters (capacity_counter.capacitycounter.state), SoC estimators (soc_estimator.socchannel.state)
+  or anomaly detectors (anomaly_detector.anomalydetector.state)
+
+as json file. The file is written to a temporary file first and then renamed, so a crash while writing never leaves a
+broken checkpoint. A checkpoint is also written at every step change.
+
+After a restart, resume() restores the schedule and the counters. The interrupted operation is restarted with its
+remaining time and the logfile is continued, as the log sinks append to existing files. The remaining time is taken at
+the last checkpoint, so the interrupted operation can be extended by up to the checkpoint interval.
+
+Example:
+
+runner = schedule_engine.schedulerunner(steps)
+resumed = checkpoint.resume(checkpointfile, runner, bat_tester, [counter])
+with log_writer.open_log(logfile, LOG_FORMATS) as log:
+    saver = checkpoint.checkpointer(checkpointfile, runner, bat_tester, [counter])
+    schedule_engine.run_schedule(bat_tester, runner, log, [counter, saver])
+saver.remove()
+"""
+
+
+def save(path, state):
+    """Write a checkpoint atomically"""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def load(path):
+    """Returns the checkpoint as dict or None if there is no checkpoint"""
+    if(not os.path.exists(path)):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def resume(path, runner, tester, counters=()):
+    """Restore the schedule and the counters from a checkpoint. Returns False if there is no checkpoint
+
+    Keyword arguments:
+    path -- Path of the checkpoint file
+    runner -- schedule_engine.schedulerunner of the same schedule the checkpoint was created with
+    tester -- hppc_tester.tester object
+    counters -- capacity counters or SoC estimators in the same order as passed to the checkpointer
+    """
+    state = load(path)
+    if(state is None):
+        return False
+    runner.restore(state["schedule"], tester)
+    for counter, counter_state in zip(counters, state["counters"]):
+        counter.restore(counter_state)
+    print("resume at step " + str(runner.step))
+    return True
+
+
+class checkpointer:
+    """
+    Observer for the acquisition loop that writes checkpoints of a running test
+    """
+
+    def __init__(self, path, runner, tester, counters=(), interval=60.0):
+        """
+        Keyword arguments:
+        path -- Path of the checkpoint file
+        runner -- schedule_engine.schedulerunner of the test
+        tester -- hppc_tester.tester object
+        counters -- capacity counters or SoC estimators whose state is saved with the checkpoint
+        interval -- Time between two checkpoints in seconds
+        """
+        self.path = path
+        self.runner = runner
+        self.tester = tester
+        self.counters = list(counters)
+        self.interval = interval
+        self._last_save = tim.time()
+        self._last_step = runner.step
+
+    def state(self):
+        return {
+            "time": tim.time(),
+            "schedule": self.runner.state(self.tester),
+            "counters": [counter.state() for counter in self.counters]
+        }
+
+    def observe(self, step, sample):
+        now = tim.time()
+        if(step != self._last_step or (now - self._last_save) >= self.interval):
+            self._last_step = step
+            self._last_save = now
+            save(self.path, self.state())
+
+    def remove(self):
+        """Delete the checkpoint, e.g. after the test is finished"""
+        if(os.path.exists(self.path)):
+            os.remove(self.path)
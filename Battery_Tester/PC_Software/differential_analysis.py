@@ -0,0 +1,351 @@
+import os
+import sys
+import glob
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ProcessPoolExecutor
+import binary_log
+import hppc_tester
+import analysis_cache
+from ocv_analysis import coulomb_count
+
+
+"""
+The Purpose of this Module is to calculate incremental capacity (dQ/dV, ICA) and differential voltage (dV/dQ, DVA, see
+dVdA.png in Measurement_Data/static_capacity_tests) curves of the constant current charges and discharges of
+static_capacity_test.py and pseudo_ocv_test.py and to track their peaks over many runs.
+
+The voltage is logged with 4 decimals, so the difference of two samples is mostly 0 or one quantisation step and a
+derivative of neighbouring samples is useless. Instead the samples are binned:
+
+dQ/dV -- The charge between two samples is added to the bin of their mean voltage (bincount), the sum of a bin divided by
+         the bin width is dQ/dV. Bins far wider than the quantisation average the noise without fitting anything
+dV/dQ -- The mean voltage of every bin of the charge throughput (bincount) is differentiated along the charge grid
+
+Every log is binned by a process pool onto the same grids (results are stored in the analysis_cache), so all runs form
+2D arrays (runs x bins). Smoothing (gaussian, moving average or Savitzky-Golay), differentiation, peak detection and
+peak tracking are then done on the whole 2D array at once:
+
+1. Peaks are maxima within +-distance bins higher than min_height times the maximum of their curve, refined by a
+   parabola through the three points around the maximum
+2. The reference peaks are the highest peaks of the mean curve of all runs (or given positions)
+3. Every peak of a run belongs to the nearest reference peak and every reference takes the highest of its peaks, so the
+   positions and heights of a peak form one column (NaN if the peak is missing) that can be compared over cells and
+   cycles
+
+dQ/dV and dV/dQ are given as magnitudes (positive for charge and discharge). The charge segment ends when the voltage
+reaches its maximum, so the CV phase of a CCCV charge is not included.
+
+Usage as a script (without logs all static_test_* files of Measurement_Data are used):
+
+python differential_analysis.py [peaks.csv] [logs...]
+"""
+
+
+DEFAULT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data",
+                              "static_capacity_tests")
+DIRECTIONS = ("discharge", "charge")
+
+
+def _blocks(mask):
+    """Returns the start and end indices of every block of consecutive True values"""
+    edges = np.diff(mask.astype(np.int8))
+    starts = np.flatnonzero(edges == 1) + 1
+    ends = np.flatnonzero(edges == -1) + 1
+    if(len(mask) and mask[0]):
+        starts = np.concatenate(([0], starts))
+    if(len(mask) and mask[-1]):
+        ends = np.concatenate((ends, [len(mask)]))
+    return starts, ends
+
+
+def find_segments(data, cv_tolerance=0.002):
+    """Returns the slices of the constant current discharge and charge of a log as dict (None if missing)
+
+    The discharge is the longest block of CCR samples with negative current, the charge is the first block of CCR or
+    CCCV samples with positive current after the discharge (the longest block if there is none after it). The charge ends
+    with the first sample within cv_tolerance (V) of the highest voltage of the block.
+    """
+    mode = np.asarray(data["mode"])
+    current = np.asarray(data["current"])
+    voltage = np.asarray(data["voltage"])
+    segments = {"discharge": None, "charge": None}
+
+    starts, ends = _blocks((mode == int(hppc_tester.operatingmodes["CCR"])) & (current < 0))
+    discharge_end = 0
+    if(len(starts)):
+        longest = np.argmax(ends - starts)
+        segments["discharge"] = slice(starts[longest], ends[longest])
+        discharge_end = ends[longest]
+
+    charging = np.isin(mode, (int(hppc_tester.operatingmodes["CCR"]), int(hppc_tester.operatingmodes["CCCV"])))
+    starts, ends = _blocks(charging & (current > 0))
+    if(len(starts)):
+        after = np.flatnonzero(starts >= discharge_end)
+        chosen = after[0] if len(after) else np.argmax(ends - starts)
+        start, end = starts[chosen], ends[chosen]
+        block = voltage[start:end]
+        end = start + int(np.argmax(block >= block.max() - cv_tolerance)) + 1
+        segments["charge"] = slice(start, end)
+    return segments
+
+
+def bin_segment(time_ms, voltage, current, voltage_edges, capacity_edges, normalize=False):
+    """Bin one constant current segment
+
+    Keyword arguments:
+    time_ms, voltage, current -- Samples of the segment
+    voltage_edges -- Edges of the voltage bins of dQ/dV (equally spaced)
+    capacity_edges -- Edges of the bins of the charge throughput for dV/dQ (equally spaced)
+    normalize -- Use the charge throughput divided by the total charge of the segment instead of Ah
+
+    Returns (charge per voltage bin in Ah, mean voltage per capacity bin (NaN for empty bins), total charge in Ah)
+    """
+    throughput = np.abs(coulomb_count(time_ms, current))
+    total = throughput[-1] if len(throughput) else 0.0
+    if(normalize and total > 0):
+        throughput = throughput / total
+
+    middle = (voltage[1:] + voltage[:-1]) / 2
+    voltage_bins = np.floor((middle - voltage_edges[0]) / (voltage_edges[1] - voltage_edges[0])).astype(np.intp)
+    inside = (voltage_bins >= 0) & (voltage_bins < len(voltage_edges) - 1)
+    charge = np.bincount(voltage_bins[inside], weights=np.abs(np.diff(throughput))[inside],
+                         minlength=len(voltage_edges) - 1)
+    if(normalize):
+        charge *= total
+
+    capacity_bins = np.floor((throughput - capacity_edges[0]) / (capacity_edges[1] - capacity_edges[0])).astype(np.intp)
+    inside = (capacity_bins >= 0) & (capacity_bins < len(capacity_edges) - 1)
+    counts = np.bincount(capacity_bins[inside], minlength=len(capacity_edges) - 1)
+    sums = np.bincount(capacity_bins[inside], weights=voltage[inside], minlength=len(capacity_edges) - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_voltage = np.where(counts > 0, sums / counts, np.nan)
+    return charge, mean_voltage, total
+
+
+def bin_file(path, voltage_range=(1.5, 4.1), voltage_step=0.005, max_capacity=1.8, capacity_step=0.005,
+             normalize=False):
+    """Bin the discharge and the charge of a log (see bin_segment()). Returns a dict with the results of both directions"""
+    data = binary_log.load_log(path)
+    voltage_edges = np.arange(voltage_range[0], voltage_range[1] + voltage_step / 2, voltage_step)
+    capacity_edges = np.arange(0, (1.0 if normalize else max_capacity) + capacity_step / 2, capacity_step)
+    result = {}
+    for direction, segment in find_segments(data).items():
+        if(segment is None or segment.stop - segment.start < 2):
+            result[direction] = (np.zeros(len(voltage_edges) - 1), np.full(len(capacity_edges) - 1, np.nan), np.nan)
+            continue
+        result[direction] = bin_segment(np.asarray(data["time"][segment]),
+                                        np.asarray(data["voltage"][segment], dtype=np.float64),
+                                        np.asarray(data["current"][segment], dtype=np.float64),
+                                        voltage_edges, capacity_edges, normalize)
+    return result
+
+
+def _kernel(method, window, order=2):
+    if(method == "gaussian"):
+        #window is the standard deviation in bins, the kernel covers +-3 standard deviations
+        x = np.arange(-int(3 * window), int(3 * window) + 1)
+        kernel = np.exp(-0.5 * (x / window) ** 2)
+        return kernel / kernel.sum()
+    if(method == "moving"):
+        return np.full(window, 1.0 / window)
+    if(method == "savgol"):
+        #Coefficients of the value of a least squares polynomial at the center of the window
+        half = window // 2
+        vandermonde = np.vander(np.arange(-half, half + 1), order + 1, increasing=True)
+        return np.linalg.pinv(vandermonde)[0]
+    raise ValueError("Unknown smoothing method " + method)
+
+
+def smooth(curves, method="gaussian", window=2, order=2):
+    """Smooth every row of a 2D array, NaN values are ignored (normalized convolution)
+
+    Keyword arguments:
+    curves -- Array (runs x bins)
+    method -- "gaussian" (window is the standard deviation in bins), "moving" (moving average over window bins) or
+              "savgol" (Savitzky-Golay filter of the given order over window bins, window must be odd). None returns a copy
+    window -- Size of the filter, see method
+    order -- Polynomial order of the Savitzky-Golay filter
+    """
+    curves = np.atleast_2d(np.asarray(curves, dtype=np.float64))
+    if(method is None):
+        return curves.copy()
+    kernel = _kernel(method, window, order)
+    half = len(kernel) // 2
+    valid = ~np.isnan(curves)
+    padded = np.pad(np.where(valid, curves, 0.0), ((0, 0), (half, len(kernel) - 1 - half)))
+    weights = np.pad(valid.astype(np.float64), ((0, 0), (half, len(kernel) - 1 - half)))
+    values = sliding_window_view(padded, len(kernel), axis=1) @ kernel[::-1]
+    if(method == "savgol"):
+        #The polynomial coefficients are not positive, so gaps can't be normalized, the edges keep NaN instead
+        values[~(sliding_window_view(weights, len(kernel), axis=1).min(axis=2) > 0)] = np.nan
+        return values
+    norm = sliding_window_view(weights, len(kernel), axis=1) @ kernel[::-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = values / norm
+    values[~valid] = np.nan
+    return values
+
+
+def find_peaks(curves, min_height=0.05, distance=5):
+    """Returns a boolean array (runs x bins) of the peaks of every row
+
+    A peak is the maximum of the bins within +-distance bins around it, which suppresses the ripples left by the
+    smoothing, and higher than min_height times the maximum of its row. Bins closer than distance to the end of the grid or
+    to a NaN value (end of a run) are no peaks, so the steep ends of the curves are not reported.
+    """
+    curves = np.atleast_2d(curves)
+    padded = np.pad(curves, ((0, 0), (distance, distance)), constant_values=np.nan)
+    windows = sliding_window_view(padded, 2 * distance + 1, axis=1)
+    complete = ~np.isnan(windows).any(axis=2)
+    with np.errstate(invalid='ignore'):
+        peaks = complete & (curves >= windows.max(axis=2)) & (curves > windows[:, :, 0]) & (curves > 0)
+        peaks &= curves >= min_height * np.nanmax(curves, axis=1, initial=0.0)[:, None]
+    return peaks
+
+
+def _refine(curves, rows, index, grid):
+    """Returns position and height of the parabola through the maximum at index and its two neighbours"""
+    step = grid[1] - grid[0]
+    left = curves[rows, np.maximum(index - 1, 0)]
+    center = curves[rows, index]
+    right = curves[rows, np.minimum(index + 1, curves.shape[1] - 1)]
+    curvature = left - 2 * center + right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+    offset = np.clip(np.nan_to_num(offset), -0.5, 0.5)
+    return grid[index] + offset * step, center - 0.25 * (left - right) * offset
+
+
+def track_peaks(curves, grid, reference=None, max_peaks=4, tolerance=None, min_height=0.05, distance=5):
+    """Assign the peaks of every run to reference peaks
+
+    Keyword arguments:
+    curves -- Smoothed curves (runs x bins)
+    grid -- Position of every bin (center)
+    reference -- Positions of the tracked peaks. Defaults to the max_peaks highest peaks of the mean curve of all runs
+                 (bins with values of at least half of the runs)
+    max_peaks -- Number of reference peaks taken from the mean curve
+    tolerance -- Maximum distance between a peak and its reference. None accepts every peak nearer to the reference than
+                 to the other references, e.g. peaks shifted by the IR drop at different C-rates
+    min_height, distance -- See find_peaks()
+
+    Returns (reference positions, positions (runs x peaks), heights (runs x peaks)), NaN where a run has no peak
+    """
+    curves = np.atleast_2d(curves)
+    if(reference is None):
+        #Bins after the end of most runs are left out of the mean curve
+        valid = ~np.isnan(curves)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid, curves, 0.0).sum(axis=0) / valid.sum(axis=0)
+        mean = np.where(valid.mean(axis=0) >= 0.5, mean, np.nan)[None, :]
+        candidates = np.flatnonzero(find_peaks(mean, min_height, distance)[0])
+        candidates = candidates[np.argsort(mean[0, candidates])[::-1][:max_peaks]]
+        reference = _refine(mean, np.zeros(len(candidates), dtype=np.intp), candidates, grid)[0]
+    reference = np.sort(np.asarray(reference, dtype=np.float64))
+
+    peaks = find_peaks(curves, min_height, distance)
+    #Every peak belongs to its nearest reference, a reference takes the highest of its peaks (runs x bins x references)
+    offset = np.abs(grid[:, None] - reference[None, :])
+    nearest = np.argmin(offset, axis=1)[:, None] == np.arange(len(reference))[None, :]
+    if(tolerance is not None):
+        nearest &= offset <= tolerance
+    score = np.where(peaks[:, :, None] & nearest[None, :, :], np.nan_to_num(curves, nan=-np.inf)[:, :, None], -np.inf)
+    index = np.argmax(score, axis=1)
+    rows = np.repeat(np.arange(len(curves)), len(reference)).reshape(index.shape)
+    positions, heights = _refine(curves, rows, index, grid)
+    missing = np.isinf(np.take_along_axis(score, index[:, None, :], axis=1)[:, 0, :])
+    positions[missing] = np.nan
+    heights[missing] = np.nan
+    return reference, positions, heights
+
+
+def differential_curves(paths, voltage_range=(1.5, 4.1), voltage_step=0.005, max_capacity=1.8, capacity_step=0.005,
+                        normalize=False, method="gaussian", voltage_window=3, capacity_window=3, order=2, processes=None,
+                        cache=None):
+    """Calculate the dQ/dV and dV/dQ curves of the discharge and the charge of multiple logs
+
+    Keyword arguments:
+    paths -- List of logfiles
+    voltage_range -- (lowest, highest) voltage of the dQ/dV grid in V
+    voltage_step -- Width of the voltage bins in V
+    max_capacity -- End of the charge grid of dV/dQ in Ah
+    capacity_step -- Width of the charge bins in Ah (in parts of the total charge if normalize is set)
+    normalize -- Use the charge throughput relative to the total charge of the segment for dV/dQ
+    method, order -- Smoothing of the curves, see smooth()
+    voltage_window -- Size of the smoothing filter of dQ/dV in bins
+    capacity_window -- Size of the smoothing filter of the voltage before the calculation of dV/dQ in bins
+    processes -- Number of worker processes. Defaults to the number of CPUs
+    cache -- Optional analysis_cache.analysiscache, only files without a stored result are binned
+
+    Returns a dict with the names of the files, the grids (voltage, capacity), the total charge of every segment
+    (capacity_<direction>) and the 2D arrays dqdv_<direction> and dvdq_<direction> (runs x bins)
+    """
+    params = {"voltage_range": voltage_range, "voltage_step": voltage_step, "max_capacity": max_capacity,
+              "capacity_step": capacity_step, "normalize": normalize}
+    results = {}
+    keys = {}
+    if(cache is not None):
+        for path in paths:
+            keys[path] = cache.key(bin_file, path, params)
+            found, result = cache.get(keys[path])
+            if(found):
+                results[path] = result
+    missing = [path for path in paths if path not in results]
+    if(missing):
+        count = len(missing)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, result in zip(missing, pool.map(bin_file, missing, [voltage_range] * count, [voltage_step] * count,
+                                                      [max_capacity] * count, [capacity_step] * count,
+                                                      [normalize] * count)):
+                results[path] = result
+                if(cache is not None):
+                    cache.put(keys[path], result)
+
+    voltage_edges = np.arange(voltage_range[0], voltage_range[1] + voltage_step / 2, voltage_step)
+    capacity_edges = np.arange(0, (1.0 if normalize else max_capacity) + capacity_step / 2, capacity_step)
+    curves = {
+        "files": [os.path.basename(path) for path in paths],
+        "voltage": (voltage_edges[1:] + voltage_edges[:-1]) / 2,
+        "capacity": (capacity_edges[1:] + capacity_edges[:-1]) / 2
+    }
+    for direction in DIRECTIONS:
+        charge = np.array([results[path][direction][0] for path in paths]).reshape(len(paths), -1)
+        mean_voltage = np.array([results[path][direction][1] for path in paths]).reshape(len(paths), -1)
+        curves["capacity_" + direction] = np.array([results[path][direction][2] for path in paths])
+        curves["dqdv_" + direction] = smooth(charge / voltage_step, method, voltage_window, order)
+        smoothed = smooth(mean_voltage, method, capacity_window, order)
+        curves["dvdq_" + direction] = np.abs(np.gradient(smoothed, capacity_step, axis=1)) if smoothed.shape[1] > 1 \
+            else np.full(smoothed.shape, np.nan)
+    return curves
+
+
+def peak_table(curves, max_peaks=4, min_height=0.05, distance=5, tolerance=None):
+    """Track the peaks of all curves of differential_curves(). Returns a list of rows (file, direction, curve, peak, reference, position, height)"""
+    rows = []
+    for direction in DIRECTIONS:
+        for name, grid in (("dqdv", curves["voltage"]), ("dvdq", curves["capacity"])):
+            reference, positions, heights = track_peaks(curves[name + "_" + direction], grid, None, max_peaks,
+                                                        tolerance, min_height, distance)
+            for run, file in enumerate(curves["files"]):
+                for peak in range(len(reference)):
+                    rows.append((file, direction, name, peak, reference[peak], positions[run, peak], heights[run, peak]))
+    return rows
+
+
+def write_table(path, rows):
+    with open(path, 'w') as f:
+        f.write("file,direction,curve,peak,reference,position,height\n")
+        for row in rows:
+            f.write("%s,%s,%s,%d,%.4f,%.4f,%.4f\n" % row)
+
+
+if __name__ == "__main__":
+    paths = sys.argv[2:] or sorted(glob.glob(os.path.join(DEFAULT_FOLDER, "static_test_*.csv")))
+    rows = peak_table(differential_curves(paths, cache=analysis_cache.analysiscache()))
+    if(len(sys.argv) > 1):
+        write_table(sys.argv[1], rows)
+    else:
+        print("file,direction,curve,peak,reference,position,height")
+        for row in rows:
+            print("%s,%s,%s,%d,%.4f,%.4f,%.4f" % row)
@@ -0,0 +1,279 @@
+import math
+import random
+import time as tim
+import hppc_tester
+import binary_protocol
+
+
+"""
+The Purpose of this Module is to run the PC software without the Arduino based Hardware. Both classes can be passed to
+hppc_tester.tester instead of a Serial object and implement the parts of the pyserial interface used by the tester
+(read, in_waiting, readline, write, close).
+
+replayport: Replays a recorded csv logfile of Measurement_Data. Commands sent by the tester are recorded but have no effect
+simulatedport: Simulates the firmware state machine (IDLE, CCCV, CCP, CCR) together with a cell modelled as an equivalent
+               circuit (OCV(SoC) + R0 + one RC element). The cell reacts to the commands sent by the set_* methods
+
+The simulatedport also understands the commands of the binary protocol (see binary_protocol.py) and then sends frames
+with the requested number of samples and sample interval.
+
+The simulatedport sends one sample every 101ms of device time, the replayport keeps the recorded time between the
+samples. speedup scales the time between two samples, e.g. speedup=100 runs 100 times faster than real time. speedup=None sends the samples as fast as they are read. To run long schedules
+in accelerated time the tester needs a clock that follows the device time (see hppc_tester).
+
+At the end of a replayed logfile read() and readline() raise EOFError, so the acquisition loops
+(schedule_engine.run_schedule, channel_manager) end instead of polling an empty port forever.
+"""
+
+
+SAMPLE_INTERVAL_MS = 101
+OVERLIMIT_SLOPE = 20.0      #Voltage change in V per unit SoC outside of the OCV table
+
+#Approximation of the Hakadi 1500mAh OCV from the 0.5C discharge static_test_0c5-2-1, SoC in steps of 5%
+DEFAULT_OCV_TABLE = [1.60, 2.15, 2.40, 2.57, 2.66, 2.71, 2.74, 2.80, 2.90, 2.99, 3.09,
+                     3.19, 3.29, 3.38, 3.47, 3.55, 3.64, 3.74, 3.84, 3.95, 4.10]
+
+
+class _pacedport:
+    """
+    Common part of the fake ports: output buffer and pacing of the samples
+    """
+
+    def __init__(self, speedup=None, timeout=None):
+        self.speedup = speedup
+        self.timeout = timeout
+        self.commands = []
+        self.is_open = True
+        self._out = bytearray()
+        self._next_sample_time = None
+        self.line_interval = SAMPLE_INTERVAL_MS     #Device time in ms until the line after the one returned by _next_line
+
+    def _next_line(self):
+        """Returns the next line sent by the device or None if there is no more data"""
+        raise NotImplementedError
+
+    def _fill(self):
+        if(self.speedup is not None):
+            now = tim.perf_counter()
+            if(self._next_sample_time is None):
+                self._next_sample_time = now
+            if(self._next_sample_time > now):
+                tim.sleep(self._next_sample_time - now)
+        line = self._next_line()
+        if(line is None):
+            return False
+        if(self.speedup is not None):
+            self._next_sample_time += self.line_interval / 1000 / self.speedup
+        self._out += line
+        return True
+
+    @property
+    def in_waiting(self):
+        return len(self._out)
+
+    def read(self, size=1):
+        if(not self._out and not self._fill()):
+            raise EOFError("no more data")
+        chunk = bytes(self._out[:size])
+        del self._out[:size]
+        return chunk
+
+    def readline(self):
+        while b'\n' not in self._out:
+            if(not self._fill()):
+                if(not self._out):
+                    raise EOFError("no more data")
+                break
+        end = self._out.find(b'\n') + 1
+        if(end == 0):
+            end = len(self._out)
+        line = bytes(self._out[:end])
+        del self._out[:end]
+        return line
+
+    def write(self, data):
+        self.commands.append(bytes(data))
+        self._command(bytes(data))
+        return len(data)
+
+    def _command(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class replayport(_pacedport):
+    """
+    Replays a csv logfile (step,mode,time,voltage,current) as the lines the Arduino sends. The lines keep the recorded
+    time_millis and are paced by the recorded time between them, so gaps and logs thinned by a deadband replay with
+    their real durations. Lines without all five columns or with an invalid time are skipped (counted in skipped_lines)
+    """
+
+    def __init__(self, csv_path, speedup=1.0, timeout=None):
+        """
+        Keyword arguments:
+        csv_path -- Path of the recorded logfile
+        speedup -- Replay speed relative to the recorded time. None replays without any delay
+        timeout -- Only stored for compatibility with Serial, read() raises EOFError at the end of the file
+        """
+        _pacedport.__init__(self, speedup, timeout)
+        self._lines = []
+        self._millis = []
+        self.skipped_lines = 0
+        with open(csv_path, 'rb') as f:
+            f.readline()
+            for line in f:
+                if(not line.strip()):
+                    continue
+                fields = line.rstrip(b'\r\n').split(b',')
+                try:
+                    millis = int(fields[2])
+                except (IndexError, ValueError):
+                    millis = None
+                if(millis is None or len(fields) != 5):
+                    self.skipped_lines += 1
+                    continue
+                self._lines.append(b','.join(fields[1:]) + b'\r\n')
+                self._millis.append(millis)
+        self._index = 0
+
+    def _next_line(self):
+        index = self._index
+        if(index >= len(self._lines)):
+            return None
+        self._index = index + 1
+        #Time until the next recorded line, time_millis jumps back after a reset of the Arduino
+        if(index + 1 < len(self._millis)):
+            self.line_interval = max(self._millis[index + 1] - self._millis[index], 0)
+        return self._lines[index]
+
+    def __len__(self):
+        return len(self._lines)
+
+
+class simulatedport(_pacedport):
+    """
+    Simulates the firmware of Battery_Tester.ino with an equivalent circuit model of the cell. Charge currents are positive
+    """
+
+    def __init__(self, soc=0.5, capacity=1.5, r0=0.06, r1=0.04, c1=1000.0, ocv_table=None,
+                 voltage_noise=0.0, current_noise=0.0, seed=None, speedup=None, timeout=None):
+        """
+        Keyword arguments:
+        soc -- Initial state of charge (0..1)
+        capacity -- Cell capacity in Ah
+        r0 -- Series resistance in Ohm
+        r1 -- Resistance of the RC element in Ohm
+        c1 -- Capacitance of the RC element in F
+        ocv_table -- OCV in V for equally spaced SoC values from 0 to 1. Defaults to DEFAULT_OCV_TABLE
+        voltage_noise -- Standard deviation of the voltage measurement noise in V
+        current_noise -- Standard deviation of the current measurement noise in A
+        seed -- Seed of the noise generator
+        speedup -- Time scaling of the samples (see module description). None runs as fast as possible
+        timeout -- Only stored for compatibility with Serial
+        """
+        _pacedport.__init__(self, speedup, timeout)
+        self.soc = soc
+        self.capacity = capacity
+        self.r0 = r0
+        self.r1 = r1
+        self.c1 = c1
+        self.ocv_table = list(DEFAULT_OCV_TABLE if ocv_table is None else ocv_table)
+        self.voltage_noise = voltage_noise
+        self.current_noise = current_noise
+        self._random = random.Random(seed)
+
+        self.state = int(hppc_tester.operatingmodes["IDLE"])
+        self.voltage_setpoint = 0.0
+        self.current_setpoint = 0.0
+        self.cutoff_current = 0.0
+        self.millis = 202
+        self.v1 = 0.0
+        self.current = 0.0
+        self.sample_interval = SAMPLE_INTERVAL_MS
+        self.samples_per_frame = None
+        self.frame_sequence = 0
+        self._pending = None
+        self._pending_protocol = None
+
+    def ocv(self, soc):
+        """Open circuit voltage for a given SoC by linear interpolation of the OCV table"""
+        if(soc < 0.0 or soc > 1.0):
+            #Steep voltage change of an over discharged or over charged cell so the voltage limits are reached
+            edge = self.ocv_table[0] if soc < 0.0 else self.ocv_table[-1]
+            return edge + (soc - min(max(soc, 0.0), 1.0)) * OVERLIMIT_SLOPE
+        position = soc * (len(self.ocv_table) - 1)
+        index = min(int(position), len(self.ocv_table) - 2)
+        fraction = position - index
+        return self.ocv_table[index] + fraction * (self.ocv_table[index + 1] - self.ocv_table[index])
+
+    def terminal_voltage(self, current):
+        return self.ocv(self.soc) + self.v1 + current * self.r0
+
+    def _command(self, data):
+        #Same format as parsed by sscanf in SerialRead() of the firmware: "mode voltage current cutoff"
+        values = data.split()
+        if(values[:1] == [b"B"] and len(values) == 3):
+            self._pending_protocol = (int(values[1]), int(values[2]))
+            return
+        if(values == [b"A"]):
+            self._pending_protocol = (None, SAMPLE_INTERVAL_MS)
+            return
+        if(len(values) != 4):
+            return
+        try:
+            self._pending = (int(values[0]), float(values[1]), float(values[2]), float(values[3]))
+        except ValueError:
+            return
+
+    def _target_current(self):
+        if(self.state == int(hppc_tester.operatingmodes["CCCV"])):
+            #Current that holds the terminal voltage at the setpoint, limited to the CC phase current
+            current = (self.voltage_setpoint - self.ocv(self.soc) - self.v1) / self.r0
+            return min(max(current, 0.0), self.current_setpoint)
+        if(self.state in (int(hppc_tester.operatingmodes["CCP"]), int(hppc_tester.operatingmodes["CCR"]))):
+            return self.current_setpoint
+        return 0.0
+
+    def step(self, dt):
+        """Advance the cell model by dt seconds with the current of the present state"""
+        self.current = self._target_current()
+        tau = self.r1 * self.c1
+        decay = math.exp(-dt / tau)
+        self.v1 = self.v1 * decay + self.current * self.r1 * (1 - decay)
+        self.soc += self.current * dt / 3600 / self.capacity
+
+    def _next_line(self):
+        if(self.samples_per_frame is None):
+            return b"%d,%d,%.4f,%.4f\r\n" % self._sample()
+        samples = [self._sample() for i in range(self.samples_per_frame)]
+        self.frame_sequence += 1
+        return binary_protocol.encode_frame(self.frame_sequence, samples)
+
+    def _sample(self):
+        reported_state = self.state
+        voltage = self.terminal_voltage(self.current)
+        current = self.current
+        if(self.voltage_noise):
+            voltage += self._random.gauss(0.0, self.voltage_noise)
+        if(self.current_noise):
+            current += self._random.gauss(0.0, self.current_noise)
+        sample = (reported_state, self.millis, voltage, current)
+
+        #Limit checks and command handling of the firmware happen after the sample is printed
+        if(voltage > 4.5 or voltage < 0 or abs(current) > 5.0):
+            self.state = int(hppc_tester.operatingmodes["IDLE"])
+        if(self._pending is not None):
+            self.state, self.voltage_setpoint, self.current_setpoint, self.cutoff_current = self._pending
+            self._pending = None
+        if(self._pending_protocol is not None):
+            self.samples_per_frame, self.sample_interval = self._pending_protocol
+            self._pending_protocol = None
+            self.line_interval = self.sample_interval * (self.samples_per_frame or 1)
+        self.step(self.sample_interval / 1000)
+        self.millis += self.sample_interval
+        return sample
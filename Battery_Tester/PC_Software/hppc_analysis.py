@@ -0,0 +1,209 @@
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import binary_log
+import hppc_tester
+import analysis_cache
+
+
+"""
+The Purpose of this Module is to extract the internal resistance and the RC parameters of every pulse of an HPPC test
+(hppc_test.py). Pulses are found with the mode column of the log: every block of consecutive CCP samples is a pulse and
+the step column of its first sample is reported with it. The last sample before the pulse is the rest point the pulse
+response is referenced to.
+
+For every pulse the voltage response is fitted with the first order equivalent circuit
+
+V(t) - V_rest = I * R0 + I * R1 * (1 - exp(-t / tau))
+
+For a fixed tau the model is linear in R0 and R1. All pulses are padded to the same length and the linear least squares
+problem is solved in closed form for a grid of tau values and all pulses at once. The tau with the smallest residual is
+chosen for every pulse. Additionally the DC resistance between the rest point and the end of the pulse is calculated
+(method of Rin_SoC.jpg).
+
+Multiple files are processed in parallel by a process pool. Usage as a script:
+
+python hppc_analysis.py output.csv hppc_logs...
+"""
+
+
+PARAMETER_DTYPE = np.dtype([
+    ("pulse", "<i4"),
+    ("step", "<i4"),
+    ("soc", "<f8"),
+    ("current", "<f8"),
+    ("r0", "<f8"),
+    ("r1", "<f8"),
+    ("c1", "<f8"),
+    ("tau", "<f8"),
+    ("r_dc", "<f8"),
+    ("rmse", "<f8")
+])
+
+DEFAULT_TAU_GRID = np.logspace(-0.7, 2, 64)
+
+
+def find_pulses(mode):
+    """Returns the index of the first and the number of samples of every pulse (consecutive CCP samples)
+
+    The first sample of the step after a pulse still reports CCP because the firmware prints the state before it reads
+    the next command, so it is counted to the pulse.
+    """
+    pulse = (mode == int(hppc_tester.operatingmodes["CCP"])).astype(np.int8)
+    if(len(pulse) == 0):
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    edges = np.diff(pulse)
+    starts = np.flatnonzero(edges == 1) + 1
+    ends = np.flatnonzero(edges == -1) + 1
+    if(pulse[-1]):
+        ends = np.concatenate((ends, [len(pulse)]))
+    if(pulse[0]):
+        #The first sample of a log has no rest point in front of it
+        ends = ends[1:]
+    return starts, ends - starts
+
+
+def state_of_charge(time_ms, current, full_index, capacity=None):
+    """Returns the SoC of every sample by coulomb counting, starting with a full cell at full_index
+
+    Keyword arguments:
+    capacity -- Cell capacity in Ah. Defaults to the largest charge removed after full_index
+    """
+    dt = np.diff(time_ms.astype(np.float64)) / 1000
+    charge = np.concatenate(([0.0], np.cumsum((current[1:] + current[:-1]) * dt / 7200)))
+    charge -= charge[full_index]
+    if(capacity is None):
+        capacity = -charge[full_index:].min()
+    return 1 + charge / capacity
+
+
+def fit_pulses(time_ms, voltage, current, starts, lengths, tau_grid=DEFAULT_TAU_GRID):
+    """Fit R0, R1 and tau of all pulses at once. Returns the arrays (r0, r1, tau, r_dc, rmse, pulse_current)"""
+    max_length = int(lengths.max())
+    offsets = np.arange(max_length)
+    idx = np.minimum(starts[:, None] + offsets[None, :], len(voltage) - 1)
+    mask = offsets[None, :] < lengths[:, None]
+    rest = starts - 1
+
+    t = (time_ms[idx].astype(np.float64) - time_ms[rest][:, None]) / 1000
+    y = np.where(mask, voltage[idx] - voltage[rest][:, None], 0.0)
+    pulse_current = np.where(mask, current[idx], 0.0).sum(axis=1) / lengths
+    delta_current = pulse_current - current[rest]
+
+    #Closed form linear regression y = c + a * x for every (tau, pulse) pair
+    x = np.where(mask[None, :, :], 1 - np.exp(-t[None, :, :] / tau_grid[:, None, None]), 0.0)
+    n = lengths[None, :].astype(np.float64)
+    sx = x.sum(axis=2)
+    sy = y.sum(axis=1)[None, :]
+    sxx = (x * x).sum(axis=2)
+    sxy = (x * y[None, :, :]).sum(axis=2)
+    syy = (y * y).sum(axis=1)[None, :]
+    denominator = n * sxx - sx * sx
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = (n * sxy - sx * sy) / denominator
+        c = (sy - a * sx) / n
+    sse = syy - 2 * a * sxy - 2 * c * sy + a * a * sxx + 2 * a * c * sx + c * c * n
+    sse = np.where(np.isfinite(sse), sse, np.inf)
+
+    best = np.argmin(sse, axis=0)
+    pulses = np.arange(len(starts))
+    a_best = a[best, pulses]
+    c_best = c[best, pulses]
+
+    end = starts + lengths - 1
+    r_dc = (voltage[end] - voltage[rest]) / delta_current
+    rmse = np.sqrt(np.maximum(sse[best, pulses], 0.0) / lengths)
+    return c_best / delta_current, a_best / delta_current, tau_grid[best], r_dc, rmse, pulse_current
+
+
+def analyse(data, capacity=None, tau_grid=DEFAULT_TAU_GRID):
+    """Extract the parameters of every pulse of an HPPC log
+
+    Keyword arguments:
+    data -- Log as numpy record array (see binary_log.load_log)
+    capacity -- Cell capacity in Ah for the SoC calculation. Defaults to the charge removed after the first CCCV charge
+    tau_grid -- Time constants in seconds that are tested for the RC element
+
+    Returns a numpy record array with PARAMETER_DTYPE and one row per pulse
+    """
+    step = np.asarray(data["step"])
+    mode = np.asarray(data["mode"])
+    time_ms = np.asarray(data["time"])
+    voltage = np.asarray(data["voltage"], dtype=np.float64)
+    current = np.asarray(data["current"], dtype=np.float64)
+
+    starts, lengths = find_pulses(mode)
+    result = np.zeros(len(starts), dtype=PARAMETER_DTYPE)
+    if(len(starts) == 0):
+        return result
+
+    #The cell is full at the end of the first CCCV charge
+    cccv = np.flatnonzero(mode == int(hppc_tester.operatingmodes["CCCV"]))
+    full_index = int(cccv[cccv < starts[0]].max()) if (cccv < starts[0]).any() else 0
+    soc = state_of_charge(time_ms, current, full_index, capacity)
+
+    fill_parameters(result, step[starts], soc[starts - 1],
+                    fit_pulses(time_ms, voltage, current, starts, lengths, tau_grid))
+    return result
+
+
+def fill_parameters(result, steps, soc, fit):
+    """Fill a PARAMETER_DTYPE array with the steps and SoC of the pulses and the return value of fit_pulses()"""
+    r0, r1, tau, r_dc, rmse, pulse_current = fit
+    result["pulse"] = np.arange(len(result))
+    result["step"] = steps
+    result["soc"] = soc
+    result["current"] = pulse_current
+    result["r0"] = r0
+    result["r1"] = r1
+    result["tau"] = tau
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["c1"] = tau / r1
+    result["r_dc"] = r_dc
+    result["rmse"] = rmse
+    return result
+
+
+def analyse_file(path, capacity=None):
+    return analyse(binary_log.load_log(path), capacity)
+
+
+def analyse_files(paths, capacity=None, processes=None, cache=None):
+    """Analyse multiple HPPC logs in parallel. Returns a dict with the parameter array of every file
+
+    Keyword arguments:
+    paths -- List of logfiles
+    capacity -- Cell capacity in Ah, None calculates it for every file
+    processes -- Number of worker processes. Defaults to the number of CPUs
+    cache -- Optional analysis_cache.analysiscache, only files without a stored result are analysed
+    """
+    results = {}
+    keys = {}
+    if(cache is not None):
+        for path in paths:
+            keys[path] = cache.key(analyse_file, path, {"capacity": capacity})
+            found, result = cache.get(keys[path])
+            if(found):
+                results[path] = result
+    missing = [path for path in paths if path not in results]
+    if(missing):
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, result in zip(missing, pool.map(analyse_file, missing, [capacity] * len(missing))):
+                results[path] = result
+                if(cache is not None):
+                    cache.put(keys[path], result)
+    return {path: results[path] for path in paths}
+
+
+def write_table(path, results):
+    """Write the parameters of multiple files as one csv table sorted by file and SoC"""
+    with open(path, 'w') as f:
+        f.write("file," + ",".join(PARAMETER_DTYPE.names) + "\n")
+        for name, parameters in results.items():
+            for row in np.sort(parameters, order=["soc", "pulse"])[::-1]:
+                f.write(os.path.basename(name) + ",%d,%d,%.4f,%.4f,%.6f,%.6f,%.2f,%.3f,%.6f,%.6f\n" % tuple(row))
+
+
+if __name__ == "__main__":
+    write_table(sys.argv[1], analyse_files(sys.argv[2:], cache=analysis_cache.analysiscache()))
@@ -1,6 +1,12 @@
 import serial as Serial
 import hppc_tester
-import time
+import log_writer
+import tester_metrics
+import telemetry
+import cell_model
+import soc_estimator
+import anomaly_detector
+from schedule_engine import cccv, ccr, ccp, idle, repeat, schedulerunner, run_schedule
 
 ############# Experiment Parameters ################
 CCCV_CHARGE_CURRENT = 1.5       #CC Phase current of CCCV charge in Ampere
@@ -11,6 +17,7 @@ CUTOFF_VOLTAGE = 1.5             #Minimum Voltage of the Battery Cell according
 
 IDLE_BEFORE_HPPC_START = 1200    #Rest Time after CCCV charge and before first HPPC Pulses
 
+HPPC_STEPS = 10                     #Number of HPPC pulse pairs with subsequent step discharge
 HPPC_DISCHARGE_PULSE_CURRENT = -0.75 #Current of the HPPC Discharge Pulse in Ampere (must be negative)
 HPPC_DISCHARGE_PULSE_DURATION = 10  #Duration of the HPPC discharge pulse in seconds
 HPPC_DISCHARGE_PULSE_PAUSE = 40     #Pause between Discharge and subsequent charge pulse in seconds
@@ -20,81 +27,63 @@ HPPC_CHARGE_PULSE_PAUSE = 40        #Pause between charge pulse and step dischar
 HPPC_STEP_DISCHARGE_CURRENT = -1.0  #Discharge current during the step discharge in ampere (must be negative)
 HPPC_STEP_DISCHARGE_TIME = 540     #Discharge time for step discharge in seconds
 HPPC_REST_AFTER_STEP = 1200         #Rest time after a discharge step in seconds
+HPPC_SOC_STEP = None                #SoC change of a step discharge (e.g. 0.1), the step discharge ends on the estimated SoC (see soc_estimator.py). None uses HPPC_STEP_DISCHARGE_TIME
+SOC_STEP_TIMEOUT = 3600             #Maximum duration of a step discharge that ends on the SoC in seconds
+CELL_CAPACITY = 1.5                 #Nominal capacity of the cell in Ah for the SoC estimator
 
+LOG_ECHO_INTERVAL = 1.0            #Print a sample to the console at most every LOG_ECHO_INTERVAL seconds (None disables it)
+LOG_FORMATS = ("csv",)              #Log formats of the experiment, add "bin" to also write the binary format of binary_log.py
+LOG_DEADBAND = None                 #(voltage V, current A, max. interval s) of a deadband that logs rests only on changes, e.g. (0.002, 0.02, 10.0). None logs every sample
+METRICS_FILE = None                 #Path of a json file with timing metrics of the acquisition loop (see tester_metrics.py), None disables them
+TELEMETRY_PORT = None               #TCP port of the local http endpoint with live data (see telemetry.py), None disables it
+BINARY_PROTOCOL = None              #(samples per frame, sample interval in ms) of the binary protocol, e.g. (5, 20) for faster pulse edges. None uses ascii lines
+ANOMALY_ACTION = "flag"             #Reaction on faults found by anomaly_detector.py: "flag" only prints them, "step" ends the step (the test on stalls), None disables the detector
 #####################################################
 
 comport = Serial.Serial(port="COM6",baudrate=115200)
 logfile = "./hppc_test_hakadi1500mah_3-1-low-pulse.csv" #Path of logfile for the experiment
 
-running = True
-bat_tester = hppc_tester.tester(comport)
+bat_tester = hppc_tester.tester(comport, metrics=None if METRICS_FILE is None else tester_metrics.metrics(METRICS_FILE))
+if(BINARY_PROTOCOL is not None and not bat_tester.enable_binary(*BINARY_PROTOCOL)):
+    print("binary protocol not supported by the firmware, using ascii lines")
 
-instructionpointer = 0
+bank = soc_estimator.estimatorbank(cell_model.cellparameters(capacity=CELL_CAPACITY))
+soc = bank.channel(comport.port)
+if(HPPC_SOC_STEP is None):
+    step_discharge = ccr(HPPC_STEP_DISCHARGE_CURRENT,HPPC_STEP_DISCHARGE_TIME,limits=(4.2,CUTOFF_VOLTAGE))
+else:
+    step_discharge = ccr(HPPC_STEP_DISCHARGE_CURRENT,SOC_STEP_TIMEOUT,limits=(4.2,CUTOFF_VOLTAGE),until=soc.soc_change(-HPPC_SOC_STEP))
 
-def hppcsubcycle(startoffset):
-        if((instructionpointer-startoffset) == 1):
-            bat_tester.set_voltage_limits(4.5,0.5)
-            bat_tester.start_cc_pulse(HPPC_DISCHARGE_PULSE_CURRENT,4.5,0.5,HPPC_DISCHARGE_PULSE_DURATION)
-        if((instructionpointer-startoffset) == 2):
-            bat_tester.start_idle_time(HPPC_DISCHARGE_PULSE_PAUSE)
-        if((instructionpointer-startoffset) == 3):
-            bat_tester.set_voltage_limits(4.5,0.5)
-            bat_tester.start_cc_pulse(HPPC_CHARGE_PULSE_CURRENT,4.5,0.5,HPPC_CHARGE_PULSE_DURATION)
-        if((instructionpointer-startoffset) == 4):
-            bat_tester.start_idle_time(HPPC_CHARGE_PULSE_PAUSE)
-        if((instructionpointer-startoffset) == 5):
-            bat_tester.set_voltage_limits(4.2,CUTOFF_VOLTAGE)
-            bat_tester.start_cc_regulated(HPPC_STEP_DISCHARGE_CURRENT,HPPC_STEP_DISCHARGE_TIME)
-        if((instructionpointer-startoffset) == 6):
-            bat_tester.set_voltage_limits(4.4,CUTOFF_VOLTAGE - 0.1)
-            bat_tester.start_idle_time(HPPC_REST_AFTER_STEP)
-        
-        
+hppc_subcycle = [
+    ccp(HPPC_DISCHARGE_PULSE_CURRENT,HPPC_DISCHARGE_PULSE_DURATION,4.5,0.5),
+    idle(HPPC_DISCHARGE_PULSE_PAUSE),
+    ccp(HPPC_CHARGE_PULSE_CURRENT,HPPC_CHARGE_PULSE_DURATION,4.5,0.5),
+    idle(HPPC_CHARGE_PULSE_PAUSE),
+    step_discharge,
+    idle(HPPC_REST_AFTER_STEP,limits=(4.4,CUTOFF_VOLTAGE - 0.1))
+]
 
-with open(logfile, 'a') as f:
-    f.write("step,mode,time,voltage,current\n")
+steps = [
+    cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT,limits=(CCCV_CHARGE_VOLTAGE+0.1,CUTOFF_VOLTAGE-0.1)),
+    idle(IDLE_BEFORE_HPPC_START),
+    repeat(hppc_subcycle,count=HPPC_STEPS),
+    ccr(HPPC_STEP_DISCHARGE_CURRENT,HPPC_STEP_DISCHARGE_TIME,limits=(CCCV_CHARGE_VOLTAGE,CUTOFF_VOLTAGE)),
+    cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT,limits=(CCCV_CHARGE_VOLTAGE+0.1,CUTOFF_VOLTAGE-0.1))
+]
 
-while running:
-    #Wait for new logdata -> advance in testing scheduel
-    logdata = bat_tester.get_data()
-    
-    with open(logfile, 'a') as f:
-        f.write(str(instructionpointer) + "," + str(logdata,'utf-8').replace('\r', ""))
-    print(logdata)
-    
-    if(instructionpointer == 0):
-        instructionpointer = instructionpointer + 1
-        bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE+0.1,CUTOFF_VOLTAGE-0.1)
-        bat_tester.start_cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT)
-       
-    
-    elif(bat_tester.check_operation_complete()):
-        if(instructionpointer == 1):
-            bat_tester.start_idle_time(IDLE_BEFORE_HPPC_START)
+observers = [soc]
+runner = schedulerunner(steps)
+if(ANOMALY_ACTION is not None):
+    detector = anomaly_detector.anomalydetector(bat_tester, comport.port)
+    observers.append(detector)
+    if(ANOMALY_ACTION == "step"):
+        runner = schedulerunner(steps, abort=detector.fault(), interrupt=detector.step_fault())
+if(TELEMETRY_PORT is not None):
+    server = telemetry.telemetryserver(port=TELEMETRY_PORT)
+    observers.append(server.add_channel(comport.port))
+    server.start()
 
-        #Is this code pretty? No but it works for now
-        hppcsubcycle(1)
-        hppcsubcycle(7)
-        hppcsubcycle(13)
-        hppcsubcycle(19)
-        hppcsubcycle(25)
-        hppcsubcycle(31)
-        hppcsubcycle(37)
-        hppcsubcycle(43)
-        hppcsubcycle(49)
-        hppcsubcycle(55)
+with log_writer.open_log(logfile, LOG_FORMATS, echo_interval=LOG_ECHO_INTERVAL, deadband=LOG_DEADBAND) as log:
+    run_schedule(bat_tester, runner, log, observers)
 
-        if(instructionpointer == 62):
-            bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE,CUTOFF_VOLTAGE)
-            bat_tester.start_cc_regulated(HPPC_STEP_DISCHARGE_CURRENT,HPPC_STEP_DISCHARGE_TIME)
-        if(instructionpointer == 63):
-            bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE+0.1,CUTOFF_VOLTAGE-0.1)
-            bat_tester.start_cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT)
-        if(instructionpointer == 64):
-            bat_tester.start_idle_time(10)
-            running = False
-        instructionpointer = instructionpointer + 1
-        print(instructionpointer)
-
-
-comport.close()
\ No newline at end of file
+comport.close()
@@ -1,5 +1,7 @@
 import serial as Serial
 import time as tim
+from collections import deque
+import binary_protocol
 
 
 """
@@ -13,6 +15,18 @@ CCR: regulated current charge or discharge
 
 All functions to control the battery tester are contained inside the tester class. The constructor of the class takes a Serial object as argument
 which represents the COM port of the Arduino.
+
+The durations of all operations are measured with a clock, which is a function taking the tester as argument and returning the time in seconds:
+
+wall_clock: Time of the PC (default)
+deviceclock(): Time of the Arduino taken from time_millis of the last sample. Timing follows the samples instead of the PC scheduling and
+               recorded or simulated data (see fake_serial.py) can be processed faster than real time
+virtualclock(): Time that is advanced manually, e.g. by a simulation
+
+Optionally a tester_metrics.metrics object can be passed to the tester to measure the timing of the acquisition loop.
+
+enable_binary() switches the firmware to the binary framed protocol (see binary_protocol.py). read_sample() then returns
+the decoded samples of the frames together with an ascii line in the same format, so the log sinks don't notice the difference.
 """
 
 
@@ -23,6 +37,63 @@ operatingmodes = {
     "CCR" : "3"
 }
 
+
+def wall_clock(bat_tester):
+    """Returns the time of the PC in seconds"""
+    return tim.time()
+
+
+class deviceclock:
+    """
+    Returns the time of the Arduino in seconds. Wrap arounds of millis() or a reset of the Arduino don't let the time run backwards
+    """
+
+    def __init__(self):
+        self._last_millis = None
+        self._offset = 0
+
+    def __call__(self, bat_tester):
+        millis = bat_tester.time_millis
+        if(self._last_millis is not None and millis < self._last_millis):
+            self._offset += self._last_millis - millis
+        self._last_millis = millis
+        return (millis + self._offset) / 1000
+
+
+class virtualclock:
+    """
+    Clock that only changes if advance() or set() is called
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self, bat_tester):
+        return self.now
+
+    def advance(self, dt):
+        self.now += dt
+
+    def set(self, now):
+        self.now = now
+
+
+def parse_line(data):
+    """Parse a line of the Arduino ("mode,millis,voltage,current\\r\\n") without decoding it to str first
+
+    Returns a tuple (operatingmode, time_millis, voltage, current) or None if the line is incomplete or malformed
+    """
+    if(not data.endswith(b'\n')):
+        return None
+    values = data.split(b',')
+    if(len(values) != 4):
+        return None
+    try:
+        return (int(values[0]), int(values[1]), float(values[2]), float(values[3]))
+    except ValueError:
+        return None
+
+
 class tester:
     """
     Set Functions are used to send commands to the arduino. Might be changed to private functions in the future
@@ -46,34 +117,186 @@ class tester:
     instruction_start_time = 0
     instruction_stop_time = 0
     target_operating_mode = 0
+    target_current = 0
     uv_flag = 0
     ov_flag = 0
+    cutoff_flag = 0
+
+
+    time_millis = 0
+    rejected_lines = 0
+    timeouts = 0
+    metrics = None
 
 
-    def __init__(self, comport:Serial):
+    def __init__(self, comport:Serial, clock=wall_clock, metrics=None):
+        """
+        Keyword arguments:
+        comport -- Serial object of the Arduino (or a port of fake_serial.py)
+        clock -- Clock used for the duration of all operations (see module description)
+        metrics -- Optional tester_metrics.metrics object that measures the timing of the acquisition loop
+        """
         self._comport = comport
+        self._rx_buffer = bytearray()
+        self.clock = clock
+        self.metrics = metrics
+        self.decoder = None
+        self._frame_samples = deque()
+        self._ascii_sample_interval = None
         return
     
-    def get_data(self):
+    def _readline(self):
+        """
+        Returns the next line received from the Arduino including the line ending. Returns b"" if the COM port timed out
+        before a complete line was received, the incomplete line stays in the receive buffer.
+        The receive buffer is reused and the port is read in blocks instead of single bytes like Serial.readline() does.
+        """
+        buf = self._rx_buffer
+        start = 0
+        while True:
+            end = buf.find(b'\n', start)
+            if(end >= 0):
+                line = bytes(buf[:end + 1])
+                del buf[:end + 1]
+                return line
+            start = len(buf)
+            chunk = self._comport.read(self._comport.in_waiting or 1)
+            if(not chunk):
+                return b""
+            buf += chunk
+
+    def read_sample(self):
+        """
+        Reads one line from the Arduino based Frontend via Serial. Returns a tuple (sample, data) with sample being the
+        parsed values (operatingmode, time_millis, voltage, current) and data the raw line for the logfile.
+        Incomplete or malformed lines return (None, data) and are counted in rejected_lines. Timeouts of the COM port
+        return (None, b"") and are counted in timeouts.
         """
-        Reads Data from the Arduino based Frontend via Serial
+        if(self.decoder is not None):
+            return self._read_frame_sample()
+        metrics = self.metrics
+        if(metrics is not None):
+            start = tim.perf_counter()
+            metrics.read_started(start)
+            data = self._readline()
+            received = tim.perf_counter()
+            sample = parse_line(data)
+            metrics.sample_read(start, received, tim.perf_counter(), sample)
+        else:
+            data = self._readline()
+            sample = parse_line(data)
+        if(sample is None):
+            if(data):
+                self.rejected_lines += 1
+            else:
+                self.timeouts += 1
+            return None, data
+        self.operatingmode, self.time_millis, self.voltage, self.current = sample
+        return sample, data
+
+    def _queue_frame_samples(self, samples):
+        values = zip(samples["mode"].tolist(), samples["time"].tolist(), samples["voltage"].tolist(), samples["current"].tolist())
+        self._frame_samples.extend(zip(values, binary_protocol.format_lines(samples)))
+
+    def _read_frame_sample(self):
+        """read_sample() for the binary protocol. Returns (None, b"") if the COM port timed out before a frame was complete"""
+        metrics = self.metrics
+        if(metrics is not None):
+            start = tim.perf_counter()
+            metrics.read_started(start)
+        pending = self._frame_samples
+        while not pending:
+            chunk = self._comport.read(self._comport.in_waiting or 1)
+            if(not chunk):
+                self.timeouts += 1
+                if(metrics is not None):
+                    metrics.sample_read(start, tim.perf_counter(), tim.perf_counter(), None)
+                return None, b""
+            self.decoder.feed(chunk)
+            samples = self.decoder.decode()
+            self._queue_frame_samples(samples)
+        sample, data = pending.popleft()
+        if(metrics is not None):
+            now = tim.perf_counter()
+            metrics.sample_read(start, now, now, sample)
+        self.operatingmode, self.time_millis, self.voltage, self.current = sample
+        return sample, data
+
+    def enable_binary(self, samples_per_frame=4, sample_interval=25, timeout=3.0):
+        """Switch the firmware to the binary framed protocol. Returns False if no valid frame was received within the
+        timeout, e.g. because the firmware doesn't support it. The tester then stays in the ascii protocol.
+
+        Keyword arguments:
+        samples_per_frame -- Number of samples the firmware collects in one frame (1..8)
+        sample_interval -- Time between two samples in milliseconds
+        timeout -- Time in seconds to wait for the first frame
         """
-        data = self._comport.readline()
-        values = str(data,'utf-8').split(',')
-        self.operatingmode = int(values[0])
-        self.time_millis = int(values[1])
-        self.voltage = float(values[2])
-        self.current = float(values[3])
-        return data
+        decoder = binary_protocol.framedecoder()
+        if(self.metrics is not None and self.decoder is None):
+            self._ascii_sample_interval = self.metrics.sample_interval
+        self._comport.write(binary_protocol.enable_command(samples_per_frame, sample_interval))
+        #Ascii lines received before the switch are skipped by the decoder
+        decoder.feed(bytes(self._rx_buffer))
+        self._rx_buffer.clear()
+        deadline = tim.perf_counter() + timeout
+        while tim.perf_counter() < deadline:
+            decoder.feed(self._comport.read(self._comport.in_waiting or 1))
+            samples = decoder.decode()
+            if(len(samples)):
+                self.decoder = decoder
+                self._queue_frame_samples(samples)
+                if(self.metrics is not None):
+                    self.metrics.sample_interval = sample_interval
+                return True
+        #Firmware without binary protocol reads the command as garbage setpoints
+        self._comport.write(binary_protocol.DISABLE_COMMAND)
+        self._ascii_protocol()
+        self.set_idle()
+        return False
+
+    def disable_binary(self):
+        """Switch the firmware back to ascii lines"""
+        self._comport.write(binary_protocol.DISABLE_COMMAND)
+        self._ascii_protocol()
+
+    def _ascii_protocol(self):
+        """Reset the decoder and the expected sample interval of the metrics to the ascii protocol"""
+        self.decoder = None
+        self._frame_samples.clear()
+        if(self.metrics is not None and self._ascii_sample_interval is not None):
+            self.metrics.sample_interval = self._ascii_sample_interval
+
+    def get_data(self, max_timeouts=None):
+        """
+        Reads Data from the Arduino based Frontend via Serial and returns the next valid line as bytes.
+        Raises EOFError at the end of a replayed logfile (see fake_serial.replayport)
+
+        Keyword arguments:
+        max_timeouts -- Number of timeouts of the COM port in a row after which None is returned. None blocks until a
+                        valid line was received, i.e. forever if the Arduino doesn't send anymore
+        """
+        timeouts = 0
+        while True:
+            sample, data = self.read_sample()
+            if(sample is not None):
+                return data
+            timeouts = 0 if data else timeouts + 1
+            if(max_timeouts is not None and timeouts >= max_timeouts):
+                return None
     
 
 
+    def _send(self, command):
+        self._comport.write(bytes(command,"ascii"))
+        if(self.metrics is not None):
+            self.metrics.command_sent(int(command.split(" ", 1)[0]))
+
     def set_idle(self):
         """
         Set Arduino State Machine in IDLE State. Might change to private function in further versions
         """
         command = operatingmodes["IDLE"] + " 0.0 0.0 0.0\n"
-        self._comport.write(bytes(command,"ascii"))
+        self._send(command)
 
         return
     
@@ -82,7 +305,7 @@ class tester:
         Set Arduino State Machine in CCCV State. Might change to private function in further versions
         """
         command = operatingmodes["CCCV"] + " " + str(target_voltage) + " " + str(current_limit) + " " + str(cutoff_current) + "\n"
-        self._comport.write(bytes(command,"ascii"))
+        self._send(command)
         return
     
     def set_cc_pulse(self, current):
@@ -90,7 +313,7 @@ class tester:
         Set Arduino State Machine in CCP State. Might change to private function in further versions
         """
         command = operatingmodes["CCP"] + " 0.0 " + str(current) + " 0.0" + "\n"
-        self._comport.write(bytes(command,"ascii"))
+        self._send(command)
         return
     
     def set_cc_regulated(self,current):
@@ -98,7 +321,7 @@ class tester:
         Set Arduino State Machine in CCR State. Might change to private function in further versions
         """
         command = operatingmodes["CCR"] + " 0.0 " + str(current) + " 0.0" + "\n"
-        self._comport.write(bytes(command,"ascii"))
+        self._send(command)
         return
 
 
@@ -117,11 +340,13 @@ class tester:
         else:
             self.target_operating_mode = int(operatingmodes["CCR"])
             self.set_cc_regulated(current)
-        self.instruction_start_time = tim.time()
-        self.instruction_stop_time = tim.time() + time
+        self.target_current = current
+        self.instruction_start_time = self.clock(self)
+        self.instruction_stop_time = self.instruction_start_time + time
         self.instr_cmplt = False
         self.ov_flag = 0
         self.uv_flag = 0
+        self.cutoff_flag = 0
         
 
     def start_idle_time(self,time):
@@ -146,12 +371,14 @@ class tester:
         """
         self.set_voltage_limits(upper_voltage_limit,lower_voltage_limit)
         self.set_cc_pulse(current)
-        self.instruction_start_time = tim.time()
-        self.instruction_stop_time = tim.time() + time
+        self.instruction_start_time = self.clock(self)
+        self.instruction_stop_time = self.instruction_start_time + time
         self.instr_cmplt = False
         self.ov_flag = 0
         self.uv_flag = 0
+        self.cutoff_flag = 0
         self.target_operating_mode = int(operatingmodes["CCP"])
+        self.target_current = current
 
 
     
@@ -167,12 +394,14 @@ class tester:
         """
         self.set_cccv(target_voltage,current_limit,cutoff_current)
         self.cutoff_current = cutoff_current
-        self.instruction_start_time = tim.time()
-        self.instruction_stop_time = tim.time() + time
+        self.instruction_start_time = self.clock(self)
+        self.instruction_stop_time = self.instruction_start_time + time
         self.instr_cmplt = False
         self.ov_flag = 0
         self.uv_flag = 0
+        self.cutoff_flag = 0
         self.target_operating_mode = int(operatingmodes["CCCV"])
+        self.target_current = current_limit
 
     
     def set_voltage_limits(self, upper_limit:float, lower_limit:float):
@@ -194,13 +423,14 @@ class tester:
         if(self.target_operating_mode != self.operatingmode):
             return False
         
-        if(tim.time() > self.instruction_stop_time):
+        if(self.clock(self) > self.instruction_stop_time):
             self.instr_cmplt = True
             return True
         
         if(self.operatingmode == int(operatingmodes["CCCV"])):
             if(self.current < self.cutoff_current):
                 self.instr_cmplt = True
+                self.cutoff_flag = 1
                 print("cutoff")
                 return True
             
@@ -1,6 +1,13 @@
 import serial as Serial
 import hppc_tester
-import time
+import log_writer
+import tester_metrics
+import telemetry
+import cell_model
+import soc_estimator
+import capacity_counter
+import checkpoint
+from schedule_engine import cccv, ccr, idle, repeat, branch, schedulerunner, run_schedule
 
 ############# Experiment Parameters ################
 CCCV_CHARGE_CURRENT = 0.75    #CC Phase current of CCCV charge in Ampere
@@ -8,8 +15,6 @@ CCCV_CUTOFF_CURRENT = 0.100   #Cutoff current of CCCV charge in Ampere
 CCCV_CHARGE_VOLTAGE = 4.1     #Charge Voltage in V
 CCCV_CHARGE_TIMEOUT = 10000   #Maximum charging time if cutoff current is not reacher earlier in seconds
 
-IDLE_BEFORE_OCV_START = 3600  #Rest Time between CCCV charge and start of the pseudo OCV test in seconds
-
 OCV_DISCHARGE_CUTOFF_VOLTAGE = 1.5  #Cutoff voltage for the low C-rate discharge in V
 OCV_DISCHARGE_CURRENT = -0.5      #Discharge current for the pseudo OCV test in Ampere (must be negative and low in regards to the battery capacity)
 OCV_DISCHARGE_STEP_WAIT = 1200       #Wait time after the SoC was reduced in seconds
@@ -19,99 +24,82 @@ OCV_CHARGE_CUTOFF_VOLTAGE = 4.1     #Final charge voltage for the charge part of
 OCV_CHARGE_CURRENT = 0.5          #Charge current for the pseudo OCV test in Ampere (must be positive and low in regards to the battery capacity)
 OCV_CHARGE_STEP_WAIT = 1200          #Wait time after the SoC was increased in seconds
 OCV_CHARGE_STEP_DURATION = 540   #Duration of the charge step in seconds
+
+OCV_FINAL_CHARGE_VOLTAGE = 4.0       #Voltage at the end of a charge step after which the final charge current is used
+OCV_FINAL_CHARGE_CURRENT = 0.2       #Charge current for the last steps in Ampere to prevent an early abort due to overvoltage
+OCV_FINAL_CHARGE_STEP_DURATION = 1350 #Duration of the last charge steps in seconds
+
+OCV_SOC_STEP = None                  #SoC change of a discharge/charge step (e.g. 0.05), the steps end on the estimated SoC (see soc_estimator.py). None uses the step durations
+OCV_FINAL_CHARGE_SOC = 0.85          #Estimated SoC after which the final charge current is used (only with OCV_SOC_STEP)
+SOC_STEP_TIMEOUT = 3600              #Maximum duration of a step that ends on the SoC in seconds
+CELL_CAPACITY = 1.5                  #Nominal capacity of the cell in Ah for the SoC estimator
+
+SAFETY_VOLTAGE = 4.15            #The test is terminated immediately above this voltage
+
+LOG_ECHO_INTERVAL = 1.0            #Print a sample to the console at most every LOG_ECHO_INTERVAL seconds (None disables it)
+LOG_FORMATS = ("csv",)              #Log formats of the experiment, add "bin" to also write the binary format of binary_log.py
+LOG_DEADBAND = None                 #(voltage V, current A, max. interval s) of a deadband that logs rests only on changes, e.g. (0.002, 0.02, 10.0). None logs every sample
+METRICS_FILE = None                 #Path of a json file with timing metrics of the acquisition loop (see tester_metrics.py), None disables them
+TELEMETRY_PORT = None               #TCP port of the local http endpoint with live data (see telemetry.py), None disables it
+CHECKPOINT_INTERVAL = 60            #Time between two checkpoints in seconds. A crashed test continues at the last checkpoint when the script is restarted
 #####################################################
 
 comport = Serial.Serial(port="COM6",baudrate=115200)
 logfile = "./ocv_test_inc_2-2.csv"  #Path of the logfile for the experiment
 
-running = True
-bat_tester = hppc_tester.tester(comport)
-
-instructionpointer = 0
-dischargesteps = 0
-operatingmode = 0
-chargesteps = 0
-
-
-
-with open(logfile, 'a') as f:
-    f.write("step,mode,time,voltage,current\n")
-
-while running:
-    #Wait for new logdata -> advance in testing scheduel
-    logdata = bat_tester.get_data()
-    with open(logfile, 'a') as f:
-        f.write(str(instructionpointer) + "," + str(logdata,'utf-8').replace('\r', ""))
-    print(logdata)
-    print(logdata)
-    print(instructionpointer)
-
-    
-    if(bat_tester.voltage > OCV_CHARGE_CUTOFF_VOLTAGE):
-        upper_limit_reached = 1
-    
-    if(bat_tester.voltage < OCV_DISCHARGE_CUTOFF_VOLTAGE):
-        lower_limit_reached = 1
-
-    if(bat_tester.voltage > 4.15): #safety termination
-        bat_tester.start_idle_time(10)
-        running = False
-
-    if(instructionpointer == 0):
-        instructionpointer = instructionpointer + 1
-        bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE-0.1)
-        bat_tester.start_cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT)
-       
-    if((instructionpointer == 1) and (bat_tester.check_operation_complete())):
-        print("Enter ocv test")
-        operatingmode = 1
-        upper_limit_reached = 0
-        lower_limit_reached = 0
-
-    if(operatingmode == 1):
-
-        if(bat_tester.check_operation_complete()):
-            bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE)
-            if(bat_tester.uv_flag==1):
-                operatingmode = 2
-            elif((instructionpointer % 2) == 1):  #IDLE
-                bat_tester.start_idle_time(OCV_DISCHARGE_STEP_WAIT)
-            else: #Discharge
-                bat_tester.start_cc_regulated(OCV_DISCHARGE_CURRENT,OCV_DISCHARGE_STEP_DURATION)
-
-            instructionpointer = instructionpointer + 1
-            print(instructionpointer)
-
-    if(operatingmode == 2):
-        bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE,0.0)
-        operatingmode = 3
-        #bat_tester.start_idle_time(OCV_DISCHARGE_STEP_WAIT)
-        bat_tester.start_idle_time(10)
-        if((instructionpointer % 2) == 0):
-            instructionpointer = instructionpointer + 1
-        else:
-            instructionpointer = instructionpointer + 2
-
-        print(instructionpointer)
-
-    if(operatingmode == 3):
-        if(bat_tester.check_operation_complete()):
-            if(bat_tester.ov_flag==1):
-                operatingmode = 4
-            if((instructionpointer % 2) == 1):  #IDLE
-                bat_tester.start_idle_time(OCV_CHARGE_STEP_WAIT)
-            else: #Discharge
-                bat_tester.start_cc_regulated(OCV_CHARGE_CURRENT,OCV_CHARGE_STEP_DURATION)
-
-            if(bat_tester.voltage > 4.0): #Remap charge current for the last steps
-                OCV_CHARGE_CURRENT = 0.2
-                OCV_CHARGE_STEP_DURATION = 1350
-
-            instructionpointer = instructionpointer + 1
-            print(instructionpointer)
-
-    if(operatingmode == 4):
-        bat_tester.start_idle_time(10)
-        running = False
-
-comport.close()
\ No newline at end of file
+bat_tester = hppc_tester.tester(comport, metrics=None if METRICS_FILE is None else tester_metrics.metrics(METRICS_FILE))
+
+bank = soc_estimator.estimatorbank(cell_model.cellparameters(capacity=CELL_CAPACITY))
+soc = bank.channel(comport.port)
+
+def soc_step(current, duration):
+    if(OCV_SOC_STEP is None):
+        return ccr(current,duration)
+    return ccr(current,SOC_STEP_TIMEOUT,until=soc.soc_change(OCV_SOC_STEP if current > 0 else -OCV_SOC_STEP))
+
+discharge_steps = [
+    idle(OCV_DISCHARGE_STEP_WAIT,limits=(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE)),
+    soc_step(OCV_DISCHARGE_CURRENT,OCV_DISCHARGE_STEP_DURATION)
+]
+
+charge_steps = [
+    idle(OCV_CHARGE_STEP_WAIT),
+    soc_step(OCV_CHARGE_CURRENT,OCV_CHARGE_STEP_DURATION)
+]
+
+final_charge_steps = [
+    idle(OCV_CHARGE_STEP_WAIT),
+    soc_step(OCV_FINAL_CHARGE_CURRENT,OCV_FINAL_CHARGE_STEP_DURATION)
+]
+
+if(OCV_SOC_STEP is None):
+    final_charge_reached = lambda t: t.voltage > OCV_FINAL_CHARGE_VOLTAGE
+else:
+    final_charge_reached = soc.soc_above(OCV_FINAL_CHARGE_SOC)
+
+steps = [
+    cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT,limits=(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE-0.1)),
+    repeat(discharge_steps,until="uv"),
+    idle(10,limits=(CCCV_CHARGE_VOLTAGE,0.0)),
+    #Remap charge current for the last steps
+    repeat(charge_steps,until=lambda t: t.ov_flag == 1 or final_charge_reached(t)),
+    branch("ov",[],[repeat(final_charge_steps,until="ov")])
+]
+
+runner = schedulerunner(steps, abort=lambda t: t.voltage > SAFETY_VOLTAGE)
+counter = capacity_counter.capacitycounter(logfile.replace(".csv", "_summary.csv"))
+checkpointfile = logfile.replace(".csv", ".checkpoint")
+checkpoint.resume(checkpointfile, runner, bat_tester, [counter, soc])
+saver = checkpoint.checkpointer(checkpointfile, runner, bat_tester, [counter, soc], CHECKPOINT_INTERVAL)
+observers = [counter, soc, saver]
+if(TELEMETRY_PORT is not None):
+    server = telemetry.telemetryserver(port=TELEMETRY_PORT)
+    observers.append(server.add_channel(comport.port))
+    server.start()
+
+with log_writer.open_log(logfile, LOG_FORMATS, echo_interval=LOG_ECHO_INTERVAL, deadband=LOG_DEADBAND) as log, counter:
+    run_schedule(bat_tester, runner, log, observers)
+saver.remove()
+print(counter.summary())
+
+comport.close()
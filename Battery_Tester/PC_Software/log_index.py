@@ -0,0 +1,240 @@
+import io
+import os
+import hashlib
+import sys
+import numpy as np
+import binary_log
+import log_writer
+
+
+"""
+The Purpose of this Module is to read single steps of a log without parsing the whole file. A log is divided into
+segments, i.e. blocks of consecutive samples with the same step and mode. The index stores the row range and the byte range
+of every segment and is saved next to the log (logfile + ".idx") when the log is read for the first time. The index also
+stores the size and modification time of the log and a sha1 of the first and the last block of the indexed bytes. Later
+reads only check these: data that was appended since (e.g. by a running test) is indexed from the start of the last
+segment on, a log that was modified or replaced by another file (different blocks or a new modification time at the
+same size) is indexed again.
+
+Reading a step afterwards costs a seek and the parsing of its own lines (csv) or a slice of the memory mapped file (binary
+log), independent of the size of the log.
+
+Example (pulse 7 of an HPPC test):
+
+runs = log_index.mode_runs(log_index.load_index("hppc_test.csv"))
+pulses = runs[runs["mode"] == int(hppc_tester.operatingmodes["CCP"])]
+data = log_index.load_segments("hppc_test.csv", pulses[7:8])
+
+Usage as a script prints the index of a log:
+
+python log_index.py logfile
+"""
+
+
+INDEX_DTYPE = np.dtype([
+    ("step", "<i4"),
+    ("mode", "<i4"),
+    ("first_row", "<i8"),
+    ("rows", "<i8"),
+    ("offset", "<i8"),
+    ("length", "<i8")
+])
+
+INDEX_MAGIC = "#HKDIDX"
+INDEX_VERSION = 2
+FINGERPRINT_BLOCK = 4096
+INDEX_HEADER = "step,mode,first_row,rows,offset,length"
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+def _is_binary(path):
+    return os.path.splitext(path)[1] == ".bin"
+
+
+def _scan_csv(path, offset, first_row):
+    """Returns the segments of a csv log starting at a line beginning at offset and the number of indexed bytes"""
+    segments = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        if(offset == 0):
+            offset = len(f.readline())
+        row = first_row
+        key = None
+        for line in f:
+            if(not line.endswith(b'\n')):
+                #Incomplete last line of a running test, indexed with the next read
+                break
+            try:
+                fields = line.split(b',', 2)
+                new_key = (int(fields[0]), int(fields[1])) if len(fields) == 3 else None
+            except ValueError:
+                new_key = None
+            if(new_key is not None):
+                if(new_key != key):
+                    key = new_key
+                    segments.append([key[0], key[1], row, 0, offset, 0])
+                segments[-1][3] += 1
+                row += 1
+            if(segments):
+                #Empty lines are skipped by the csv loader and stay inside the segment
+                segments[-1][5] = offset + len(line) - segments[-1][4]
+            offset += len(line)
+    return segments, offset
+
+
+def _scan_binary(path, first_row):
+    """Returns the segments of a binary log starting at first_row and the number of indexed bytes"""
+    data = binary_log.load_binary(path)
+    header_size = log_writer.BINARY_HEADER.size
+    record_size = binary_log.RECORD_DTYPE.itemsize
+    step = np.asarray(data["step"][first_row:])
+    mode = np.asarray(data["mode"][first_row:])
+    if(len(step) == 0):
+        return [], header_size + first_row * record_size
+    starts = np.concatenate(([0], np.flatnonzero((np.diff(step) != 0) | (np.diff(mode) != 0)) + 1))
+    rows = np.diff(np.concatenate((starts, [len(step)])))
+    segments = []
+    for start, count in zip(starts.tolist(), rows.tolist()):
+        segments.append([int(step[start]), int(mode[start]), first_row + start, count,
+                         header_size + (first_row + start) * record_size, count * record_size])
+    return segments, header_size + len(data) * record_size
+
+
+def build_index(path, index=None):
+    """Index a log. Returns the index as numpy record array with INDEX_DTYPE and the number of indexed bytes
+
+    Keyword arguments:
+    path -- Path of the csv or binary log
+    index -- Index of the first part of the log. Only the part starting with its last segment is scanned again
+    """
+    keep = []
+    first_row = 0
+    offset = 0
+    if(index is not None and len(index) > 0):
+        keep = index[:-1]
+        first_row = int(index["first_row"][-1])
+        offset = int(index["offset"][-1])
+
+    if(_is_binary(path)):
+        segments, size = _scan_binary(path, first_row)
+    else:
+        segments, size = _scan_csv(path, offset, first_row)
+    new = np.array([tuple(s) for s in segments], dtype=INDEX_DTYPE)
+    return np.concatenate((np.asarray(keep, dtype=INDEX_DTYPE), new)), size
+
+
+def fingerprint(path, size):
+    """Returns the sha1 of the first and of the last FINGERPRINT_BLOCK bytes of the first size bytes of a log"""
+    with open(path, 'rb') as f:
+        head = f.read(min(size, FINGERPRINT_BLOCK))
+        f.seek(max(size - FINGERPRINT_BLOCK, 0))
+        tail = f.read(min(size, FINGERPRINT_BLOCK))
+    return hashlib.sha1(head).hexdigest(), hashlib.sha1(tail).hexdigest()
+
+
+def write_index(path, index, size, mtime_ns=0):
+    """Save the index of the log at path
+
+    Keyword arguments:
+    path -- Path of the log
+    index -- Index returned by build_index()
+    size -- Number of indexed bytes of the log
+    mtime_ns -- Modification time of the log when it was indexed
+    """
+    head, tail = fingerprint(path, size)
+    with open(index_path(path), 'w') as f:
+        f.write("%s %d %d %d %s %s\n" % (INDEX_MAGIC, INDEX_VERSION, size, mtime_ns, head, tail))
+        f.write(INDEX_HEADER + "\n")
+        for row in index:
+            f.write("%d,%d,%d,%d,%d,%d\n" % tuple(row))
+
+
+def read_index(path):
+    """Returns the saved index of the log at path and a tuple (indexed bytes, modification time, sha1 of the first
+    block, sha1 of the last block) of the log when it was indexed, or (None, None) if there is no valid index"""
+    try:
+        with open(index_path(path), 'r') as f:
+            magic, version, size, mtime_ns, head, tail = f.readline().split()
+            if(magic != INDEX_MAGIC or int(version) != INDEX_VERSION):
+                return None, None
+            f.readline()
+            index = np.loadtxt(f, delimiter=',', dtype=INDEX_DTYPE, ndmin=1)
+    except (OSError, ValueError):
+        return None, None
+    return index, (int(size), int(mtime_ns), head, tail)
+
+
+def load_index(path):
+    """Returns the index of a log. The saved index is created or updated if the log has changed"""
+    index, indexed = read_index(path)
+    stat = os.stat(path)
+    if(index is not None):
+        size, mtime_ns, head, tail = indexed
+        if(size > stat.st_size or fingerprint(path, size) != (head, tail)):
+            #The log was replaced by another file
+            index = None
+        elif(size == stat.st_size):
+            if(mtime_ns == stat.st_mtime_ns):
+                return index
+            #Modified without a change of the size, appending always makes the log larger
+            index = None
+    index, size = build_index(path, index)
+    write_index(path, index, size, stat.st_mtime_ns)
+    return index
+
+
+def mode_runs(index):
+    """Merge neighbouring segments with the same mode, e.g. to get a whole pulse (see hppc_analysis.find_pulses)
+
+    The first sample of a step still reports the mode of the previous step, so this sample is a segment of its own in
+    the index. The merged segment keeps the step of its first part.
+    """
+    if(len(index) == 0):
+        return index.copy()
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(index["mode"]) != 0) + 1))
+    runs = index[starts].copy()
+    runs["rows"] = np.add.reduceat(index["rows"], starts)
+    runs["length"] = np.add.reduceat(index["length"], starts)
+    return runs
+
+
+def load_segments(path, segments):
+    """Read the samples of the given segments (rows of the index) into a numpy record array with binary_log.RECORD_DTYPE"""
+    if(len(segments) == 0):
+        return np.zeros(0, dtype=binary_log.RECORD_DTYPE)
+    if(_is_binary(path)):
+        data = binary_log.load_binary(path)
+        return np.concatenate([data[s["first_row"]:s["first_row"] + s["rows"]] for s in segments])
+
+    chunks = []
+    with open(path, 'rb') as f:
+        for s in segments:
+            f.seek(int(s["offset"]))
+            chunks.append(f.read(int(s["length"])))
+    return np.loadtxt(io.BytesIO(b"".join(chunks)), delimiter=',', dtype=binary_log.RECORD_DTYPE, ndmin=1)
+
+
+def load_steps(path, steps, modes=None):
+    """Read only the samples of some steps of a log
+
+    Keyword arguments:
+    path -- Path of the csv or binary log
+    steps -- Step number or list of step numbers
+    modes -- Optional operating mode or list of modes (as int) the samples are limited to
+
+    Returns a numpy record array with binary_log.RECORD_DTYPE
+    """
+    index = load_index(path)
+    selected = np.isin(index["step"], np.atleast_1d(steps))
+    if(modes is not None):
+        selected &= np.isin(index["mode"], np.atleast_1d(modes))
+    return load_segments(path, index[selected])
+
+
+if __name__ == "__main__":
+    print(INDEX_HEADER)
+    for row in load_index(sys.argv[1]):
+        print("%d,%d,%d,%d,%d,%d" % tuple(row))
@@ -0,0 +1,431 @@
+import io
+import os
+import sys
+import numpy as np
+import binary_log
+import log_index
+import hppc_tester
+import hppc_analysis
+import ocv_analysis
+
+
+"""
+The Purpose of this Module is to analyse logs of any length in bounded memory. iter_chunks() reads a log in chunks of a
+fixed number of rows (numpy record arrays with binary_log.RECORD_DTYPE). Filters on the step and mode columns are
+applied with the index of log_index.py before reading: only the byte ranges of matching segments are read and parsed,
+rows that don't match are never converted.
+
+The reducers process the chunks one after another and only keep their results and the last row of the previous chunk:
+
+capacityreducer -- Charge and discharge capacity and energy of every step (like capacity_counter.capacitycounter)
+ocvreducer -- OCV-SoC curves of an incremental OCV test (like ocv_analysis.extract_ocv)
+pulsereducer -- Parameters of the pulses of an HPPC test (like hppc_analysis.analyse), only the samples of the pulses
+                are kept until they are fitted
+
+The ocvreducer and the pulsereducer need all rows of the log, the capacityreducer doesn't integrate across gaps of
+filtered rows. Example:
+
+capacity, ocv = log_stream.reduce_log("ocv_test.csv", [log_stream.capacityreducer(), log_stream.ocvreducer()])
+
+Usage as a script prints the capacity of every step:
+
+python log_stream.py logfile [chunk rows]
+"""
+
+
+DEFAULT_CHUNK_ROWS = 65536
+
+
+def _load_index(path):
+    try:
+        return log_index.load_index(path)
+    except OSError:
+        #Read only folder, the index is only kept in memory
+        return log_index.build_index(path)[0]
+
+
+def _row_ranges(index, steps=None, modes=None):
+    """Returns the selected segments of an index merged into contiguous ranges (first_row, rows, offset, length)"""
+    selected = np.ones(len(index), dtype=bool)
+    if(steps is not None):
+        selected &= np.isin(index["step"], np.atleast_1d(steps))
+    if(modes is not None):
+        selected &= np.isin(index["mode"], np.atleast_1d(modes))
+    ranges = []
+    for segment in index[selected]:
+        first_row, rows, offset, length = (int(segment["first_row"]), int(segment["rows"]), int(segment["offset"]),
+                                           int(segment["length"]))
+        if(ranges and ranges[-1][0] + ranges[-1][1] == first_row and ranges[-1][2] + ranges[-1][3] == offset):
+            ranges[-1][1] += rows
+            ranges[-1][3] += length
+        else:
+            ranges.append([first_row, rows, offset, length])
+    return ranges
+
+
+def _csv_pieces(path, ranges, block_bytes):
+    with open(path, 'rb') as f:
+        for first_row, rows, offset, length in ranges:
+            f.seek(offset)
+            remaining = length
+            rest = b""
+            while remaining > 0:
+                block = f.read(min(remaining, block_bytes))
+                if(not block):
+                    break
+                remaining -= len(block)
+                data = rest + block
+                cut = len(data) if remaining <= 0 else data.rfind(b'\n') + 1
+                rest = data[cut:]
+                if(cut > 0):
+                    yield np.loadtxt(io.BytesIO(data[:cut]), delimiter=',', dtype=binary_log.RECORD_DTYPE, ndmin=1)
+
+
+def _binary_pieces(path, ranges, chunk_rows):
+    data = binary_log.load_binary(path)
+    for first_row, rows, offset, length in ranges:
+        for start in range(first_row, first_row + rows, chunk_rows):
+            yield np.array(data[start:min(start + chunk_rows, first_row + rows)])
+
+
+def iter_chunks(path, chunk_rows=DEFAULT_CHUNK_ROWS, steps=None, modes=None):
+    """Read a log in chunks
+
+    Keyword arguments:
+    path -- Path of the csv or binary log
+    chunk_rows -- Number of rows of every chunk, the last chunk can be shorter
+    steps -- Optional step number or list of step numbers the rows are limited to
+    modes -- Optional operating mode or list of modes (as int) the rows are limited to
+
+    Yields numpy record arrays with binary_log.RECORD_DTYPE
+    """
+    ranges = _row_ranges(_load_index(path), steps, modes)
+    if(os.path.splitext(path)[1] == ".bin"):
+        pieces = _binary_pieces(path, ranges, chunk_rows)
+    else:
+        pieces = _csv_pieces(path, ranges, chunk_rows * 40)
+
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        while len(piece):
+            take = min(chunk_rows - buffered, len(piece))
+            buffer.append(piece[:take])
+            buffered += take
+            piece = piece[take:]
+            if(buffered == chunk_rows):
+                yield buffer[0] if len(buffer) == 1 else np.concatenate(buffer)
+                buffer = []
+                buffered = 0
+    if(buffered):
+        yield np.concatenate(buffer)
+
+
+def reduce_log(path, reducers, chunk_rows=DEFAULT_CHUNK_ROWS, steps=None, modes=None):
+    """Pass all chunks of a log to the reducers (objects with update(chunk) and result()). Returns the list of results"""
+    for chunk in iter_chunks(path, chunk_rows, steps, modes):
+        for reducer in reducers:
+            reducer.update(chunk)
+    return [reducer.result() for reducer in reducers]
+
+
+class _chargecounter:
+    """
+    Coulomb counting over chunks, same result as ocv_analysis.coulomb_count over the whole log
+    """
+
+    def __init__(self):
+        self.charge = 0.0
+        self._last_time = None
+        self._last_current = 0.0
+
+    def update(self, time_ms, current):
+        """Returns the charge in Ah of every row relative to the first row of the log"""
+        if(self._last_time is None):
+            charge = ocv_analysis.coulomb_count(time_ms, current)
+        else:
+            charge = ocv_analysis.coulomb_count(np.concatenate(([self._last_time], time_ms)),
+                                                np.concatenate(([self._last_current], current)))[1:]
+        charge += self.charge
+        self.charge = charge[-1]
+        self._last_time = time_ms[-1]
+        self._last_current = current[-1]
+        return charge
+
+
+class capacityreducer:
+    """
+    Charge and discharge capacity and energy of every step. The interval between two samples is counted to the step of
+    the second sample, like capacity_counter.capacitycounter does
+    """
+
+    def __init__(self, max_gap=10.0):
+        """
+        Keyword arguments:
+        max_gap -- Samples more than max_gap seconds apart (e.g. after a reset of the Arduino or filtered rows) are not integrated
+        """
+        self.max_gap = max_gap * 1000
+        self.steps = {}
+        self._last = None
+
+    def update(self, chunk):
+        step = np.asarray(chunk["step"])
+        time_ms = np.asarray(chunk["time"], dtype=np.float64)
+        voltage = np.asarray(chunk["voltage"], dtype=np.float64)
+        current = np.asarray(chunk["current"], dtype=np.float64)
+        if(len(step) == 0):
+            return
+        if(self._last is None):
+            previous = (time_ms[0], voltage[0], current[0])
+        else:
+            previous = self._last
+        all_time = np.concatenate(([previous[0]], time_ms))
+        all_current = np.concatenate(([previous[2]], current))
+        all_power = np.concatenate(([previous[1] * previous[2]], voltage * current))
+        dt = np.diff(all_time)
+        valid = (dt > 0) & (dt <= self.max_gap)
+        ah = np.where(valid, (all_current[1:] + all_current[:-1]) * dt / 7200000, 0.0)
+        wh = np.where(valid, (all_power[1:] + all_power[:-1]) * dt / 7200000, 0.0)
+        charging = ah >= 0
+
+        unique_steps, first, inverse = np.unique(step, return_index=True, return_inverse=True)
+        last = len(step) - 1 - np.unique(step[::-1], return_index=True)[1]
+        sums = [np.bincount(inverse, weights=w, minlength=len(unique_steps)) for w in
+                (np.where(charging, ah, 0.0), np.where(charging, 0.0, -ah), np.where(charging, wh, 0.0),
+                 np.where(charging, 0.0, -wh))]
+        for i, s in enumerate(unique_steps.tolist()):
+            if(s not in self.steps):
+                self.steps[s] = {"step": s, "start_time": int(time_ms[first[i]]), "end_time": 0, "charge_ah": 0.0,
+                                 "discharge_ah": 0.0, "charge_wh": 0.0, "discharge_wh": 0.0,
+                                 "start_voltage": float(voltage[first[i]]), "end_voltage": 0.0}
+            totals = self.steps[s]
+            totals["end_time"] = int(time_ms[last[i]])
+            totals["end_voltage"] = float(voltage[last[i]])
+            totals["charge_ah"] += sums[0][i]
+            totals["discharge_ah"] += sums[1][i]
+            totals["charge_wh"] += sums[2][i]
+            totals["discharge_wh"] += sums[3][i]
+        self._last = (time_ms[-1], voltage[-1], current[-1])
+
+    def result(self):
+        """Returns a list with a dict per step (keys of capacity_counter.capacitycounter.step_summary)"""
+        result = []
+        for s in sorted(self.steps):
+            totals = dict(self.steps[s])
+            totals["duration"] = (totals.pop("end_time") - totals["start_time"]) / 1000
+            result.append(totals)
+        return result
+
+
+class ocvreducer:
+    """
+    Streaming version of ocv_analysis.extract_ocv. Only the OCV points, the lowest voltage and the charge at the start of
+    every step are kept
+    """
+
+    def __init__(self, discharge_steps=None, charge_steps=None, capacity=None, discharge_threshold=-0.1,
+                 charge_threshold=0.15, grid_points=100):
+        """Keyword arguments as ocv_analysis.extract_ocv()"""
+        self.discharge_steps = discharge_steps
+        self.charge_steps = charge_steps
+        self.capacity = capacity
+        self.discharge_threshold = discharge_threshold
+        self.charge_threshold = charge_threshold
+        self.grid_points = grid_points
+
+        self._counter = _chargecounter()
+        self._last = None
+        self._step_start = {}
+        self._step_max = {}
+        self._edges = []
+        self._min_voltage = np.inf
+        self._min_step = None
+
+    def update(self, chunk):
+        step = np.asarray(chunk["step"])
+        voltage = np.asarray(chunk["voltage"], dtype=np.float64)
+        current = np.asarray(chunk["current"], dtype=np.float64)
+        if(len(step) == 0):
+            return
+        charge = self._counter.update(np.asarray(chunk["time"]), current)
+
+        lowest = int(np.argmin(voltage))
+        if(voltage[lowest] < self._min_voltage):
+            self._min_voltage = voltage[lowest]
+            self._min_step = int(step[lowest])
+
+        unique_steps, first, inverse = np.unique(step, return_index=True, return_inverse=True)
+        maxima = np.full(len(unique_steps), -np.inf)
+        np.maximum.at(maxima, inverse, charge)
+        for s, index, maximum in zip(unique_steps.tolist(), first.tolist(), maxima.tolist()):
+            if(s not in self._step_start):
+                self._step_start[s] = charge[index]
+            self._step_max[s] = max(self._step_max.get(s, -np.inf), maximum)
+
+        #Candidates for the last sample before a current jump, assigned to the parts in result()
+        if(self._last is not None):
+            step = np.concatenate(([self._last[0]], step))
+            voltage = np.concatenate(([self._last[1]], voltage))
+            current = np.concatenate(([self._last[2]], current))
+            charge = np.concatenate(([self._last[3]], charge))
+        jumps = np.diff(current)
+        for i in np.flatnonzero((jumps < self.discharge_threshold) | (jumps > self.charge_threshold)).tolist():
+            self._edges.append((int(step[i]), int(step[i + 1]), float(jumps[i]), float(charge[i]), float(voltage[i])))
+        self._last = (step[-1], voltage[-1], current[-1], charge[-1])
+
+    def _part(self, steps, threshold):
+        present = [s for s in self._step_start if steps[0] <= s <= steps[1]]
+        if(not present):
+            raise ValueError("Log doesn't contain a discharge and a charge part")
+        start = self._step_start[min(present)]
+        edges = [e for e in self._edges if steps[0] <= e[0] <= steps[1] and steps[0] <= e[1] <= steps[1] and
+                 ((threshold < 0 and e[2] < threshold) or (threshold >= 0 and e[2] > threshold))]
+        points = np.array([(e[3] - start, e[4]) for e in edges], dtype=np.float64).reshape(-1, 2)
+        return start, present, points
+
+    def result(self):
+        """Returns the dict of ocv_analysis.extract_ocv()"""
+        if(self._min_step is None):
+            raise ValueError("Log doesn't contain a discharge and a charge part")
+        discharge_steps = self.discharge_steps
+        charge_steps = self.charge_steps
+        if(discharge_steps is None):
+            discharge_steps = (2, self._min_step)
+        if(charge_steps is None):
+            charge_steps = (self._min_step + 2, max(self._step_start))
+        discharge_start, _, discharge_points = self._part(discharge_steps, self.discharge_threshold)
+        charge_start, charge_present, charge_points = self._part(charge_steps, self.charge_threshold)
+
+        capacity = self.capacity
+        if(capacity is None):
+            capacity = max(self._step_max[s] for s in charge_present) - charge_start
+        return ocv_analysis.ocv_curves((discharge_points[:, 0] + capacity) / capacity, discharge_points[:, 1],
+                                       charge_points[:, 0] / capacity, charge_points[:, 1], capacity, self.grid_points)
+
+
+class pulsereducer:
+    """
+    Streaming version of hppc_analysis.analyse. The samples of every pulse and its rest point are kept until a batch of
+    pulses is complete, which is then fitted at once
+    """
+
+    def __init__(self, capacity=None, tau_grid=hppc_analysis.DEFAULT_TAU_GRID, batch=64):
+        """
+        Keyword arguments:
+        capacity -- Cell capacity in Ah for the SoC calculation. Defaults to the charge removed after the first CCCV charge
+        tau_grid -- Time constants in seconds that are tested for the RC element
+        batch -- Number of complete pulses that are fitted together
+        """
+        self.capacity = capacity
+        self.tau_grid = tau_grid
+        self.batch = batch
+
+        self._counter = _chargecounter()
+        self._last = None
+        self._open = None
+        self._complete = []
+        self._fits = []
+        self._steps = []
+        self._rest_charge = []
+        self._started = False
+        self._skip_pulse = False
+        self._full_charge = 0.0
+        self._min_charge = np.inf
+
+    def update(self, chunk):
+        step = np.asarray(chunk["step"])
+        mode = np.asarray(chunk["mode"])
+        time_ms = np.asarray(chunk["time"])
+        voltage = np.asarray(chunk["voltage"], dtype=np.float64)
+        current = np.asarray(chunk["current"], dtype=np.float64)
+        if(len(step) == 0):
+            return
+        charge = self._counter.update(time_ms, current)
+        pulse = mode == int(hppc_tester.operatingmodes["CCP"])
+
+        columns = [step, mode, time_ms, voltage, current, charge, pulse]
+        offset = 0
+        if(self._last is not None):
+            columns = [np.concatenate(([last], column)) for last, column in zip(self._last, columns)]
+            offset = 1
+        step, mode, time_ms, voltage, current, charge, pulse = columns
+
+        edges = np.diff(pulse.astype(np.int8))
+        starts = (np.flatnonzero(edges == 1) + 1).tolist()
+        ends = (np.flatnonzero(edges == -1) + 1).tolist()
+
+        #SoC reference: last CCCV sample before the first pulse and the lowest charge after it
+        if(not self._started):
+            limit = starts[0] if starts else len(step)
+            cccv = np.flatnonzero(mode[:limit] == int(hppc_tester.operatingmodes["CCCV"]))
+            if(len(cccv)):
+                self._full_charge = float(charge[cccv[-1]])
+                self._min_charge = float(charge[cccv[-1]:].min())
+            else:
+                self._min_charge = min(self._min_charge, float(charge.min()))
+            self._started = len(starts) > 0
+        else:
+            self._min_charge = min(self._min_charge, float(charge.min()))
+
+        if(self._open is not None):
+            end = ends.pop(0) if ends else len(step)
+            self._open[1].append((time_ms[offset:end], voltage[offset:end], current[offset:end]))
+            if(end < len(step)):
+                self._close()
+        elif(self._skip_pulse or (offset == 0 and pulse[0])):
+            #The log starts with a pulse, which has no rest point
+            self._skip_pulse = not ends
+            if(ends):
+                ends.pop(0)
+        for start in starts:
+            end = ends.pop(0) if ends else len(step)
+            rest = start - 1
+            self._open = ((int(step[start]), float(charge[rest]), time_ms[rest], voltage[rest], current[rest]),
+                          [(time_ms[start:end], voltage[start:end], current[start:end])])
+            if(end < len(step)):
+                self._close()
+        self._last = [column[-1] for column in columns]
+        if(len(self._complete) >= self.batch):
+            self._fit()
+
+    def _close(self):
+        head, parts = self._open
+        self._open = None
+        self._complete.append((head, [np.concatenate(values) for values in zip(*parts)]))
+
+    def _fit(self):
+        if(not self._complete):
+            return
+        lengths = np.array([len(columns[0]) for head, columns in self._complete])
+        starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1])) + 1
+        time_ms = np.concatenate([np.concatenate(([head[2]], columns[0])) for head, columns in self._complete])
+        voltage = np.concatenate([np.concatenate(([head[3]], columns[1])) for head, columns in self._complete])
+        current = np.concatenate([np.concatenate(([head[4]], columns[2])) for head, columns in self._complete])
+        self._fits.append(hppc_analysis.fit_pulses(time_ms, voltage, current, starts, lengths, self.tau_grid))
+        self._steps.extend(head[0] for head, columns in self._complete)
+        self._rest_charge.extend(head[1] for head, columns in self._complete)
+        self._complete = []
+
+    def result(self):
+        """Returns the numpy record array with hppc_analysis.PARAMETER_DTYPE of hppc_analysis.analyse()"""
+        if(self._open is not None):
+            self._close()
+        self._fit()
+        result = np.zeros(len(self._steps), dtype=hppc_analysis.PARAMETER_DTYPE)
+        if(len(result) == 0):
+            return result
+        capacity = self.capacity
+        if(capacity is None):
+            capacity = -(self._min_charge - self._full_charge)
+        soc = 1 + (np.array(self._rest_charge) - self._full_charge) / capacity
+        fit = tuple(np.concatenate(values) for values in zip(*self._fits))
+        return hppc_analysis.fill_parameters(result, np.array(self._steps), soc, fit)
+
+
+if __name__ == "__main__":
+    chunk_rows = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CHUNK_ROWS
+    print("step,start_time,duration,charge_ah,discharge_ah,charge_wh,discharge_wh,start_voltage,end_voltage")
+    for s in reduce_log(sys.argv[1], [capacityreducer()], chunk_rows)[0]:
+        print("%d,%d,%.1f,%.6f,%.6f,%.6f,%.6f,%.4f,%.4f" % (s["step"], s["start_time"], s["duration"], s["charge_ah"],
+                                                           s["discharge_ah"], s["charge_wh"], s["discharge_wh"],
+                                                           s["start_voltage"], s["end_voltage"]))
@@ -0,0 +1,298 @@
+import os
+import struct
+from collections import deque
+import time as tim
+import hppc_tester
+
+
+"""
+The Purpose of this Module is to write the measurement logs of the test scripts. Opening and closing the logfile for every
+100ms sample of the Arduino is slow, especially if multiple channels are running on the same PC. The logsink keeps the file open
+and collects the lines in memory until one of the following conditions is met:
+
+flush_bytes: The buffered lines exceed this size in bytes
+flush_interval: The oldest buffered line is older than this time in seconds
+fsync_interval: Additionally the file is synced to disk (os.fsync) at least every fsync_interval seconds. None disables the fsync
+
+Everything that is still buffered is written when close() is called. The logsink can be used as a context manager so the
+buffer is also written if the test script is aborted with an exception or Ctrl+C.
+
+Besides the csv format, the binarysink writes the same data as fixed-width little endian records which can be memory mapped
+with numpy (see binary_log.py). The file starts with a 16 byte header followed by one 20 byte record per sample:
+
+step (int32), mode (int32), time (uint32, milliseconds), voltage (float32, V), current (float32, A)
+
+The Arduino sends a sample every 100ms, also during long rests where the values hardly change. The deadbandfilter can be put
+in front of the sinks to thin out these phases (see the class description). open_log() adds it if a deadband is given.
+"""
+
+
+LOG_HEADER = "step,mode,time,voltage,current\n"
+
+BINARY_MAGIC = b"HKDLOG"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<6sHHH4x")
+BINARY_RECORD = struct.Struct("<iiIff")
+
+
+class logsink:
+    """
+    Buffered writer for the csv logfile of a test. Lines are passed as the raw bytes returned by tester.get_data()
+    together with the current instruction pointer of the test script.
+    """
+
+    def __init__(self, path, flush_bytes=65536, flush_interval=5.0, fsync_interval=60.0, echo_interval=None):
+        """
+        Keyword arguments:
+        path -- Path of the logfile. Data is appended if the file already exists, the header is only written to new files
+        flush_bytes -- Buffer size in bytes after which the buffer is written to the file
+        flush_interval -- Maximum time in seconds a line stays in the buffer
+        fsync_interval -- Time in seconds between two os.fsync calls. None only flushes to the operating system
+        echo_interval -- Print a logged line at most every echo_interval seconds. None disables the printing
+        """
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.echo_interval = echo_interval
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._first_buffered = 0
+        self._last_sync = tim.time()
+        self._last_echo = 0
+
+        self._file = open(path, 'ab')
+        if(self._file.tell() == 0):
+            self._file.write(self._header())
+            self._file.flush()
+
+    def _header(self):
+        return bytes(LOG_HEADER, "ascii")
+
+    def _encode(self, step, line, sample):
+        return b"%d," % step + line.replace(b'\r', b"")
+
+    def write(self, step, line, sample=None):
+        """Append one sample to the log
+
+        Keyword arguments:
+        step -- Current instruction pointer of the test
+        line -- Raw line as returned by tester.get_data()
+        sample -- Optional parsed values of the line as returned by tester.read_sample()
+        """
+        now = tim.time()
+        record = self._encode(step, line, sample)
+        if(not record):
+            return
+        if(not self._buffer):
+            self._first_buffered = now
+        self._buffer.append(record)
+        self._buffered_bytes += len(record)
+
+        if(self.echo_interval is not None and (now - self._last_echo) >= self.echo_interval):
+            self._last_echo = now
+            print(str(step) + "," + str(line, 'utf-8').rstrip())
+
+        if(self._buffered_bytes >= self.flush_bytes or (now - self._first_buffered) >= self.flush_interval):
+            self.flush()
+            if(self.fsync_interval is not None and (now - self._last_sync) >= self.fsync_interval):
+                self.sync()
+
+    def flush(self):
+        """Write all buffered lines to the operating system"""
+        if(self._buffer):
+            self._file.write(b"".join(self._buffer))
+            self._buffer.clear()
+            self._buffered_bytes = 0
+        self._file.flush()
+
+    def sync(self):
+        """Flush the buffer and force the operating system to write the file to disk"""
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = tim.time()
+
+    def close(self):
+        """Write everything that is still buffered and close the file"""
+        if(self._file.closed):
+            return
+        try:
+            if(self.fsync_interval is not None):
+                self.sync()
+            else:
+                self.flush()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class binarysink(logsink):
+    """
+    Buffered writer for the binary log format. Takes the same arguments as logsink, lines that can't be parsed are not written.
+    """
+
+    def _header(self):
+        return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_HEADER.size, BINARY_RECORD.size)
+
+    def _encode(self, step, line, sample):
+        if(sample is None):
+            sample = hppc_tester.parse_line(line)
+            if(sample is None):
+                return b""
+        try:
+            return BINARY_RECORD.pack(step, sample[0], sample[1], sample[2], sample[3])
+        except struct.error:
+            return b""
+
+
+class sinkgroup:
+    """
+    Forwards every sample to multiple sinks, e.g. to write a csv and a binary log of the same test
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def write(self, step, line, sample=None):
+        for sink in self.sinks:
+            sink.write(step, line, sample)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def sync(self):
+        for sink in self.sinks:
+            sink.sync()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class deadbandfilter:
+    """
+    Reduces the logging rate during rests. In the reduced modes (IDLE by default) a sample is only written if
+
+    - the voltage or the current differs by more than the deadband from the last written sample
+    - the last written sample is older than max_interval seconds (device time)
+
+    All other modes are logged at full rate. Around every change of the mode or the step the full rate is kept as well:
+    the transition_samples samples before the change are written from a small buffer and the transition_samples samples
+    after it are always written. So the start of the relaxation after a pulse is logged completely and its slow part is
+    still logged with the resolution of the deadband.
+    """
+
+    def __init__(self, sink, voltage_deadband=0.002, current_deadband=0.02, max_interval=10.0, transition_samples=10,
+                 reduced_modes=(int(hppc_tester.operatingmodes["IDLE"]),)):
+        """
+        Keyword arguments:
+        sink -- Log sink the kept samples are written to (see open_log)
+        voltage_deadband -- Voltage change in V that is always logged
+        current_deadband -- Current change in A that is always logged
+        max_interval -- Maximum time in seconds between two logged samples
+        transition_samples -- Number of samples before and after a mode or step change that are logged at full rate
+        reduced_modes -- Operating modes (as int) in which the rate is reduced
+        """
+        self.sink = sink
+        self.voltage_deadband = voltage_deadband
+        self.current_deadband = current_deadband
+        self.max_interval = max_interval * 1000
+        self.transition_samples = transition_samples
+        self.reduced_modes = set(reduced_modes)
+        self.samples = 0
+        self.written = 0
+
+        self._last_key = None
+        self._last_written = None
+        self._full_rate = 0
+        self._held = deque(maxlen=transition_samples)
+
+    def write(self, step, line, sample=None):
+        if(sample is None):
+            sample = hppc_tester.parse_line(line)
+            if(sample is None):
+                return
+        self.samples += 1
+        key = (step, sample[0])
+        if(key != self._last_key):
+            #Change of the mode or the step: write the held samples in front of it and keep the full rate after it
+            self._last_key = key
+            self._full_rate = self.transition_samples
+            while self._held:
+                self._write(*self._held.popleft())
+        elif(self._full_rate > 0):
+            self._full_rate -= 1
+        elif(sample[0] in self.reduced_modes):
+            last = self._last_written
+            if(abs(sample[2] - last[2]) <= self.voltage_deadband and abs(sample[3] - last[3]) <= self.current_deadband
+               and (sample[1] - last[1]) < self.max_interval):
+                if(self.transition_samples > 0):
+                    self._held.append((step, line, sample))
+                return
+        self._held.clear()
+        self._write(step, line, sample)
+
+    def _write(self, step, line, sample):
+        self.written += 1
+        self._last_written = sample
+        self.sink.write(step, line, sample)
+
+    def flush(self):
+        self.sink.flush()
+
+    def sync(self):
+        self.sink.sync()
+
+    def close(self):
+        #The last sample of the test is always kept
+        if(self._held):
+            self._write(*self._held.pop())
+            self._held.clear()
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def open_log(path, formats=("csv",), deadband=None, **kwargs):
+    """Open the log sinks of a test
+
+    Keyword arguments:
+    path -- Path of the csv logfile. The binary log uses the same path with the extension .bin
+    formats -- Tuple containing "csv" and/or "bin"
+    deadband -- Optional tuple (voltage in V, current in A, max interval in s) of a deadbandfilter in front of the sinks
+    kwargs -- Passed to the constructor of each sink. Console echo is only done by the first sink
+    """
+    sinks = []
+    for log_format in formats:
+        if(log_format == "csv"):
+            sinks.append(logsink(path, **kwargs))
+        elif(log_format == "bin"):
+            sinks.append(binarysink(os.path.splitext(path)[0] + ".bin", **kwargs))
+        else:
+            raise ValueError("Unknown log format " + str(log_format))
+        kwargs["echo_interval"] = None
+
+    sink = sinks[0] if len(sinks) == 1 else sinkgroup(sinks)
+    if(deadband is not None):
+        sink = deadbandfilter(sink, deadband[0], deadband[1], deadband[2])
+    return sink
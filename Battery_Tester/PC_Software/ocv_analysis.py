@@ -0,0 +1,181 @@
+import sys
+import numpy as np
+import binary_log
+import analysis_cache
+
+
+"""
+Python port of ocv_analysis.m. Extracts the charge and discharge OCV-SoC curves from the log of an incremental OCV test
+(incremental_ocv.py) or a pseudo OCV test (pseudo_ocv_test.py). All calculations are done on whole numpy arrays:
+
+1. Coulomb counting of the discharge and the charge part with the trapezoidal rule (cumsum)
+2. Detection of the start of every charge/discharge step by a jump of the current (diff)
+3. The voltage at the end of the preceding rest is used as OCV at the SoC of this point
+4. Interpolation of the OCV points onto a common SoC grid and calculation of the hysteresis
+
+The discharge part is expected to start with a full cell and the charge part with an empty cell. Without a given capacity
+the charge throughput of the charge part is used, as done in ocv_analysis.m. For a pseudo OCV test the continuous low
+current curves are used directly instead of OCV points (see pseudo_ocv()).
+
+Usage as a script:
+
+python ocv_analysis.py logfile.csv [output.csv]
+"""
+
+
+def coulomb_count(time_ms, current):
+    """Returns the charge in Ah relative to the first sample (trapezoidal rule, charge current is positive)"""
+    dt = np.diff(time_ms.astype(np.float64)) / 1000
+    increments = (current[1:] + current[:-1]) * dt / 7200
+    charge = np.empty(len(current), dtype=np.float64)
+    charge[0] = 0.0
+    np.cumsum(increments, out=charge[1:])
+    return charge
+
+
+def find_split(step, voltage):
+    """Returns the step of the discharge part in which the lowest voltage was reached (last discharge step)"""
+    return int(step[np.argmin(voltage)])
+
+
+def step_edges(current, threshold):
+    """Returns the indices of the last sample before the current changes by more than threshold (negative threshold for discharge steps)"""
+    jumps = np.diff(current)
+    if(threshold < 0):
+        return np.flatnonzero(jumps < threshold)
+    return np.flatnonzero(jumps > threshold)
+
+
+def _interp(soc, ocv, grid):
+    order = np.argsort(soc)
+    return np.interp(grid, soc[order], ocv[order], left=np.nan, right=np.nan)
+
+
+def extract_ocv(data, discharge_steps=None, charge_steps=None, capacity=None, discharge_threshold=-0.1,
+                charge_threshold=0.15, grid_points=100):
+    """Extract the OCV-SoC relationship of an incremental OCV test
+
+    Keyword arguments:
+    data -- Log as numpy record array (see binary_log.load_log)
+    discharge_steps -- Tuple (first, last) of the steps belonging to the discharge part. Defaults to step 2 up to the step with the lowest voltage
+    charge_steps -- Tuple (first, last) of the steps belonging to the charge part. Defaults to all steps after the discharge part and the following short rest
+    capacity -- Cell capacity in Ah used for the SoC. Defaults to the charge throughput of the charge part
+    discharge_threshold -- Current change in A that marks the start of a discharge step
+    charge_threshold -- Current change in A that marks the start of a charge step
+    grid_points -- Number of SoC points between 0 and 1 for the interpolated curves
+
+    Returns a dict with the interpolated curves (soc, ocv_discharge, ocv_charge, hysteresis), the measured points
+    (soc_discharge_points, ocv_discharge_points, soc_charge_points, ocv_charge_points) and the capacity
+    """
+    step = np.asarray(data["step"])
+    time_ms = np.asarray(data["time"])
+    voltage = np.asarray(data["voltage"], dtype=np.float64)
+    current = np.asarray(data["current"], dtype=np.float64)
+
+    if(discharge_steps is None or charge_steps is None):
+        last_discharge_step = find_split(step, voltage)
+        if(discharge_steps is None):
+            discharge_steps = (2, last_discharge_step)
+        if(charge_steps is None):
+            charge_steps = (last_discharge_step + 2, int(step.max()))
+
+    discharge = (step >= discharge_steps[0]) & (step <= discharge_steps[1])
+    charge = (step >= charge_steps[0]) & (step <= charge_steps[1])
+    if(not discharge.any() or not charge.any()):
+        raise ValueError("Log doesn't contain a discharge and a charge part")
+
+    discharged = coulomb_count(time_ms[discharge], current[discharge])
+    charged = coulomb_count(time_ms[charge], current[charge])
+    if(capacity is None):
+        capacity = charged.max()
+
+    soc_discharge = (discharged + capacity) / capacity
+    soc_charge = charged / capacity
+
+    discharge_edges = step_edges(current[discharge], discharge_threshold)
+    charge_edges = step_edges(current[charge], charge_threshold)
+
+    ocv_discharge_points = voltage[discharge][discharge_edges]
+    soc_discharge_points = soc_discharge[discharge_edges]
+    ocv_charge_points = voltage[charge][charge_edges]
+    soc_charge_points = soc_charge[charge_edges]
+    return ocv_curves(soc_discharge_points, ocv_discharge_points, soc_charge_points, ocv_charge_points, capacity, grid_points)
+
+
+def ocv_curves(soc_discharge_points, ocv_discharge_points, soc_charge_points, ocv_charge_points, capacity, grid_points=100):
+    """Interpolate the OCV points onto a common SoC grid. Returns the dict of extract_ocv()"""
+    grid = np.linspace(0, 1, grid_points)
+    ocv_discharge = _interp(soc_discharge_points, ocv_discharge_points, grid)
+    ocv_charge = _interp(soc_charge_points, ocv_charge_points, grid)
+
+    return {
+        "soc": grid,
+        "ocv_discharge": ocv_discharge,
+        "ocv_charge": ocv_charge,
+        "hysteresis": ocv_charge - ocv_discharge,
+        "soc_discharge_points": soc_discharge_points,
+        "ocv_discharge_points": ocv_discharge_points,
+        "soc_charge_points": soc_charge_points,
+        "ocv_charge_points": ocv_charge_points,
+        "capacity": capacity
+    }
+
+
+def pseudo_ocv(data, discharge_step=3, charge_step=4, capacity=None, grid_points=100):
+    """Extract the pseudo OCV curves of a low current test (pseudo_ocv_test.py)
+
+    Keyword arguments:
+    data -- Log as numpy record array (see binary_log.load_log)
+    discharge_step -- Step of the low current discharge
+    charge_step -- Step of the low current charge
+    capacity -- Cell capacity in Ah. Defaults to the charge throughput of the charge step
+    grid_points -- Number of SoC points between 0 and 1
+
+    Returns a dict with the same curves as extract_ocv() (soc, ocv_discharge, ocv_charge, hysteresis) and the capacity
+    """
+    step = np.asarray(data["step"])
+    time_ms = np.asarray(data["time"])
+    voltage = np.asarray(data["voltage"], dtype=np.float64)
+    current = np.asarray(data["current"], dtype=np.float64)
+
+    discharge = step == discharge_step
+    charge = step == charge_step
+    if(not discharge.any() or not charge.any()):
+        raise ValueError("Log doesn't contain the discharge and charge step")
+
+    discharged = coulomb_count(time_ms[discharge], current[discharge])
+    charged = coulomb_count(time_ms[charge], current[charge])
+    if(capacity is None):
+        capacity = charged.max()
+
+    grid = np.linspace(0, 1, grid_points)
+    ocv_discharge = _interp((discharged + capacity) / capacity, voltage[discharge], grid)
+    ocv_charge = _interp(charged / capacity, voltage[charge], grid)
+    return {
+        "soc": grid,
+        "ocv_discharge": ocv_discharge,
+        "ocv_charge": ocv_charge,
+        "hysteresis": ocv_charge - ocv_discharge,
+        "capacity": capacity
+    }
+
+
+def analyse_file(path, **kwargs):
+    """extract_ocv() of a logfile, keyword arguments are passed to extract_ocv()"""
+    return extract_ocv(binary_log.load_log(path), **kwargs)
+
+
+def write_table(path, result):
+    """Write the interpolated OCV-SoC table of extract_ocv() or pseudo_ocv() as csv"""
+    table = np.column_stack((result["soc"], result["ocv_discharge"], result["ocv_charge"], result["hysteresis"]))
+    np.savetxt(path, table, delimiter=',', fmt="%.5f", header="soc,ocv_discharge,ocv_charge,hysteresis", comments="")
+
+
+if __name__ == "__main__":
+    result = analysis_cache.analysiscache().call(analyse_file, sys.argv[1])
+    print("capacity: %.4f Ah" % result["capacity"])
+    if(len(sys.argv) > 2):
+        write_table(sys.argv[2], result)
+    else:
+        for soc, dis, cha, hys in zip(result["soc"], result["ocv_discharge"], result["ocv_charge"], result["hysteresis"]):
+            print("%.2f,%.4f,%.4f,%.4f" % (soc, dis, cha, hys))
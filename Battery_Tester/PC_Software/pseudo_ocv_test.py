@@ -1,6 +1,11 @@
 import serial as Serial
 import hppc_tester
-import time
+import log_writer
+import tester_metrics
+import telemetry
+import capacity_counter
+import checkpoint
+from schedule_engine import cccv, ccr, idle, schedulerunner, run_schedule
 
 ############# Experiment Parameters ################
 CCCV_CHARGE_CURRENT = 0.75    #CC Phase current of CCCV charge in Ampere
@@ -17,50 +22,40 @@ OCV_DISCHARGE_TIMEOUT = 80000       #Maximum discharge time if cutoff voltage is
 OCV_CHARGE_CUTOFF_VOLTAGE = 4.1     #Final charge voltage for the charge part of the pseudo OCV test in V
 OCV_CHARGE_CURRENT = 0.075          #Charge current for the pseudo OCV test in Ampere (must be positive and low in regards to the battery capacity)
 OCV_CHARGE_TIMEOUT = 80000          #Maximum charge time if charge voltage is not reached in seconds
+
+LOG_ECHO_INTERVAL = 1.0            #Print a sample to the console at most every LOG_ECHO_INTERVAL seconds (None disables it)
+LOG_FORMATS = ("csv",)              #Log formats of the experiment, add "bin" to also write the binary format of binary_log.py
+METRICS_FILE = None                 #Path of a json file with timing metrics of the acquisition loop (see tester_metrics.py), None disables them
+TELEMETRY_PORT = None               #TCP port of the local http endpoint with live data (see telemetry.py), None disables it
+CHECKPOINT_INTERVAL = 60            #Time between two checkpoints in seconds. A crashed test continues at the last checkpoint when the script is restarted
 #####################################################
 
 comport = Serial.Serial(port="COM6",baudrate=115200)
 logfile = "./ocv_test.csv"  #Path of the logfile for the experiment
 
-running = True
-bat_tester = hppc_tester.tester(comport)
-
-instructionpointer = 0
-
-        
-
-with open(logfile, 'a') as f:
-    f.write("step,mode,time,voltage,current\n")
-
-while running:
-    #Wait for new logdata -> advance in testing scheduel
-    logdata = bat_tester.get_data()
-    with open(logfile, 'a') as f:
-        f.write(str(instructionpointer) + "," + str(logdata,'utf-8').replace('\r', ""))
-    print(logdata)
-    print(logdata)
-    print(instructionpointer)
-    if(instructionpointer == 0):
-        instructionpointer = instructionpointer + 1
-        bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE-0.1)
-        bat_tester.start_cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT)
-       
-    
-    elif(bat_tester.check_operation_complete()):
-        if(instructionpointer == 1):
-            bat_tester.start_idle_time(IDLE_BEFORE_OCV_START)
-
-        if(instructionpointer == 2):
-            bat_tester.set_voltage_limits(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE)
-            bat_tester.start_cc_regulated(OCV_DISCHARGE_CURRENT,OCV_DISCHARGE_TIMEOUT)
-        if(instructionpointer == 3):
-            bat_tester.set_voltage_limits(OCV_CHARGE_CUTOFF_VOLTAGE,OCV_DISCHARGE_CUTOFF_VOLTAGE-0.1)
-            bat_tester.start_cc_regulated(OCV_CHARGE_CURRENT,OCV_CHARGE_TIMEOUT)
-        if(instructionpointer == 4):
-            bat_tester.start_idle_time(10)
-            running = False
-        instructionpointer = instructionpointer + 1
-        print(instructionpointer)
-
-
-comport.close()
\ No newline at end of file
+bat_tester = hppc_tester.tester(comport, metrics=None if METRICS_FILE is None else tester_metrics.metrics(METRICS_FILE))
+
+steps = [
+    cccv(CCCV_CHARGE_VOLTAGE,CCCV_CHARGE_CURRENT,CCCV_CUTOFF_CURRENT,CCCV_CHARGE_TIMEOUT,limits=(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE-0.1)),
+    idle(IDLE_BEFORE_OCV_START),
+    ccr(OCV_DISCHARGE_CURRENT,OCV_DISCHARGE_TIMEOUT,limits=(CCCV_CHARGE_VOLTAGE+0.1,OCV_DISCHARGE_CUTOFF_VOLTAGE)),
+    ccr(OCV_CHARGE_CURRENT,OCV_CHARGE_TIMEOUT,limits=(OCV_CHARGE_CUTOFF_VOLTAGE,OCV_DISCHARGE_CUTOFF_VOLTAGE-0.1))
+]
+
+runner = schedulerunner(steps)
+counter = capacity_counter.capacitycounter(logfile.replace(".csv", "_summary.csv"))
+checkpointfile = logfile.replace(".csv", ".checkpoint")
+checkpoint.resume(checkpointfile, runner, bat_tester, [counter])
+saver = checkpoint.checkpointer(checkpointfile, runner, bat_tester, [counter], CHECKPOINT_INTERVAL)
+observers = [counter, saver]
+if(TELEMETRY_PORT is not None):
+    server = telemetry.telemetryserver(port=TELEMETRY_PORT)
+    observers.append(server.add_channel(comport.port))
+    server.start()
+
+with log_writer.open_log(logfile, LOG_FORMATS, echo_interval=LOG_ECHO_INTERVAL) as log, counter:
+    run_schedule(bat_tester, runner, log, observers)
+saver.remove()
+print(counter.summary())
+
+comport.close()
@@ -0,0 +1,352 @@
+import os
+import re
+import sys
+import glob
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import binary_log
+import hppc_tester
+import analysis_cache
+from ocv_analysis import coulomb_count
+
+
+"""
+The Purpose of this Module is to compare the static capacity tests (static_capacity_test.py, static_test_* files in
+Measurement_Data/static_capacity_tests) of all cells, C-rates and repetitions at once instead of plotting them one by one.
+
+1. Cell, C-rate and repetition are parsed from the logfile name (naming convention of the README and
+   campaign.capacity_jobs, e.g. static_test_1c5-2-1.csv or static_test_05_0c5-2-3.csv with the series 05)
+2. The discharge (first CCR step with negative current) and the following recharge of every log are extracted by a
+   process pool. Every discharge curve is resampled onto a common discharged capacity grid and a common SoC grid, so all
+   runs form one 2D array (runs x grid points, NaN after the end of a run)
+3. From the run table and the 2D arrays the rate capability is calculated with whole array operations:
+   - Capacity and energy versus C-rate (mean and standard deviation of all runs with the same C-rate)
+   - Peukert fit Q = Q_cell * (I / I_ref) ^ (1 - k) with one exponent k for all cells and one Q_cell for every cell,
+     so the capacity differences between the cells don't distort the exponent
+   - Linear fits of the energy efficiency and of the mean discharge voltage versus the current (the slope of the voltage
+     is the effective DC resistance of the cell)
+   - Spread between the repetitions of the same cell and C-rate, for the capacity and along the whole voltage curve
+
+The C-rate of the filename groups the runs, all fits use the measured mean discharge current. The extracted runs
+are stored in the analysis_cache.
+
+Usage as a script (without logs all static_test_* files of Measurement_Data are used):
+
+python rate_analysis.py [output.csv] [logs...]
+"""
+
+
+DEFAULT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Measurement_Data",
+                              "static_capacity_tests")
+NAME_PATTERN = re.compile(r"static_test_(?:(?P<series>[0-9a-zA-Z]+)_)?(?P<integer>\d+)c(?P<fraction>\d*)"
+                          r"-(?P<cell>[0-9a-zA-Z]+)-(?P<repetition>\d+)(?:-[^.]*)?\.")
+
+RUN_DTYPE = np.dtype([
+    ("cell", "U16"),
+    ("series", "U16"),
+    ("repetition", "<i4"),
+    ("c_rate_name", "<f8"),
+    ("c_rate", "<f8"),
+    ("current", "<f8"),
+    ("duration", "<f8"),
+    ("capacity", "<f8"),
+    ("energy", "<f8"),
+    ("mean_voltage", "<f8"),
+    ("end_voltage", "<f8"),
+    ("charge_capacity", "<f8"),
+    ("charge_energy", "<f8"),
+    ("coulombic_efficiency", "<f8"),
+    ("energy_efficiency", "<f8")
+])
+
+
+def parse_name(path):
+    """Returns (series, cell, C-rate, repetition) of a logfile name like static_test_05_1c5-3-1.csv
+
+    The C-rate is written as in campaign.c_rate_name (0c5 -> 0.5, 1c -> 1, 1c33 -> 1.33). The series is the optional
+    part between static_test_ and the C-rate ("" if missing).
+    """
+    match = NAME_PATTERN.search(os.path.basename(path))
+    if(match is None):
+        raise ValueError(path + " doesn't follow the naming convention static_test_[series_]<C-rate>-<cell>-<repetition>")
+    c_rate = float(match.group("integer") + "." + (match.group("fraction") or "0"))
+    return match.group("series") or "", match.group("cell"), c_rate, int(match.group("repetition"))
+
+
+def _energy(time_ms, voltage, current):
+    """Returns the energy in Wh relative to the first sample (trapezoidal rule)"""
+    power = voltage * current
+    dt = np.diff(time_ms.astype(np.float64)) / 1000
+    energy = np.empty(len(power), dtype=np.float64)
+    energy[0] = 0.0
+    np.cumsum((power[1:] + power[:-1]) * dt / 7200, out=energy[1:])
+    return energy
+
+
+def extract_run(path, nominal_capacity=1.5, max_capacity=1.8, grid_points=200):
+    """Extract the discharge and the following recharge of a static capacity test
+
+    Keyword arguments:
+    path -- Logfile of static_capacity_test.py
+    nominal_capacity -- Nominal capacity of the cell in Ah, used for the measured C-rate
+    max_capacity -- End of the discharged capacity grid in Ah
+    grid_points -- Number of points of the capacity and the SoC grid
+
+    Returns a dict with the fields of RUN_DTYPE and the voltage resampled onto the capacity grid
+    (voltage_capacity, linspace(0, max_capacity, grid_points)) and the SoC grid (voltage_soc, linspace(1, 0, grid_points))
+    """
+    series, cell, c_rate_name, repetition = parse_name(path)
+    data = binary_log.load_log(path)
+    step = np.asarray(data["step"])
+    mode = np.asarray(data["mode"])
+    time_ms = np.asarray(data["time"])
+    voltage = np.asarray(data["voltage"], dtype=np.float64)
+    current = np.asarray(data["current"], dtype=np.float64)
+
+    discharge = np.flatnonzero((mode == int(hppc_tester.operatingmodes["CCR"])) & (current < 0))
+    if(len(discharge) == 0):
+        raise ValueError(path + " doesn't contain a discharge")
+    gaps = np.flatnonzero(np.diff(discharge) != 1)
+    end = discharge[gaps[0]] + 1 if len(gaps) else discharge[-1] + 1
+    selected = slice(discharge[0], end)
+
+    discharged = -coulomb_count(time_ms[selected], current[selected])
+    discharged_energy = -_energy(time_ms[selected], voltage[selected], current[selected])
+    capacity = discharged[-1]
+    energy = discharged_energy[-1]
+
+    #Recharge: the step after the discharge (CCCV charge of static_capacity_test.py)
+    recharge = np.flatnonzero((step == step[discharge[0]] + 1) & (current > 0))
+    if(len(recharge)):
+        charge_capacity = coulomb_count(time_ms[recharge], current[recharge])[-1]
+        charge_energy = _energy(time_ms[recharge], voltage[recharge], current[recharge])[-1]
+    else:
+        charge_capacity = charge_energy = np.nan
+
+    mean_current = -capacity * 3600 / ((time_ms[end - 1] - time_ms[discharge[0]]) / 1000)
+    capacity_grid = np.linspace(0, max_capacity, grid_points)
+    soc_grid = np.linspace(1, 0, grid_points)
+    return {
+        "cell": cell,
+        "series": series,
+        "repetition": repetition,
+        "c_rate_name": c_rate_name,
+        "c_rate": -mean_current / nominal_capacity,
+        "current": mean_current,
+        "duration": (time_ms[end - 1] - time_ms[discharge[0]]) / 1000,
+        "capacity": capacity,
+        "energy": energy,
+        "mean_voltage": energy / capacity,
+        "end_voltage": voltage[end - 1],
+        "charge_capacity": charge_capacity,
+        "charge_energy": charge_energy,
+        "coulombic_efficiency": capacity / charge_capacity,
+        "energy_efficiency": energy / charge_energy,
+        "voltage_capacity": np.interp(capacity_grid, discharged, voltage[selected], right=np.nan),
+        "voltage_soc": np.interp(1 - soc_grid, discharged / capacity, voltage[selected], right=np.nan)
+    }
+
+
+def extract_runs(paths, nominal_capacity=1.5, max_capacity=1.8, grid_points=200, processes=None, cache=None):
+    """Extract multiple static capacity tests in parallel
+
+    Keyword arguments:
+    paths -- List of logfiles
+    nominal_capacity, max_capacity, grid_points -- See extract_run()
+    processes -- Number of worker processes. Defaults to the number of CPUs
+    cache -- Optional analysis_cache.analysiscache, only files without a stored result are extracted
+
+    Returns a dict with the run table (RUN_DTYPE, one row per file), the names of the files, the grids and the 2D arrays
+    voltage_capacity and voltage_soc (runs x grid_points)
+    """
+    params = {"nominal_capacity": nominal_capacity, "max_capacity": max_capacity, "grid_points": grid_points}
+    results = {}
+    keys = {}
+    if(cache is not None):
+        for path in paths:
+            keys[path] = cache.key(extract_run, path, params)
+            found, result = cache.get(keys[path])
+            if(found):
+                results[path] = result
+    missing = [path for path in paths if path not in results]
+    if(missing):
+        count = len(missing)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, result in zip(missing, pool.map(extract_run, missing, [nominal_capacity] * count,
+                                                      [max_capacity] * count, [grid_points] * count)):
+                results[path] = result
+                if(cache is not None):
+                    cache.put(keys[path], result)
+
+    runs = np.zeros(len(paths), dtype=RUN_DTYPE)
+    for name in RUN_DTYPE.names:
+        runs[name] = [results[path][name] for path in paths]
+    return {
+        "files": [os.path.basename(path) for path in paths],
+        "runs": runs,
+        "capacity_grid": np.linspace(0, max_capacity, grid_points),
+        "soc_grid": np.linspace(1, 0, grid_points),
+        "voltage_capacity": np.array([results[path]["voltage_capacity"] for path in paths]).reshape(len(paths), grid_points),
+        "voltage_soc": np.array([results[path]["voltage_soc"] for path in paths]).reshape(len(paths), grid_points)
+    }
+
+
+def _group_stats(groups, count, values):
+    """Returns count, mean and standard deviation (ddof=1, NaN for single values) of values per group, NaN values are ignored
+
+    Keyword arguments:
+    groups -- Group index of every row (runs)
+    count -- Number of groups
+    values -- Array with the runs as first axis
+    """
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    n = np.zeros((count,) + values.shape[1:])
+    total = np.zeros_like(n)
+    np.add.at(n, groups, valid)
+    np.add.at(total, groups, filled)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        squares = np.zeros_like(n)
+        np.add.at(squares, groups, np.where(valid, (values - mean[groups]) ** 2, 0.0))
+        std = np.sqrt(squares / (n - 1))
+    std[n < 2] = np.nan
+    return n, mean, std
+
+
+def _linear_fit(x, y):
+    """Returns (slope, intercept) of a least squares line, NaN values are ignored"""
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if(valid.sum() < 2):
+        return np.nan, np.nan
+    slope, intercept = np.polyfit(x[valid], y[valid], 1)
+    return slope, intercept
+
+
+def peukert_fit(runs, reference_c_rate=1.0, nominal_capacity=1.5):
+    """Fit Q = Q_cell * (I / I_ref) ^ (1 - k) with one Peukert exponent k for all cells
+
+    log(Q) is linear in log(I) with an intercept for every cell, so all cells are fitted by one least squares problem.
+
+    Keyword arguments:
+    runs -- Run table of extract_runs()
+    reference_c_rate -- C-rate of the reference current I_ref
+    nominal_capacity -- Nominal capacity in Ah
+
+    Returns a dict with the exponent k, the cells, their capacity Q_cell at the reference current and the rmse of log(Q)
+    """
+    cells, cell_index = np.unique(runs["cell"], return_inverse=True)
+    log_current = np.log(-runs["current"] / (reference_c_rate * nominal_capacity))
+    design = np.zeros((len(runs), len(cells) + 1))
+    design[np.arange(len(runs)), cell_index] = 1.0
+    design[:, -1] = log_current
+    solution, _, rank, _ = np.linalg.lstsq(design, np.log(runs["capacity"]), rcond=None)
+    if(rank < design.shape[1]):
+        raise ValueError("The runs don't contain enough C-rates for a Peukert fit")
+    residual = np.log(runs["capacity"]) - design @ solution
+    return {
+        "k": 1 - solution[-1],
+        "cells": cells,
+        "capacity": np.exp(solution[:-1]),
+        "rmse": float(np.sqrt(np.mean(residual ** 2)))
+    }
+
+
+def rate_capability(result, nominal_capacity=1.5, reference_c_rate=1.0):
+    """Calculate the rate capability of all runs of extract_runs()
+
+    Keyword arguments:
+    result -- Return value of extract_runs()
+    nominal_capacity -- Nominal capacity in Ah
+    reference_c_rate -- C-rate of the reference capacity of the Peukert fit
+
+    Runs are grouped by the C-rate of their filename, the tables report the measured mean C-rate of every group.
+
+    Returns a dict with
+    c_rates -- Table of every C-rate (c_rate_name, c_rate, runs, capacity, capacity_std, energy, energy_std, mean_voltage, energy_efficiency)
+    peukert -- Return value of peukert_fit()
+    efficiency_fit -- (slope per A, efficiency at 0 A) of the energy efficiency
+    voltage_fit -- (slope in V per A, voltage at 0 A) of the mean discharge voltage, -slope is the effective DC resistance
+    repeats -- Table of every cell and C-rate with repetitions (cell, c_rate, runs, capacity_std, max_voltage_std, mean_voltage_std)
+    voltage_capacity_mean, voltage_capacity_std -- Mean curve of every C-rate on the capacity grid (C-rates x grid points)
+    """
+    runs = result["runs"]
+    c_rates, rate_index = np.unique(runs["c_rate_name"], return_inverse=True)
+    scalars = np.column_stack((runs["c_rate"], runs["capacity"], runs["energy"], runs["mean_voltage"],
+                               runs["energy_efficiency"]))
+    n, mean, std = _group_stats(rate_index, len(c_rates), scalars)
+    _, curve_mean, curve_std = _group_stats(rate_index, len(c_rates), result["voltage_capacity"])
+
+    rate_table = np.zeros(len(c_rates), dtype=[("c_rate_name", "<f8"), ("c_rate", "<f8"), ("runs", "<i4"), ("capacity", "<f8"),
+                                               ("capacity_std", "<f8"), ("energy", "<f8"), ("energy_std", "<f8"),
+                                               ("mean_voltage", "<f8"), ("energy_efficiency", "<f8")])
+    rate_table["c_rate_name"] = c_rates
+    rate_table["c_rate"] = mean[:, 0]
+    rate_table["runs"] = n[:, 0]
+    rate_table["capacity"], rate_table["capacity_std"] = mean[:, 1], std[:, 1]
+    rate_table["energy"], rate_table["energy_std"] = mean[:, 2], std[:, 2]
+    rate_table["mean_voltage"] = mean[:, 3]
+    rate_table["energy_efficiency"] = mean[:, 4]
+
+    #Repetitions: runs of the same cell at the same C-rate
+    pairs, pair_index = np.unique(np.rec.fromarrays((runs["cell"], runs["c_rate_name"])), return_inverse=True)
+    pair_index = pair_index.reshape(-1)
+    pair_n, _, pair_std = _group_stats(pair_index, len(pairs), runs["capacity"])
+    _, _, pair_curve_std = _group_stats(pair_index, len(pairs), result["voltage_soc"])
+    repeated = pair_n >= 2
+    repeat_table = np.zeros(int(repeated.sum()), dtype=[("cell", "U16"), ("c_rate", "<f8"), ("runs", "<i4"),
+                                                        ("capacity_std", "<f8"), ("max_voltage_std", "<f8"),
+                                                        ("mean_voltage_std", "<f8")])
+    repeat_table["cell"] = pairs["f0"][repeated]
+    repeat_table["c_rate"] = pairs["f1"][repeated]
+    repeat_table["runs"] = pair_n[repeated]
+    repeat_table["capacity_std"] = pair_std[repeated]
+    with np.errstate(invalid='ignore'):
+        #The last points of the SoC grid are inside the steep end of discharge, where the curves can't be compared
+        repeat_curve_std = pair_curve_std[repeated][:, :int(0.95 * pair_curve_std.shape[1])]
+        if(repeat_curve_std.size):
+            repeat_table["max_voltage_std"] = np.nanmax(repeat_curve_std, axis=1)
+            repeat_table["mean_voltage_std"] = np.nanmean(repeat_curve_std, axis=1)
+
+    return {
+        "c_rates": rate_table,
+        "peukert": peukert_fit(runs, reference_c_rate, nominal_capacity),
+        "efficiency_fit": _linear_fit(-runs["current"], runs["energy_efficiency"]),
+        "voltage_fit": _linear_fit(-runs["current"], runs["mean_voltage"]),
+        "repeats": repeat_table,
+        "voltage_capacity_mean": curve_mean,
+        "voltage_capacity_std": curve_std
+    }
+
+
+def write_table(path, result):
+    """Write the run table of extract_runs() as csv"""
+    with open(path, 'w') as f:
+        f.write("file," + ",".join(RUN_DTYPE.names) + "\n")
+        for name, row in zip(result["files"], result["runs"]):
+            f.write(name + ",%s,%s,%d,%.2f,%.4f,%.4f,%.1f,%.5f,%.5f,%.4f,%.4f,%.5f,%.5f,%.4f,%.4f\n" % tuple(row))
+
+
+def print_report(report):
+    print("c_rate  measured  runs  capacity(Ah)  std     energy(Wh)  mean_voltage  energy_efficiency")
+    for row in report["c_rates"]:
+        print("%6.2f  %8.3f  %4d  %12.4f  %.4f  %10.4f  %12.4f  %17.4f" % (row["c_rate_name"], row["c_rate"], row["runs"],
+                                                                         row["capacity"], row["capacity_std"], row["energy"],
+                                                                         row["mean_voltage"], row["energy_efficiency"]))
+    peukert = report["peukert"]
+    print("Peukert exponent: %.4f (rmse of log(Q) %.4f)" % (peukert["k"], peukert["rmse"]))
+    for cell, capacity in zip(peukert["cells"], peukert["capacity"]):
+        print("  cell %s: %.4f Ah at the reference current" % (cell, capacity))
+    print("energy efficiency: %.4f %+.5f / A" % (report["efficiency_fit"][1], report["efficiency_fit"][0]))
+    print("mean discharge voltage: %.4f V, effective resistance %.4f Ohm" % (report["voltage_fit"][1], -report["voltage_fit"][0]))
+    print("cell  c_rate  runs  capacity_std(Ah)  max_voltage_std(V)  mean_voltage_std(V)")
+    for row in report["repeats"]:
+        print("%4s  %6.2f  %4d  %16.4f  %18.4f  %19.4f" % tuple(row))
+
+
+if __name__ == "__main__":
+    paths = sys.argv[2:] or sorted(glob.glob(os.path.join(DEFAULT_FOLDER, "static_test_*.csv")))
+    result = extract_runs(paths, cache=analysis_cache.analysiscache())
+    if(len(sys.argv) > 1):
+        write_table(sys.argv[1], result)
+    print_report(rate_capability(result))
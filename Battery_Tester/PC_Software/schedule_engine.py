@@ -0,0 +1,333 @@
+import hppc_tester
+
+
+"""
+The Purpose of this Module is to describe a test as a list of steps instead of a hand coded state machine. The steps are
+compiled once into a flat table of operations and jumps. While an operation is running, every sample only costs a single
+call of tester.check_operation_complete(). Loops and branches are only evaluated when an operation is completed.
+
+Available steps:
+
+cccv(...) -- CCCV charge (tester.start_cccv)
+ccr(...) -- regulated charge or discharge (tester.start_cc_regulated)
+ccp(...) -- unregulated current pulse (tester.start_cc_pulse)
+idle(...) -- rest time (tester.start_idle_time)
+repeat(steps, count, until) -- repeat a list of steps count times and/or until a condition is met after one of the steps
+branch(condition, then, otherwise) -- run one of two lists of steps depending on a condition
+
+Every operation can end early with an until condition, which is checked after every sample while the operation is
+running, e.g. a discharge that ends on a SoC target of soc_estimator.py instead of a fixed duration:
+
+ccr(-0.5, 36000, until=soc.soc_below(0.2))
+
+The schedulerunner additionally takes an abort condition that stops the whole test and an interrupt condition that ends
+every running operation early, e.g. the conditions of anomaly_detector.py.
+
+Conditions are evaluated with the state of the tester after the previous operation is completed. They are either a
+function taking the tester as argument or one of the following strings:
+
+"uv" -- the lower voltage limit was reached (tester.uv_flag)
+"ov" -- the upper voltage limit was reached (tester.ov_flag)
+"cutoff" -- the cutoff current of a CCCV charge was reached (tester.cutoff_flag)
+
+Example:
+
+steps = [
+    cccv(4.1, 0.75, 0.075, 10000, limits=(4.2, 1.4)),
+    repeat([idle(1200), ccr(-0.5, 540)], until="uv")
+]
+run_schedule(bat_tester, schedulerunner(steps), log)
+"""
+
+
+#Entries of the compiled schedule table
+OP = 0          #(OP, tester method, arguments, voltage limits, index of the duration in the arguments, until condition)
+JUMP = 1        #(JUMP, target)
+JUMP_IF = 2     #(JUMP_IF, condition, target)
+JUMP_IF_NOT = 3 #(JUMP_IF_NOT, condition, target)
+SET_COUNT = 4   #(SET_COUNT, counter, value)
+LOOP_COUNT = 5  #(LOOP_COUNT, counter, target) decrements the counter and jumps while it is larger than zero
+
+CONDITIONS = {
+    "uv": lambda t: t.uv_flag == 1,
+    "ov": lambda t: t.ov_flag == 1,
+    "cutoff": lambda t: t.cutoff_flag == 1
+}
+
+
+def condition(cond):
+    """Returns the condition as a function taking the tester as argument"""
+    if(callable(cond)):
+        return cond
+    if(cond in CONDITIONS):
+        return CONDITIONS[cond]
+    raise ValueError("Unknown condition " + str(cond))
+
+
+def _until(until):
+    return None if until is None else condition(until)
+
+
+def cccv(target_voltage, current_limit, cutoff_current, time, limits=None, until=None):
+    """CCCV charge. limits is an optional tuple (upper, lower) passed to tester.set_voltage_limits() before the start"""
+    return ("op", "start_cccv", (target_voltage, current_limit, cutoff_current, time), limits, 3, _until(until))
+
+
+def ccr(current, time, limits=None, until=None):
+    """Regulated charge (positive current) or discharge (negative current)"""
+    return ("op", "start_cc_regulated", (current, time), limits, 1, _until(until))
+
+
+def ccp(current, time, upper_voltage_limit, lower_voltage_limit, until=None):
+    """Unregulated current pulse"""
+    return ("op", "start_cc_pulse", (current, upper_voltage_limit, lower_voltage_limit, time),
+            (upper_voltage_limit, lower_voltage_limit), 3, _until(until))
+
+
+def idle(time, limits=None, until=None):
+    """Rest time without current"""
+    return ("op", "start_idle_time", (time,), limits, 0, _until(until))
+
+
+def repeat(steps, count=None, until=None):
+    """Repeat steps count times. If until is given, the loop is left as soon as the condition is met after any step"""
+    if(count is None and until is None):
+        raise ValueError("repeat needs a count or an until condition")
+    if(count is not None and count < 1):
+        raise ValueError("repeat count must be at least 1")
+    return ("repeat", list(steps), count, None if until is None else condition(until))
+
+
+def branch(cond, then, otherwise=()):
+    """Run the steps in then if the condition is met, otherwise the steps in otherwise"""
+    return ("branch", condition(cond), list(then), list(otherwise))
+
+
+def _contains_op(steps):
+    for s in steps:
+        if(s[0] == "op"):
+            return True
+        if(s[0] == "repeat" and _contains_op(s[1])):
+            return True
+        if(s[0] == "branch" and (_contains_op(s[2]) or _contains_op(s[3]))):
+            return True
+    return False
+
+
+def _compile(steps, table, counters):
+    for s in steps:
+        kind = s[0]
+        if(kind == "op"):
+            table.append((OP, s[1], s[2], s[3], s[4], s[5]))
+
+        elif(kind == "repeat"):
+            body, count, until = s[1], s[2], s[3]
+            if(not _contains_op(body)):
+                raise ValueError("repeat without operation would never end")
+            exit_jumps = []
+            counter = None
+            if(count is not None):
+                counter = counters[0]
+                counters[0] += 1
+                table.append((SET_COUNT, counter, count))
+            loop_start = len(table)
+            for body_step in body:
+                _compile([body_step], table, counters)
+                if(until is not None):
+                    exit_jumps.append(len(table))
+                    table.append((JUMP_IF, until, None))
+            if(counter is not None):
+                table.append((LOOP_COUNT, counter, loop_start))
+            else:
+                table.append((JUMP, loop_start))
+            for index in exit_jumps:
+                table[index] = (JUMP_IF, until, len(table))
+
+        elif(kind == "branch"):
+            cond, then, otherwise = s[1], s[2], s[3]
+            branch_index = len(table)
+            table.append(None)
+            _compile(then, table, counters)
+            jump_index = len(table)
+            table.append(None)
+            table[branch_index] = (JUMP_IF_NOT, cond, len(table))
+            _compile(otherwise, table, counters)
+            table[jump_index] = (JUMP, len(table))
+
+        else:
+            raise ValueError("Unknown step " + str(kind))
+
+
+def compile_schedule(steps):
+    """Compile a list of steps into a flat table. Returns the table and the number of loop counters it uses"""
+    table = []
+    counters = [0]
+    _compile(steps, table, counters)
+    return table, counters[0]
+
+
+class schedulerunner:
+    """
+    Executes a compiled schedule on a tester. update() has to be called after every sample of the tester and returns
+    False after the last operation is completed. step counts the started operations and is used as instruction pointer
+    in the logfile, the first operation is therefore logged as step 1.
+    """
+
+    def __init__(self, steps, abort=None, interrupt=None):
+        """
+        Keyword arguments:
+        steps -- List of steps
+        abort -- Optional condition that is checked after every sample. The test is stopped immediately if it is met
+        interrupt -- Optional condition that is checked after every sample like the until condition of every operation.
+                     The running operation is ended and the schedule continues with the next step
+        """
+        self.table, counter_count = compile_schedule(steps)
+        self.counters = [0] * counter_count
+        self.abort = None if abort is None else condition(abort)
+        self.interrupt = None if interrupt is None else condition(interrupt)
+        self.pc = 0
+        self.step = 0
+        self.started = False
+        self.finished = False
+        self._until = None
+        self._resume = None
+
+    def update(self, tester):
+        """Advance the schedule. Returns False if the test is finished"""
+        if(self.finished):
+            return False
+
+        if(self.abort is not None and self.abort(tester)):
+            print("abort")
+            return self._finish(tester)
+
+        if(self._resume is not None):
+            method, args, limits, remaining = self._resume
+            self._resume = None
+            tester.set_voltage_limits(limits[0], limits[1])
+            getattr(tester, method)(*args)
+            return True
+
+        if(self.started and not tester.check_operation_complete()):
+            if((self._until is None or not self._until(tester)) and (self.interrupt is None or not self.interrupt(tester))):
+                return True
+
+        return self._advance(tester)
+
+    def _advance(self, tester):
+        table = self.table
+        while self.pc < len(table):
+            entry = table[self.pc]
+            kind = entry[0]
+            if(kind == OP):
+                if(entry[3] is not None):
+                    tester.set_voltage_limits(entry[3][0], entry[3][1])
+                getattr(tester, entry[1])(*entry[2])
+                self._until = entry[5]
+                self.pc += 1
+                self.step += 1
+                self.started = True
+                return True
+            elif(kind == JUMP):
+                self.pc = entry[1]
+            elif(kind == JUMP_IF):
+                self.pc = entry[2] if entry[1](tester) else self.pc + 1
+            elif(kind == JUMP_IF_NOT):
+                self.pc = self.pc + 1 if entry[1](tester) else entry[2]
+            elif(kind == SET_COUNT):
+                self.counters[entry[1]] = entry[2]
+                self.pc += 1
+            elif(kind == LOOP_COUNT):
+                self.counters[entry[1]] -= 1
+                self.pc = entry[2] if self.counters[entry[1]] > 0 else self.pc + 1
+
+        return self._finish(tester)
+
+    def state(self, tester):
+        """Returns the position in the schedule and the state of the running operation as dict (see checkpoint.py)"""
+        remaining = 0.0
+        limits = (tester.upper_voltage_limit, tester.lower_voltage_limit)
+        if(self._resume is not None):
+            limits = self._resume[2]
+            remaining = self._resume[3]
+        elif(self.started and not self.finished):
+            remaining = max(tester.instruction_stop_time - tester.clock(tester), 0.0)
+        return {
+            "pc": self.pc,
+            "step": self.step,
+            "counters": list(self.counters),
+            "started": self.started,
+            "finished": self.finished,
+            "remaining": remaining,
+            "upper_voltage_limit": limits[0],
+            "lower_voltage_limit": limits[1],
+            "uv_flag": tester.uv_flag,
+            "ov_flag": tester.ov_flag,
+            "cutoff_flag": tester.cutoff_flag
+        }
+
+    def restore(self, state, tester):
+        """Continue the schedule at a state returned by state(). The interrupted operation is restarted with its remaining time"""
+        if(len(state["counters"]) != len(self.counters)):
+            raise ValueError("State doesn't belong to this schedule")
+        self.pc = state["pc"]
+        self.step = state["step"]
+        self.counters = list(state["counters"])
+        self.started = state["started"]
+        self.finished = state["finished"]
+        tester.uv_flag = state["uv_flag"]
+        tester.ov_flag = state["ov_flag"]
+        tester.cutoff_flag = state["cutoff_flag"]
+        if(not self.started or self.finished):
+            return
+
+        entry = self.table[self.pc - 1]
+        if(entry[0] != OP):
+            raise ValueError("State doesn't belong to this schedule")
+        self._until = entry[5]
+        args = list(entry[2])
+        args[entry[4]] = state["remaining"]
+        #The operation is restarted with the first sample, so the clock of the tester is valid
+        self._resume = (entry[1], args, (state["upper_voltage_limit"], state["lower_voltage_limit"]), state["remaining"])
+
+    def _finish(self, tester):
+        tester.set_idle()
+        tester.target_operating_mode = int(hppc_tester.operatingmodes["IDLE"])
+        self.finished = True
+        return False
+
+
+def run_schedule(tester, runner, log, observers=()):
+    """Run the acquisition loop of a single tester until the schedule is finished
+
+    Keyword arguments:
+    tester -- hppc_tester.tester object
+    runner -- schedulerunner of the test
+    log -- Log sink (see log_writer.open_log)
+    observers -- Objects with a method observe(step, sample) that is called with every valid sample, e.g. capacity_counter.capacitycounter
+
+    The loop also ends if the port raises EOFError (end of a replayed logfile)
+    """
+    if(tester.metrics is not None):
+        log = tester.metrics.wrap_sink(log)
+    running = True
+    last_step = runner.step
+    while running:
+        #Wait for new logdata -> advance in testing scheduel
+        try:
+            sample, logdata = tester.read_sample()
+        except EOFError:
+            #End of a replayed logfile (fake_serial.replayport)
+            print("end of data")
+            break
+        if(sample is None):
+            continue
+        log.write(runner.step, logdata, sample)
+        for observer in observers:
+            observer.observe(runner.step, sample)
+        running = runner.update(tester)
+        if(runner.step != last_step):
+            last_step = runner.step
+            print(runner.step)
+    if(tester.metrics is not None and tester.metrics.path is not None):
+        tester.metrics.export()
@@ -0,0 +1,264 @@
+import math
+import threading
+import numpy as np
+import cell_model
+
+
+"""
+The Purpose of this Module is to estimate the SoC of every running cell while the test is running, so the schedule can
+end steps on SoC targets (see schedule_engine, until argument of the steps) instead of fixed durations or voltage
+heuristics.
+
+The estimator is an extended Kalman filter with the state (SoC, voltage of the RC element) of the Thevenin model of
+cell_model.py. It is split into two parts:
+
+prediction -- Coulomb counting and the RC voltage, calculated with every sample of a channel (a few scalar operations)
+correction -- Comparison of the measured voltage with OCV(SoC) + R0 * I + V_rc, calculated as numpy array operations
+              for multiple channels at once
+
+A correction is started when a channel wasn't corrected for correction_interval seconds (time of the device) and
+includes every channel that wasn't corrected for half of the interval. So there are about two corrections per interval
+independent of the number of channels and the cost per sample doesn't grow with the number of channels.
+
+The measurement noise grows with the current, because the model is less accurate under load, so the OCV correction
+mostly acts during rests and low currents. If no start SoC is given, the SoC is initialised from the OCV of the first
+sample.
+
+Example:
+
+bank = soc_estimator.estimatorbank(cell_model.cellparameters(capacity=1.5))
+soc = bank.channel("COM6")
+steps = [repeat([idle(1200), ccr(-0.5, 36000, until=soc.soc_change(-0.1))], until="uv")]
+run_schedule(bat_tester, schedulerunner(steps), log, [soc])
+"""
+
+
+class socchannel:
+    """
+    Estimator of one channel, used as observer of the acquisition loop. The state is kept in the arrays of the bank
+    """
+
+    def __init__(self, bank, index, name):
+        self.bank = bank
+        self.index = index
+        self.name = name
+        self.step = None
+        self.step_start_soc = None
+        self._last_time = None
+        self._last_current = 0.0
+
+    def observe(self, step, sample):
+        bank = self.bank
+        i = self.index
+        millis, voltage, current = sample[1], sample[2], sample[3]
+        with bank._lock:
+            if(self._last_time is None):
+                if(not bank.initialised[i]):
+                    bank._initialise(i, voltage, current)
+            else:
+                dt = (millis - self._last_time) / 1000
+                if(0 < dt <= bank.max_gap):
+                    bank.soc[i] += (current + self._last_current) * dt / (7200 * bank.capacity[i])
+                    a = math.exp(-dt / bank.tau)
+                    bank.v_rc[i] = a * bank.v_rc[i] + (1 - a) * bank.r1[i] * current
+                    bank.elapsed[i] += dt
+            self._last_time = millis
+            self._last_current = current
+            bank.voltage[i] = voltage
+            bank.current[i] = current
+            if(step != self.step):
+                self.step = step
+                self.step_start_soc = float(bank.soc[i])
+            if(bank.elapsed[i] >= bank.correction_interval):
+                bank._correct(bank.correction_interval / 2)
+
+    @property
+    def soc(self):
+        return float(self.bank.soc[self.index])
+
+    @property
+    def soc_std(self):
+        return math.sqrt(max(float(self.bank.p_ss[self.index]), 0.0))
+
+    def soc_below(self, target):
+        """Returns a condition for the schedule that is met when the SoC is at or below target"""
+        return lambda tester: self.bank.soc[self.index] <= target
+
+    def soc_above(self, target):
+        """Returns a condition for the schedule that is met when the SoC is at or above target"""
+        return lambda tester: self.bank.soc[self.index] >= target
+
+    def soc_change(self, delta):
+        """Returns a condition that is met when the SoC changed by delta (negative for a discharge) since the step started"""
+        if(delta < 0):
+            return lambda tester: self.step_start_soc is not None and self.bank.soc[self.index] - self.step_start_soc <= delta
+        return lambda tester: self.step_start_soc is not None and self.bank.soc[self.index] - self.step_start_soc >= delta
+
+    def set_soc(self, soc, std=0.01):
+        """Set the SoC of the channel, e.g. after a full charge"""
+        with self.bank._lock:
+            self.bank._set(self.index, soc, std)
+
+    def state(self):
+        """Returns the state of the estimator as dict (see checkpoint.py)"""
+        bank = self.bank
+        i = self.index
+        return {
+            "soc": float(bank.soc[i]),
+            "v_rc": float(bank.v_rc[i]),
+            "covariance": [float(bank.p_ss[i]), float(bank.p_sr[i]), float(bank.p_rr[i])],
+            "initialised": bool(bank.initialised[i]),
+            "step": self.step,
+            "step_start_soc": self.step_start_soc
+        }
+
+    def restore(self, state):
+        """Continue with a state returned by state()"""
+        bank = self.bank
+        i = self.index
+        with bank._lock:
+            bank.soc[i] = state["soc"]
+            bank.v_rc[i] = state["v_rc"]
+            bank.p_ss[i], bank.p_sr[i], bank.p_rr[i] = state["covariance"]
+            bank.initialised[i] = state["initialised"]
+            bank.elapsed[i] = 0.0
+            self.step = state.get("step")
+            self.step_start_soc = state["step_start_soc"]
+        #The time base of the device may differ after a restart, the next sample starts the prediction again
+        self._last_time = None
+
+    def status(self):
+        return {"name": self.name, "soc": self.soc, "soc_std": self.soc_std}
+
+
+class estimatorbank:
+    """
+    SoC estimators of multiple channels with the same cell type. The corrections of all channels are calculated together
+    """
+
+    def __init__(self, params=None, correction_interval=1.0, soc_noise=1e-4, rc_noise=1e-3, voltage_noise=0.01,
+                 current_noise=0.03, max_gap=10.0):
+        """
+        Keyword arguments:
+        params -- cell_model.cellparameters of the cell (without batch axis). The first RC element is used. Defaults to cell_model.cellparameters()
+        correction_interval -- Time between two corrections of a channel in seconds
+        soc_noise -- Process noise of the SoC per sqrt(s), e.g. offset errors of the current measurement
+        rc_noise -- Process noise of the RC voltage in V per sqrt(s)
+        voltage_noise -- Measurement noise of the voltage in V
+        current_noise -- Additional measurement noise in V per A, covers the model errors under load
+        max_gap -- Samples more than max_gap seconds apart (e.g. after a reset of the Arduino) are not integrated
+        """
+        self.params = cell_model.cellparameters() if params is None else params
+        if(self.params.batch_shape() != ()):
+            raise ValueError("The parameters of the estimator must not have a batch axis")
+        self.correction_interval = correction_interval
+        self.soc_noise = soc_noise
+        self.rc_noise = rc_noise
+        self.voltage_noise = voltage_noise
+        self.current_noise = current_noise
+        self.max_gap = max_gap
+
+        self.ocv_soc = self.params.ocv_soc
+        self.ocv = self.params.ocv
+        self.ocv_slope = np.gradient(self.ocv, self.ocv_soc)
+        _, r0, r_rc, tau = self.params.arrays(1)
+        self.r0_table = r0[0]
+        self.r1_table = r_rc[0, 0] if tau.shape[1] else np.zeros_like(r0[0])
+        self.tau = float(tau[0, 0]) if tau.shape[1] else 1.0
+
+        self.channels = {}
+        self._lock = threading.Lock()
+        self._resize(0)
+
+    def _resize(self, count):
+        old = getattr(self, "soc", np.zeros(0))
+        keep = len(old)
+        for name in ("soc", "v_rc", "p_ss", "p_sr", "p_rr", "voltage", "current", "elapsed", "capacity", "r1"):
+            array = np.zeros(count)
+            if(keep):
+                array[:keep] = getattr(self, name)
+            setattr(self, name, array)
+        initialised = np.zeros(count, dtype=bool)
+        if(keep):
+            initialised[:keep] = self.initialised
+        self.initialised = initialised
+
+    def channel(self, name, soc0=None, capacity=None):
+        """Returns the estimator of a channel, a new one is added if the name is unknown
+
+        Keyword arguments:
+        name -- Name of the channel
+        soc0 -- SoC at the start. None initialises the SoC from the OCV of the first sample
+        capacity -- Capacity of the cell in Ah. Defaults to the capacity of the parameters
+        """
+        if(name in self.channels):
+            return self.channels[name]
+        with self._lock:
+            index = len(self.channels)
+            self._resize(index + 1)
+            self.capacity[index] = float(self.params.capacity) if capacity is None else capacity
+            self.r1[index] = self._resistance(self.r1_table, np.array([1.0 if soc0 is None else soc0]))[0]
+            if(soc0 is not None):
+                self._set(index, soc0, 0.02)
+            new_channel = socchannel(self, index, name)
+            self.channels[name] = new_channel
+        return new_channel
+
+    def estimates(self):
+        """Returns a copy of the SoC of all channels in the order they were added"""
+        with self._lock:
+            return self.soc.copy()
+
+    def _resistance(self, table, soc):
+        if(len(table) == 1):
+            return np.full(len(soc), table[0])
+        return np.interp(soc, self.params.soc_grid, table)
+
+    def _set(self, i, soc, std):
+        self.soc[i] = soc
+        self.v_rc[i] = 0.0
+        self.p_ss[i] = std ** 2
+        self.p_sr[i] = 0.0
+        self.p_rr[i] = 0.05 ** 2
+        self.elapsed[i] = 0.0
+        self.initialised[i] = True
+
+    def _initialise(self, i, voltage, current):
+        r0 = self._resistance(self.r0_table, np.array([0.5]))[0]
+        self._set(i, float(np.interp(voltage - r0 * current, self.ocv, self.ocv_soc)), 0.1)
+
+    def correct(self):
+        """Correct the SoC of all channels with their last sample. Called automatically by the channels"""
+        with self._lock:
+            self._correct(0.0)
+
+    def _correct(self, min_elapsed):
+        active = np.flatnonzero(self.initialised & (self.elapsed > min_elapsed))
+        if(len(active) == 0):
+            return
+        soc = self.soc[active]
+        current = self.current[active]
+        elapsed = self.elapsed[active]
+
+        #Prediction of the covariance for the time since the last correction
+        a = np.exp(-elapsed / self.tau)
+        p_ss = self.p_ss[active] + self.soc_noise ** 2 * elapsed
+        p_sr = self.p_sr[active] * a
+        p_rr = self.p_rr[active] * a * a + self.rc_noise ** 2 * elapsed
+
+        #Measurement update with H = [dOCV/dSoC, 1]
+        h = np.interp(soc, self.ocv_soc, self.ocv_slope)
+        predicted = np.interp(soc, self.ocv_soc, self.ocv) + self._resistance(self.r0_table, soc) * current + self.v_rc[active]
+        innovation = self.voltage[active] - predicted
+        noise = self.voltage_noise ** 2 + (self.current_noise * current) ** 2
+        s = h * h * p_ss + 2 * h * p_sr + p_rr + noise
+        gain_soc = (h * p_ss + p_sr) / s
+        gain_rc = (h * p_sr + p_rr) / s
+
+        self.soc[active] = np.clip(soc + gain_soc * innovation, self.ocv_soc[0] - 0.1, self.ocv_soc[-1] + 0.1)
+        self.v_rc[active] += gain_rc * innovation
+        self.p_ss[active] = p_ss - gain_soc * (h * p_ss + p_sr)
+        self.p_sr[active] = p_sr - gain_soc * (h * p_sr + p_rr)
+        self.p_rr[active] = p_rr - gain_rc * (h * p_sr + p_rr)
+        self.r1[active] = self._resistance(self.r1_table, self.soc[active])
+        self.elapsed[active] = 0.0
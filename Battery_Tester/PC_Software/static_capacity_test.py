@@ -1,6 +1,6 @@
-import serial as Serial
-import hppc_tester
-import time
+import channel_manager
+import campaign
+from schedule_engine import cccv, ccr
 
 ############# Experiment Parameters ################
 CHARGE_CURRENT = 0.75   #CC Phase current of CCCV charge in Ampere
@@ -9,132 +9,44 @@ CHARGE_VOLTAGE = 4.1    #Charge Voltage in V
 CHARGE_TIMEOUT = 10000  #Maximum charging time if cutoff current is not reacher earlier in seconds
 
 DISCHARGE_CUTOFF_VOLTAGE = 1.5  #Cutoff voltage for the constant current discharge in V
-DISCHARGE_CURRENT = -1.5       #Discharge current in Ampere (must be negative)
 DISCHARGE_TIMEOUT = 60000       #Maximum discharge time in seconds
-#####################################################
-
-comport = Serial.Serial(port="COM6",baudrate=115200)
-logfile = "./static_test_05_1c-3-1.csv" #Path of the logfile for the experiment
-
-running = True
-bat_tester = hppc_tester.tester(comport)
-
-instructionpointer = 0
-
-with open(logfile, 'a') as f:
-    f.write("step,mode,time,voltage,current\n")
-
-while running:
-    #Wait for new logdata -> advance in testing scheduel
-    logdata = bat_tester.get_data()
-    with open(logfile, 'a') as f:
-        f.write(str(instructionpointer) + "," + str(logdata,'utf-8').replace('\r', ""))
-    print(logdata)
-    
-    if(instructionpointer == 0):
-        instructionpointer = instructionpointer + 1
-        bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1 , DISCHARGE_CUTOFF_VOLTAGE - 0.1)
-        bat_tester.start_cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT)
-    
-    elif(bat_tester.check_operation_complete()):
-
-        if(instructionpointer == 1):
-            bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1, DISCHARGE_CUTOFF_VOLTAGE)
-            bat_tester.start_cc_regulated(DISCHARGE_CURRENT,DISCHARGE_TIMEOUT)
-        if(instructionpointer == 2):
-            bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1 , DISCHARGE_CUTOFF_VOLTAGE - 0.1)
-            bat_tester.start_cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT)
-        if(instructionpointer == 3):
-            bat_tester.start_idle_time(10)
-            running = False
-        instructionpointer = instructionpointer + 1
-        print(instructionpointer)
-
-
-comport.close()
-time.sleep(1200) # wait 20min between runs
-
-DISCHARGE_CURRENT = -2.25
-
-comport = Serial.Serial(port="COM6",baudrate=115200)
-logfile = "./static_test_05_1c5-3-1.csv" #Path of the logfile for the experiment
-
-running = True
-bat_tester = hppc_tester.tester(comport)
 
-instructionpointer = 0
+REST_BETWEEN_RUNS = 1200        #Rest time of a cell between two runs in seconds
 
-with open(logfile, 'a') as f:
-    f.write("step,mode,time,voltage,current\n")
+CELL_CAPACITY = 1.5             #Nominal capacity of the cells in Ah
+CELLS = [3]                     #Cells of the test matrix
+C_RATES = [1, 1.5, 0.5]         #Discharge C-rates of the test matrix
+REPETITIONS = 1                 #Number of runs of every cell and C-rate
+LOG_PREFIX = "./static_test_05_" #Path and start of the logfile names, e.g. ./static_test_05_1c5-3-1.csv
 
-while running:
-    #Wait for new logdata -> advance in testing scheduel
-    logdata = bat_tester.get_data()
-    with open(logfile, 'a') as f:
-        f.write(str(instructionpointer) + "," + str(logdata,'utf-8').replace('\r', ""))
-    print(logdata)
-    
-    if(instructionpointer == 0):
-        instructionpointer = instructionpointer + 1
-        bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1 , DISCHARGE_CUTOFF_VOLTAGE - 0.1)
-        bat_tester.start_cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT)
-    
-    elif(bat_tester.check_operation_complete()):
-
-        if(instructionpointer == 1):
-            bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1, DISCHARGE_CUTOFF_VOLTAGE)
-            bat_tester.start_cc_regulated(DISCHARGE_CURRENT,DISCHARGE_TIMEOUT)
-        if(instructionpointer == 2):
-            bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1 , DISCHARGE_CUTOFF_VOLTAGE - 0.1)
-            bat_tester.start_cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT)
-        if(instructionpointer == 3):
-            bat_tester.start_idle_time(10)
-            running = False
-        instructionpointer = instructionpointer + 1
-        print(instructionpointer)
-
-
-comport.close()
-time.sleep(1200) # wait 20min between runs
-
-DISCHARGE_CURRENT = -0.75
-
-comport = Serial.Serial(port="COM6",baudrate=115200)
-logfile = "./static_test_05_0c5-3-1.csv" #Path of the logfile for the experiment
-
-running = True
-bat_tester = hppc_tester.tester(comport)
-
-instructionpointer = 0
-
-with open(logfile, 'a') as f:
-    f.write("step,mode,time,voltage,current\n")
-
-while running:
-    #Wait for new logdata -> advance in testing scheduel
-    logdata = bat_tester.get_data()
-    with open(logfile, 'a') as f:
-        f.write(str(instructionpointer) + "," + str(logdata,'utf-8').replace('\r', ""))
-    print(logdata)
-    
-    if(instructionpointer == 0):
-        instructionpointer = instructionpointer + 1
-        bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1 , DISCHARGE_CUTOFF_VOLTAGE - 0.1)
-        bat_tester.start_cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT)
-    
-    elif(bat_tester.check_operation_complete()):
-
-        if(instructionpointer == 1):
-            bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1, DISCHARGE_CUTOFF_VOLTAGE)
-            bat_tester.start_cc_regulated(DISCHARGE_CURRENT,DISCHARGE_TIMEOUT)
-        if(instructionpointer == 2):
-            bat_tester.set_voltage_limits(CHARGE_VOLTAGE + 0.1 , DISCHARGE_CUTOFF_VOLTAGE - 0.1)
-            bat_tester.start_cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT)
-        if(instructionpointer == 3):
-            bat_tester.start_idle_time(10)
-            running = False
-        instructionpointer = instructionpointer + 1
-        print(instructionpointer)
+#COM port of every tester channel and the cells connected to it (None accepts every cell)
+CHANNELS = [
+    ("COM6", None)
+]
 
+LOG_ECHO_INTERVAL = 1.0            #Print a sample to the console at most every LOG_ECHO_INTERVAL seconds (None disables it)
+LOG_FORMATS = ("csv",)              #Log formats of the experiment, add "bin" to also write the binary format of binary_log.py
+#####################################################
 
-comport.close()
+def capacity_test(discharge_current):
+    return [
+        cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT,limits=(CHARGE_VOLTAGE + 0.1,DISCHARGE_CUTOFF_VOLTAGE - 0.1)),
+        ccr(discharge_current,DISCHARGE_TIMEOUT,limits=(CHARGE_VOLTAGE + 0.1,DISCHARGE_CUTOFF_VOLTAGE)),
+        cccv(CHARGE_VOLTAGE,CHARGE_CURRENT,CUTOFF_CURRENT,CHARGE_TIMEOUT,limits=(CHARGE_VOLTAGE + 0.1,DISCHARGE_CUTOFF_VOLTAGE - 0.1))
+    ]
+
+tests = campaign.campaign(rest=REST_BETWEEN_RUNS, formats=LOG_FORMATS, echo_interval=LOG_ECHO_INTERVAL)
+for port, cells in CHANNELS:
+    tests.add_channel(port, channel_manager.open_port(port), cells)
+for job in campaign.capacity_jobs(CELLS, C_RATES, REPETITIONS, CELL_CAPACITY, capacity_test, LOG_PREFIX):
+    tests.add_job(job)
+
+try:
+    tests.run()
+finally:
+    for slot in tests.slots:
+        slot.comport.close()
+
+for job in tests.jobs:
+    print(job.name(), job.summary)
+campaign.print_report(tests.report())
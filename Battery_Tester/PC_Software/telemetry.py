@@ -0,0 +1,205 @@
+import json
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+"""
+The Purpose of this Module is to show live data of running tests without printing every sample to the console. Every
+channel keeps its recent samples in a ring buffer (fixed size numpy array). The telemetrychannel is added as observer to
+the acquisition loop (see schedule_engine.run_schedule or channel_manager), so appending a sample is an assignment of one
+array row and doesn't depend on the number of subscribers.
+
+The telemetryserver serves the ring buffers of all channels over http on the local machine. The requests are answered by
+the threads of the server, which only read the ring buffers without any lock, so a slow or hanging subscriber never
+blocks an acquisition loop. Samples are numbered with a sequence number, so a subscriber can poll for the samples since
+its last request:
+
+GET /channels -- State of every channel (last sample, step and the status of the channel if available)
+GET /samples?channel=<name>&since=<seq>&every=<n>&limit=<n> -- Samples of a channel with a sequence number >= since,
+     only every n-th sample (decimation) and at most limit samples (the newest ones). The answer contains the sequence
+     number for the next request
+
+Example:
+
+server = telemetry.telemetryserver(port=8765)
+live = server.add_channel("COM6")
+server.start()
+run_schedule(bat_tester, runner, log, [live])
+server.stop()
+"""
+
+
+SAMPLE_DTYPE = np.dtype([
+    ("seq", "<i8"),
+    ("step", "<i4"),
+    ("mode", "<i4"),
+    ("time", "<u4"),
+    ("voltage", "<f4"),
+    ("current", "<f4")
+])
+
+
+class ringbuffer:
+    """
+    Fixed size buffer of the most recent samples. Only one thread may write, readers don't lock
+    """
+
+    def __init__(self, capacity=36000):
+        self.capacity = capacity
+        self.written = 0
+        self._data = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+
+    def append(self, step, sample):
+        seq = self.written
+        self._data[seq % self.capacity] = (seq, step, sample[0], sample[1], sample[2], sample[3])
+        self.written = seq + 1
+
+    def snapshot(self, since=0, every=1, limit=None):
+        """Returns a copy of the buffered samples with seq >= since (only multiples of every, at most the newest limit samples)
+        and the seq of the next sample"""
+        end = self.written
+        start = max(since, end - self.capacity, 0)
+        if(start >= end or (limit is not None and limit <= 0)):
+            return np.zeros(0, dtype=SAMPLE_DTYPE), end
+        indices = np.arange(start, end)
+        if(every > 1):
+            indices = indices[indices % every == 0]
+        if(limit is not None):
+            indices = indices[-limit:]
+        rows = self._data[indices % self.capacity]
+        #Rows that were overwritten by the writer during the copy have a newer seq than expected
+        return rows[rows["seq"] == indices], end
+
+    def last(self):
+        if(self.written == 0):
+            return None
+        return self._data[(self.written - 1) % self.capacity].copy()
+
+
+class telemetrychannel(ringbuffer):
+    """
+    Ring buffer of one channel that can be used as observer of the acquisition loop
+    """
+
+    def __init__(self, name, capacity=36000, status=None):
+        """
+        Keyword arguments:
+        name -- Name of the channel in the requests
+        capacity -- Number of samples kept, 36000 samples are one hour at 100 ms
+        status -- Optional function returning a dict with the state of the channel, e.g. channel_manager.channel.status
+        """
+        ringbuffer.__init__(self, capacity)
+        self.name = name
+        self.status = status
+
+    def observe(self, step, sample):
+        self.append(step, sample)
+
+    def state(self):
+        last = self.last()
+        result = {"name": self.name, "samples": self.written}
+        if(last is not None):
+            result.update({"step": int(last["step"]), "mode": int(last["mode"]), "time": int(last["time"]),
+                           "voltage": float(last["voltage"]), "current": float(last["current"])})
+        if(self.status is not None):
+            try:
+                result["status"] = self.status()
+            except Exception as e:
+                result["status"] = repr(e)
+        return result
+
+
+class _handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        channels = self.server.channels
+        if(url.path in ("/", "/channels")):
+            self._send(200, {"channels": [ch.state() for ch in list(channels.values())]})
+        elif(url.path == "/samples"):
+            name = query.get("channel", [None])[0]
+            if(name not in channels):
+                self._send(404, {"error": "unknown channel"})
+                return
+            try:
+                since = int(query.get("since", ["0"])[0])
+                every = max(int(query.get("every", ["1"])[0]), 1)
+                limit = int(query["limit"][0]) if "limit" in query else None
+                if(limit is not None and limit < 0):
+                    raise ValueError("negative limit")
+            except ValueError:
+                self._send(400, {"error": "invalid parameter"})
+                return
+            rows, next_seq = channels[name].snapshot(since, every, limit)
+            self._send(200, {
+                "channel": name,
+                "next": next_seq,
+                "fields": list(SAMPLE_DTYPE.names),
+                "samples": [list(row) for row in zip(rows["seq"].tolist(), rows["step"].tolist(), rows["mode"].tolist(),
+                                                     rows["time"].tolist(), rows["voltage"].tolist(), rows["current"].tolist())]
+            })
+        else:
+            self._send(404, {"error": "unknown path"})
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class telemetryserver:
+    """
+    Local http endpoint for the live data of multiple channels. The server runs in a daemon thread
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765):
+        """
+        Keyword arguments:
+        host -- Address the server listens on, the default only accepts connections from the same PC
+        port -- TCP port of the server
+        """
+        self.host = host
+        self.port = port
+        self.channels = {}
+        self._server = None
+        self._thread = None
+
+    def add_channel(self, name, capacity=36000, status=None):
+        """Create a telemetrychannel, register it and return it"""
+        new_channel = telemetrychannel(name, capacity, status)
+        self.channels[name] = new_channel
+        return new_channel
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), _handler)
+        self._server.daemon_threads = True
+        self._server.channels = self.channels
+        self._thread = threading.Thread(target=self._server.serve_forever, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if(self._server is not None):
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
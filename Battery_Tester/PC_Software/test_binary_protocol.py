@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+import binary_protocol
+
+
+"""
+The Purpose of this Module is to check the framing of binary_protocol.py: the CRC, frames split across reads and the
+resynchronisation of the framedecoder after garbage and transmission errors.
+Run with python -m unittest test_binary_protocol
+"""
+
+
+def samples(start, count):
+    return [(3, 1000 + 25 * i, 3.5 + 0.001 * i, -1.25) for i in range(start, start + count)]
+
+
+class framedecodertest(unittest.TestCase):
+
+    def assertSamples(self, decoded, expected):
+        self.assertEqual(decoded["mode"].tolist(), [s[0] for s in expected])
+        self.assertEqual(decoded["time"].tolist(), [s[1] for s in expected])
+        np.testing.assert_allclose(decoded["voltage"], [s[2] for s in expected], rtol=1e-6)
+        np.testing.assert_allclose(decoded["current"], [s[3] for s in expected], rtol=1e-6)
+
+    def test_crc_check_value(self):
+        self.assertEqual(binary_protocol.crc16(b"123456789"), 0x29B1)
+
+    def test_frames(self):
+        decoder = binary_protocol.framedecoder()
+        decoder.feed(binary_protocol.encode_frame(0, samples(0, 4)) + binary_protocol.encode_frame(1, samples(4, 3)))
+        self.assertSamples(decoder.decode(), samples(0, 7))
+        self.assertEqual((decoder.frames, decoder.lost_frames, decoder.crc_errors, decoder.skipped_bytes), (2, 0, 0, 0))
+
+    def test_split_frames(self):
+        data = b"".join(binary_protocol.encode_frame(i, samples(4 * i, 4)) for i in range(3))
+        for chunk_size in (1, 2, 5, 13, 54):
+            decoder = binary_protocol.framedecoder()
+            decoded = []
+            for position in range(0, len(data), chunk_size):
+                decoder.feed(data[position:position + chunk_size])
+                decoded.append(decoder.decode())
+            self.assertSamples(np.concatenate(decoded), samples(0, 12))
+            self.assertEqual((decoder.frames, decoder.crc_errors, decoder.skipped_bytes), (3, 0, 0))
+
+    def test_corrupted_crc(self):
+        broken = bytearray(binary_protocol.encode_frame(1, samples(4, 4)))
+        broken[10] ^= 0x01
+        decoder = binary_protocol.framedecoder()
+        decoder.feed(binary_protocol.encode_frame(0, samples(0, 4)) + bytes(broken)
+                     + binary_protocol.encode_frame(2, samples(8, 4)))
+        self.assertSamples(decoder.decode(), samples(0, 4) + samples(8, 4))
+        self.assertEqual((decoder.frames, decoder.crc_errors, decoder.lost_frames), (2, 1, 1))
+        self.assertEqual(decoder.skipped_bytes, len(broken))
+
+    def test_leading_garbage(self):
+        #Ascii lines sent before the switch, a false sync and a single sync byte at the end of the first read
+        garbage = b"3,1000,3.5000,-1.2500\r\n\xa5\x5a\x09" + b"\xa5"
+        frame = binary_protocol.encode_frame(7, samples(0, 2))
+        decoder = binary_protocol.framedecoder()
+        decoder.feed(garbage + frame[:1])
+        self.assertEqual(len(decoder.decode()), 0)
+        decoder.feed(frame[1:])
+        self.assertSamples(decoder.decode(), samples(0, 2))
+        self.assertEqual(decoder.frames, 1)
+        self.assertEqual(decoder.skipped_bytes, len(garbage))
+
+
+if __name__ == "__main__":
+    unittest.main()
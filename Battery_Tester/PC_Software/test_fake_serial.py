@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import time as tim
+import unittest
+import fake_serial
+import hppc_tester
+import log_writer
+import schedule_engine as se
+
+
+"""
+The Purpose of this Module is to check that replayed logfiles of fake_serial.replayport end the acquisition loop
+at the end of the file instead of polling the empty port forever. Run with python -m unittest test_fake_serial
+"""
+
+
+RECORDED_LOG = """step,mode,time(ms),voltage,current
+1,3,1000,3.900,-0.750
+1,3,1101,3.895,-0.750
+1,3,1202,3.890,-0.750
+2,0,1303,3.950,0.000
+2,0,1404,3.955,0.000
+"""
+
+
+class replaytest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "recorded.csv")
+        with open(self.path, "w") as f:
+            f.write(RECORDED_LOG)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_port_raises_eof(self):
+        port = fake_serial.replayport(self.path, speedup=None)
+        for _ in range(len(port)):
+            self.assertTrue(port.readline().endswith(b"\r\n"))
+        with self.assertRaises(EOFError):
+            port.readline()
+        with self.assertRaises(EOFError):
+            port.read(16)
+
+    def test_replay_keeps_recorded_time(self):
+        with open(self.path, "a") as f:
+            f.write("2,0\n")
+            f.write("2,0,abc,3.960,0.000\n")
+            f.write("3,0,1904,3.960,0.000\n")
+        port = fake_serial.replayport(self.path, speedup=10)
+        self.assertEqual((len(port), port.skipped_lines), (6, 2))
+        lines = [port.readline() for _ in range(len(port))]
+        self.assertEqual(lines[-1], b"0,1904,3.960,0.000\r\n")
+        #Gap of 500ms between the last two lines at speedup 10
+        start = tim.perf_counter()
+        port = fake_serial.replayport(self.path, speedup=10)
+        for _ in range(len(port)):
+            port.readline()
+        self.assertGreater(tim.perf_counter() - start, (1904 - 1000) / 1000 / 10 * 0.9)
+
+    def test_get_data_raises_eof(self):
+        tester = hppc_tester.tester(fake_serial.replayport(self.path, speedup=None), clock=hppc_tester.deviceclock())
+        lines = [tester.get_data() for _ in range(5)]
+        self.assertEqual(lines[-1], b"0,1404,3.955,0.000\r\n")
+        with self.assertRaises(EOFError):
+            tester.get_data()
+
+    def test_get_data_timeouts(self):
+        #Real port without data: read() returns b"" after its timeout
+        silent = fake_serial.replayport(self.path, speedup=None)
+        silent.read = lambda size=1: b""
+        tester = hppc_tester.tester(silent)
+        self.assertIsNone(tester.get_data(max_timeouts=3))
+        self.assertEqual((tester.timeouts, tester.rejected_lines), (3, 0))
+
+    def test_schedule_ends_with_replay(self):
+        port = fake_serial.replayport(self.path, speedup=None)
+        tester = hppc_tester.tester(port, clock=hppc_tester.deviceclock())
+        #Schedule is longer than the recorded data
+        runner = se.schedulerunner([se.ccr(-0.75, 3600, limits=(4.2, 2.5)), se.idle(3600)])
+        log_path = os.path.join(self.folder, "replayed.csv")
+        with log_writer.open_log(log_path) as log:
+            se.run_schedule(tester, runner, log)
+        with open(log_path) as f:
+            self.assertEqual(len(f.readlines()), len(port) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import binary_log
+import capacity_counter
+import fake_serial
+import hppc_analysis
+import hppc_tester
+import log_stream
+import log_writer
+import ocv_analysis
+import schedule_engine as se
+
+
+"""
+The Purpose of this Module is to check that the chunked reducers of log_stream.py give the results of the batch
+analyses (hppc_analysis.analyse, ocv_analysis.extract_ocv, capacity_counter.capacitycounter) for any chunk size. The
+logs are recorded on fake_serial.simulatedport. Run with python -m unittest test_log_stream
+"""
+
+
+CHUNK_ROWS = (7, 64, 1000, 65536)
+
+HPPC_STEPS = [
+    se.cccv(4.1, 1.0, 0.05, 900, limits=(4.2, 2.4)),
+    se.idle(30),
+    se.repeat([
+        se.ccp(-1.5, 10, 4.5, 0.5),
+        se.idle(20),
+        se.ccp(0.75, 10, 4.5, 0.5),
+        se.idle(20),
+        se.ccr(-1.0, 60, limits=(4.2, 2.4)),
+        se.idle(40)
+    ], count=4)
+]
+
+OCV_STEPS = [
+    se.cccv(4.1, 1.0, 0.05, 900, limits=(4.2, 2.4)),
+    se.repeat([se.idle(20, limits=(4.2, 2.5)), se.ccr(-1.0, 40)], until="uv"),
+    se.idle(10, limits=(4.1, 0.0)),
+    se.repeat([se.idle(20), se.ccr(0.5, 80)], until="ov")
+]
+
+
+def record(path, steps, **cell):
+    """Runs the schedule on a simulated cell and writes the csv log"""
+    tester = hppc_tester.tester(fake_serial.simulatedport(seed=1, voltage_noise=0.0005, current_noise=0.002, **cell),
+                                clock=hppc_tester.deviceclock())
+    with log_writer.open_log(path, fsync_interval=None) as log:
+        se.run_schedule(tester, se.schedulerunner(steps), log)
+    return binary_log.load_log(path)
+
+
+def counted_steps(data):
+    """Returns the step summaries of a capacitycounter that saw every row of the log"""
+    counter = capacity_counter.capacitycounter()
+    steps = []
+    for row in data.tolist():
+        last_step = counter.last_step
+        counter.update(row[0], row[2], row[3], row[4])
+        if(counter.last_step is not last_step):
+            steps.append(counter.last_step)
+    steps.append(counter.step_summary())
+    return steps
+
+
+class reducertest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.hppc_path = os.path.join(cls.folder, "hppc_test.csv")
+        cls.ocv_path = os.path.join(cls.folder, "ocv_test.csv")
+        cls.hppc_data = record(cls.hppc_path, HPPC_STEPS, soc=0.6, capacity=0.15)
+        cls.ocv_data = record(cls.ocv_path, OCV_STEPS, soc=0.6, capacity=0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def assertResultsEqual(self, streamed, batch):
+        if(isinstance(batch, dict)):
+            self.assertEqual(sorted(streamed), sorted(batch))
+            for key in batch:
+                self.assertResultsEqual(streamed[key], batch[key])
+        elif(isinstance(batch, list)):
+            self.assertEqual(len(streamed), len(batch))
+            for s, b in zip(streamed, batch):
+                self.assertResultsEqual(s, b)
+        elif(isinstance(batch, np.ndarray) and batch.dtype.names is not None):
+            self.assertEqual(streamed.dtype, batch.dtype)
+            for name in batch.dtype.names:
+                np.testing.assert_allclose(streamed[name], batch[name], rtol=1e-9, atol=1e-12, err_msg=name)
+        else:
+            np.testing.assert_allclose(streamed, batch, rtol=1e-9, atol=1e-12)
+
+    def test_logs(self):
+        #The logs contain enough steps to cross many chunk boundaries
+        self.assertEqual(len(hppc_analysis.analyse(self.hppc_data)), 8)
+        self.assertGreater(len(ocv_analysis.extract_ocv(self.ocv_data)["soc_discharge_points"]), 3)
+        self.assertGreater(len(ocv_analysis.extract_ocv(self.ocv_data)["soc_charge_points"]), 3)
+
+    def test_pulsereducer(self):
+        batch = hppc_analysis.analyse(self.hppc_data)
+        for chunk_rows in CHUNK_ROWS:
+            with self.subTest(chunk_rows=chunk_rows):
+                streamed = log_stream.reduce_log(self.hppc_path, [log_stream.pulsereducer(batch=3)], chunk_rows)[0]
+                self.assertResultsEqual(streamed, batch)
+
+    def test_ocvreducer(self):
+        batch = ocv_analysis.extract_ocv(self.ocv_data)
+        for chunk_rows in CHUNK_ROWS:
+            with self.subTest(chunk_rows=chunk_rows):
+                streamed = log_stream.reduce_log(self.ocv_path, [log_stream.ocvreducer()], chunk_rows)[0]
+                self.assertResultsEqual(streamed, batch)
+
+    def test_capacityreducer(self):
+        for path, data in ((self.hppc_path, self.hppc_data), (self.ocv_path, self.ocv_data)):
+            batch = counted_steps(data)
+            for chunk_rows in CHUNK_ROWS:
+                with self.subTest(path=os.path.basename(path), chunk_rows=chunk_rows):
+                    streamed = log_stream.reduce_log(path, [log_stream.capacityreducer()], chunk_rows)[0]
+                    self.assertResultsEqual(streamed, batch)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+import checkpoint
+import fake_serial
+import hppc_tester
+import schedule_engine as se
+
+
+"""
+The Purpose of this Module is to check the compiled schedules of schedule_engine.py (loops, counters, branches, until
+conditions and resuming at a checkpoint) by running short schedules on fake_serial.simulatedport in device time.
+Run with python -m unittest test_schedule_engine
+"""
+
+
+IDLE = int(hppc_tester.operatingmodes["IDLE"])
+CCCV = int(hppc_tester.operatingmodes["CCCV"])
+CCR = int(hppc_tester.operatingmodes["CCR"])
+
+
+def new_tester(**cell):
+    tester = hppc_tester.tester(fake_serial.simulatedport(speedup=None, **cell), clock=hppc_tester.deviceclock())
+    tester.set_voltage_limits(4.2, 2.5)
+    return tester
+
+
+def run(runner, tester, stop_after=None, max_samples=100000):
+    """Runs the schedule and returns the started operations as list of (step, target mode, start time in s, duration in s)
+
+    Keyword arguments:
+    stop_after -- Device time in s after the first sample after which the run is interrupted like a crash of the PC software
+    """
+    starts = []
+    step = None
+    first = None
+    for _ in range(max_samples):
+        sample, data = tester.read_sample()
+        if(sample is None):
+            continue
+        running = runner.update(tester)
+        now = tester.time_millis / 1000
+        first = now if first is None else first
+        #The first sample starts the first operation or the operation of a resumed schedule
+        if(runner.step != step):
+            step = runner.step
+            starts.append((step, tester.target_operating_mode, now))
+        if(not running or (stop_after is not None and now - first >= stop_after)):
+            break
+    else:
+        raise AssertionError("schedule didn't finish")
+    ends = [start[2] for start in starts[1:]] + [now]
+    return [(step, mode, start, end - start) for (step, mode, start), end in zip(starts, ends)]
+
+
+class scheduletestcase(unittest.TestCase):
+
+    def assertDurations(self, operations, durations):
+        """The operations end with the first sample after their duration"""
+        self.assertEqual(len(operations), len(durations))
+        for operation, duration in zip(operations, durations):
+            self.assertAlmostEqual(operation[3], duration, delta=0.25)
+
+
+class schedulertest(scheduletestcase):
+
+    def test_counted_loops(self):
+        steps = [
+            se.repeat([se.idle(1), se.repeat([se.ccr(-0.5, 2)], count=2)], count=2),
+            se.idle(1)
+        ]
+        operations = run(se.schedulerunner(steps), new_tester())
+        self.assertEqual([op[0] for op in operations], list(range(1, 8)))
+        self.assertEqual([op[1] for op in operations], [IDLE, CCR, CCR, IDLE, CCR, CCR, IDLE])
+        self.assertDurations(operations, [1, 2, 2, 1, 2, 2, 1])
+
+    def test_branch(self):
+        otherwise = [se.idle(2), se.ccr(0.5, 1)]
+        for discharge, modes in ((-0.5, [CCR, IDLE, CCR]), (-3.0, [CCR, IDLE])):
+            #Only the high current reaches the lower limit
+            steps = [se.ccr(discharge, 3, limits=(4.2, 2.9)), se.branch("uv", [se.idle(1)], otherwise)]
+            operations = run(se.schedulerunner(steps), new_tester(soc=0.5, capacity=0.05))
+            self.assertEqual([op[1] for op in operations], modes)
+
+    def test_until(self):
+        #Loop without count ends on the until condition after any of its steps, operations on their own until condition
+        steps = [
+            se.repeat([se.idle(1), se.ccr(-1.0, 60, until=lambda t: t.voltage < 3.3)], until="uv"),
+            se.idle(1, limits=(4.2, 0.0))
+        ]
+        operations = run(se.schedulerunner(steps), new_tester(soc=0.5, capacity=0.005))
+        loop = operations[:-1]
+        self.assertGreater(len(loop), 2)
+        self.assertEqual([op[1] for op in loop], [IDLE, CCR] * (len(loop) // 2) + [IDLE] * (len(loop) % 2))
+        self.assertTrue(all(op[3] < 59 for op in loop if op[1] == CCR))
+        self.assertEqual(operations[-1][1], IDLE)
+        self.assertDurations(operations[-1:], [1])
+
+    def test_repeat_without_operation(self):
+        with self.assertRaises(ValueError):
+            se.schedulerunner([se.repeat([se.branch("uv", [], [])], until="uv")])
+
+    def test_double_idle_after_discharge(self):
+        #Transition of incremental_ocv.py: the discharge loop ends on uv, the rest of 10s is followed by the first
+        #rest of the charge loop, which must not end early on the flags of the discharge
+        discharge_steps = [se.idle(2, limits=(4.2, 3.0)), se.ccr(-1.0, 5)]
+        charge_steps = [se.idle(3), se.ccr(1.0, 5)]
+        steps = [
+            se.cccv(4.1, 1.0, 0.2, 60, limits=(4.2, 2.9)),
+            se.repeat(discharge_steps, until="uv"),
+            se.idle(10, limits=(4.1, 0.0)),
+            se.repeat(charge_steps, until="ov")
+        ]
+        operations = run(se.schedulerunner(steps), new_tester(soc=0.5, capacity=0.01))
+        modes = [op[1] for op in operations]
+        transition = next(i for i in range(len(modes) - 1) if modes[i] == IDLE and modes[i + 1] == IDLE)
+        self.assertEqual(modes[:transition], [CCCV] + [IDLE, CCR] * ((transition - 1) // 2))
+        #The last discharge ended on the lower voltage limit
+        self.assertLess(operations[transition - 1][3], 4.75)
+        self.assertDurations(operations[transition:transition + 2], [10, 3])
+        self.assertEqual(modes[transition + 2:], [CCR] + [IDLE, CCR] * ((len(modes) - transition - 3) // 2))
+
+
+class resumetest(scheduletestcase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resume_with_remaining_time(self):
+        steps = [se.repeat([se.idle(1), se.ccr(-0.5, 10)], count=2), se.idle(1)]
+        runner = se.schedulerunner(steps)
+        tester = new_tester()
+        #Crash 4s after the start of the first discharge (step 2)
+        before = run(runner, tester, stop_after=5)
+        self.assertEqual([op[1] for op in before], [IDLE, CCR])
+        path = os.path.join(self.folder, "test.checkpoint")
+        checkpoint.save(path, {"schedule": runner.state(tester), "counters": []})
+        remaining = runner.state(tester)["remaining"]
+        self.assertAlmostEqual(remaining, 10 - before[1][3], delta=0.25)
+
+        #Restart with a new tester and runner, the device time starts again
+        runner = se.schedulerunner(steps)
+        tester = new_tester()
+        self.assertTrue(checkpoint.resume(path, runner, tester))
+        after = run(runner, tester)
+        self.assertEqual([op[0] for op in after], [2, 3, 4, 5])
+        self.assertEqual([op[1] for op in after], [CCR, IDLE, CCR, IDLE])
+        self.assertDurations(after, [remaining, 1, 10, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+import os
+import json
+import bisect
+import time as tim
+
+
+"""
+The Purpose of this Module is to measure whether the PC keeps up with the samples of a tester. A metrics object is passed to
+hppc_tester.tester and collects:
+
+serial_wait -- Time read_sample() waited for a complete line from the COM port
+parse -- Time needed to parse the line
+processing -- Time between two read_sample() calls that is spent outside of the tester (log, observers, schedule), i.e.
+              the time per sample the PC needs besides waiting for data
+log_write -- Time of the log.write() calls (see timedsink)
+sample_interval -- Difference of time_millis between two samples (jitter of the device)
+command_latency -- Time between sending a command and the first sample that reports the commanded mode
+
+and counts missed samples (time_millis gap larger than 1.5 sample intervals), duplicated samples (same time_millis twice),
+resets of the device (time_millis running backwards) and rejected lines. All times are collected in histograms with fixed
+logarithmic buckets, so adding a value costs a bisect and a few additions and the memory doesn't grow.
+
+If a path is given, the metrics are written as json file every export_interval seconds. The file is replaced atomically,
+so it can be read at any time by another program.
+"""
+
+
+#Upper bounds of the histogram buckets in seconds, 10 buckets per decade from 1us to 100s
+BUCKET_BOUNDS = [10 ** (e / 10) for e in range(-60, 21)]
+
+
+class histogram:
+    """
+    Histogram with fixed logarithmic buckets
+    """
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if(self.min is None or value < self.min):
+            self.min = value
+        if(self.max is None or value > self.max):
+            self.max = value
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket containing the p-th percentile (0..100)"""
+        if(self.count == 0):
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if(seen >= rank and count > 0):
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets": {"%.6g" % bound: count for bound, count in zip(self.bounds + [float("inf")], self.counts) if count}
+        }
+
+
+class timedsink:
+    """
+    Wraps a log sink and adds the time of every write() to the log_write histogram
+    """
+
+    def __init__(self, sink, metrics):
+        self.sink = sink
+        self.metrics = metrics
+
+    def write(self, step, line, sample=None):
+        start = tim.perf_counter()
+        self.sink.write(step, line, sample)
+        self.metrics.log_write.add(tim.perf_counter() - start)
+
+    def flush(self):
+        self.sink.flush()
+
+    def sync(self):
+        self.sink.sync()
+
+    def close(self):
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class metrics:
+    """
+    Counters and histograms of the acquisition loop of one tester
+    """
+
+    def __init__(self, path=None, export_interval=60.0, sample_interval=101):
+        """
+        Keyword arguments:
+        path -- Path of the json file the metrics are exported to. None disables the export
+        export_interval -- Time between two exports in seconds
+        sample_interval -- Expected time between two samples of the device in milliseconds
+        """
+        self.path = path
+        self.export_interval = export_interval
+        self.sample_interval = sample_interval
+
+        self.serial_wait = histogram()
+        self.parse = histogram()
+        self.processing = histogram()
+        self.log_write = histogram()
+        self.sample_interval_hist = histogram()
+        self.command_latency = histogram()
+
+        self.samples = 0
+        self.rejected_lines = 0
+        self.missed_samples = 0
+        self.duplicated_samples = 0
+        self.device_resets = 0
+        self.commands = 0
+
+        self.start_time = tim.time()
+        self._last_export = tim.perf_counter()
+        self._last_return = None
+        self._last_millis = None
+        self._command_mode = None
+        self._command_time = 0.0
+
+    def read_started(self, now):
+        """Called by the tester when read_sample() is entered"""
+        if(self._last_return is not None):
+            self.processing.add(now - self._last_return)
+
+    def sample_read(self, start, received, parsed, sample):
+        """Called by the tester after a line was read and parsed (sample is None for rejected lines)"""
+        self.serial_wait.add(received - start)
+        self.parse.add(parsed - received)
+        self._last_return = parsed
+        if(sample is None):
+            self.rejected_lines += 1
+            return
+        self.samples += 1
+
+        millis = sample[1]
+        if(self._last_millis is not None):
+            dt = millis - self._last_millis
+            if(dt == 0):
+                self.duplicated_samples += 1
+            elif(dt < 0):
+                self.device_resets += 1
+            else:
+                self.sample_interval_hist.add(dt / 1000)
+                if(dt > 1.5 * self.sample_interval):
+                    self.missed_samples += int(round(dt / self.sample_interval)) - 1
+        self._last_millis = millis
+
+        if(self._command_mode is not None and sample[0] == self._command_mode):
+            self.command_latency.add(parsed - self._command_time)
+            self._command_mode = None
+
+        if(self.path is not None and (parsed - self._last_export) >= self.export_interval):
+            self._last_export = parsed
+            self.export()
+
+    def command_sent(self, mode):
+        """Called by the tester when a command for an operating mode (as int) was sent"""
+        self.commands += 1
+        self._command_mode = mode
+        self._command_time = tim.perf_counter()
+
+    def wrap_sink(self, sink):
+        """Returns a timedsink that measures the write time of the log sink"""
+        return timedsink(sink, self)
+
+    def summary(self):
+        return {
+            "time": tim.time(),
+            "duration": tim.time() - self.start_time,
+            "samples": self.samples,
+            "rejected_lines": self.rejected_lines,
+            "missed_samples": self.missed_samples,
+            "duplicated_samples": self.duplicated_samples,
+            "device_resets": self.device_resets,
+            "commands": self.commands,
+            "serial_wait": self.serial_wait.summary(),
+            "parse": self.parse.summary(),
+            "processing": self.processing.summary(),
+            "log_write": self.log_write.summary(),
+            "sample_interval": self.sample_interval_hist.summary(),
+            "command_latency": self.command_latency.summary()
+        }
+
+    def export(self, path=None):
+        """Write the summary as json file (atomic replace)"""
+        path = self.path if path is None else path
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+        os.replace(temp_path, path)